@@ -1,12 +1,159 @@
 # agents/team.py
 from autogen_agentchat.agents import AssistantAgent
-from autogen_agentchat.conditions import MaxMessageTermination, TextMentionTermination
+from autogen_agentchat.conditions import MaxMessageTermination, TextMentionTermination, TextMessageTermination
 from autogen_agentchat.teams import SelectorGroupChat
-from core.config import load_prompt
+# Private modules; autogen-agentchat is pinned in requirements.txt.
+from autogen_agentchat.teams._group_chat._chat_agent_container import ChatAgentContainer
+from autogen_agentchat.teams._group_chat._selector_group_chat import SelectorGroupChatManager
+from autogen_agentchat.messages import TextMessage
+from autogen_core import AgentId
+from autogen_core.model_context import BufferedChatCompletionContext
+from autogen_core.models import AssistantMessage, UserMessage
+from core import config
+from core.context import PinnedChatCompletionContext, SummarizingChatCompletionContext
+from core.prompts import load_prompt
+from core.router import make_selector_func
+from core.scheduler import PRIORITY_AGENT, PRIORITY_BACKGROUND, PRIORITY_NPC
+
+
+def _client_for(model_client, label: str, response_format: dict | None = None, priority: int = PRIORITY_AGENT):
+    # Pooled session clients can tag requests per caller for tracing and scheduling; plain clients are used as-is.
+    labeled = getattr(model_client, "labeled", None)
+    return labeled(label, response_format=response_format, priority=priority) if labeled else model_client
+
+
+def _context_for(model_client, pinned=None):
+    if config.CONTEXT_MODE != "summary":
+        # None lets AssistantAgent fall back to its default unbounded context.
+        return PinnedChatCompletionContext(pinned) if pinned else None
+    return SummarizingChatCompletionContext(summarizer=_client_for(model_client, "summarizer", priority=PRIORITY_BACKGROUND), pinned=pinned)
+
+
+def _trim(messages: list, limit: int = config.CONTEXT_SELECTOR_THREAD) -> None:
+    if len(messages) > limit:
+        del messages[:len(messages) - limit]
+
+
+class _BoundedSelectorGroupChatManager(SelectorGroupChatManager):
+    """
+    Keeps only the last CONTEXT_SELECTOR_THREAD messages of the group chat
+    thread. The agents have their own (summarized) contexts and routing only
+    looks at the latest messages, so older ones would just make every
+    save_state() and load_state() of the team grow with the conversation.
+    """
+
+    async def update_message_thread(self, messages) -> None:
+        await super().update_message_thread(messages)
+        _trim(self._message_thread)
+
+    async def load_state(self, state) -> None:
+        # States saved before the thread was bounded are trimmed on load.
+        await super().load_state(state)
+        _trim(self._message_thread)
+
+
+class _BoundedChatAgentContainer(ChatAgentContainer):
+    """
+    A participant's buffer of group messages it has not seen yet, bounded the
+    same way: specialists that are rarely selected would otherwise buffer
+    (and save) every message of the conversation.
+    """
+
+    def _buffer_message(self, message) -> None:
+        super()._buffer_message(message)
+        _trim(self._message_buffer)
+
+    async def load_state(self, state) -> None:
+        await super().load_state(state)
+        _trim(self._message_buffer)
+
+
+class BoundedSelectorGroupChat(SelectorGroupChat):
+    """SelectorGroupChat whose manager and participants keep bounded message lists."""
+
+    def _create_participant_factory(self, parent_topic_type, output_topic_type, agent, message_factory):
+        return lambda: _BoundedChatAgentContainer(parent_topic_type, output_topic_type, agent, message_factory)
+
+    def _create_group_chat_manager_factory(
+        self,
+        name,
+        group_topic_type,
+        output_topic_type,
+        participant_topic_types,
+        participant_names,
+        participant_descriptions,
+        output_message_queue,
+        termination_condition,
+        max_turns,
+        message_factory,
+    ):
+        return lambda: _BoundedSelectorGroupChatManager(
+            name,
+            group_topic_type,
+            output_topic_type,
+            participant_topic_types,
+            participant_names,
+            participant_descriptions,
+            output_message_queue,
+            termination_condition,
+            max_turns,
+            message_factory,
+            self._model_client,
+            self._selector_prompt,
+            self._allow_repeated_speaker,
+            self._selector_func,
+            self._max_selector_attempts,
+            self._candidate_func,
+            self._emit_team_events,
+            self._model_context,
+            self._model_client_streaming,
+        )
+
+    async def record_exchange(self, task: str, reply: str, speaker: str) -> None:
+        """
+        Adds a turn that was answered without running the team (a response
+        cache hit) to its history, as if `speaker` had replied `reply`.
+        """
+        if not self._initialized:
+            await self._init(self._runtime)
+        messages = [TextMessage(content=task, source="user"), TextMessage(content=reply, source=speaker)]
+        manager = await self._runtime.try_get_underlying_agent_instance(
+            AgentId(self._group_chat_manager_topic_type, self._team_id), _BoundedSelectorGroupChatManager
+        )
+        await manager.update_message_thread(messages)
+        for agent, topic_type in zip(self._participants, self._participant_topic_types):
+            if agent.name == speaker:
+                # What the agent would have added to its context had it been run.
+                await agent.model_context.add_message(UserMessage(content=task, source="user"))
+                await agent.model_context.add_message(AssistantMessage(content=reply, source=speaker))
+                continue
+            container = await self._runtime.try_get_underlying_agent_instance(
+                AgentId(topic_type, self._team_id), _BoundedChatAgentContainer
+            )
+            for message in messages:
+                container._buffer_message(message)
+
+
+def get_npc_agent(team: SelectorGroupChat, npc_name: str) -> AssistantAgent | None:
+    """The NPC participant of a team from create_agent_team(), e.g. to re-ask it alone."""
+    return next((agent for agent in team._participants if agent.name == npc_name), None)
+
 
 def create_agent_team(
-    model_client, npc_config: dict, npc_memory, all_tools: list
+    model_client,
+    npc_config: dict,
+    npc_memory,
+    all_tools: list,
+    stream_responses: bool = False,
+    environment_context=None,
 ) -> SelectorGroupChat:
+    """
+    environment_context: optional async callable returning the current world
+    snapshot; when given, the NPC always sees it and answers world questions
+    without a CodeAnalyzerAgent hop.
+    """
+    # Schema-constrained replies need a pooled client to attach the response format to.
+    structured = config.NPC_STRUCTURED_OUTPUT and hasattr(model_client, "labeled")
     
     npc_system_message = load_prompt(
         "npc_system_message.txt",
@@ -42,35 +189,46 @@ def create_agent_team(
     npc_agent = AssistantAgent(
         name=npc_config["name"],
         system_message=npc_system_message,
-        model_client=model_client,
+        model_client=_client_for(
+            model_client,
+            npc_config["name"],
+            response_format=config.NPC_RESPONSE_FORMAT if structured else None,
+            priority=PRIORITY_NPC,
+        ),
         tools=npc_tools,
         reflect_on_tool_use=False,
         memory=[npc_memory],
+        model_context=_context_for(model_client, pinned=environment_context),
+        # Emits ModelClientStreamingChunkEvent tokens when the team is run with run_stream().
+        model_client_stream=stream_responses,
         description=f"The synthesizer and final responder who speaks to the user. This agent DOES NOT possess factual knowledge on its own. It MUST wait for specialists like CodeAnalyzerAgent or StoryAgent to provide data before answering any factual question."
     )
 
     story_agent = AssistantAgent(
         name="story_agent",
         system_message=story_system_message,
-        model_client=model_client,
+        model_client=_client_for(model_client, "story_agent"),
         tools=story_tools,
         reflect_on_tool_use=False,
+        model_context=_context_for(model_client),
         description="A specialist data-gathering agent. Call this agent when the user asks a Factual Inquiry about background lore or story details. Its job is to provide context to the main NPC.",
     )
 
     code_analyzer_agent = AssistantAgent(
         name="CodeAnalyzerAgent",
         system_message=code_analyzer_system_message,
-        model_client=model_client,
+        model_client=_client_for(model_client, "CodeAnalyzerAgent"),
         tools=code_analyzer_tools,
         reflect_on_tool_use=False,
+        model_context=_context_for(model_client),
         description="A specialist data-gathering agent. Call this agent when the user asks a Factual Inquiry about the game world, such as item locations, store layout, or object status. Its output is raw JSON data for the main NPC to use.",
     )
 
     vision_agent = AssistantAgent(
         name="VisionAgent",
         system_message=vision_system_message,
-        model_client=model_client,
+        model_client=_client_for(model_client, "VisionAgent"),
+        model_context=_context_for(model_client),
         # No tools are needed; its instructions are to describe images.
         description="Specialized agent for describing the content of images/screenshots from the game world."
     )
@@ -78,13 +236,25 @@ def create_agent_team(
     termination = MaxMessageTermination(max_messages=20) | TextMentionTermination(
         "APPROVE"
     )
+    if structured:
+        # A constrained reply cannot carry "APPROVE"; the NPC's JSON reply itself ends the turn.
+        termination = termination | TextMessageTermination(source=npc_config["name"])
 
-    team = SelectorGroupChat(
+    team = BoundedSelectorGroupChat(
         participants=[npc_agent, story_agent, code_analyzer_agent, vision_agent],
-        model_client=model_client,
+        model_client=_client_for(model_client, "selector"),
+        model_context=BufferedChatCompletionContext(buffer_size=config.CONTEXT_SELECTOR_MESSAGES),
         termination_condition=termination,
         allow_repeated_speaker=True,
         max_selector_attempts=3,
+        # Social turns and plain lookups skip the selector model call; unclear turns still use it.
+        selector_func=(
+            make_selector_func(npc_config["name"], world_in_context=environment_context is not None)
+            if config.ROUTER_ENABLED
+            else None
+        ),
+        # SelectSpeakerEvents let the server time selector and agent steps per turn.
+        emit_team_events=True,
     )
 
     return team
\ No newline at end of file
@@ -0,0 +1,201 @@
+# bench/fake_model_server.py
+"""
+Local stand-in for the OpenAI-compatible chat completions API, used by
+bench/load_test.py so the server can be load-tested with no network.
+
+- Selector requests ("select the next role from [...]") get the first
+  participant, i.e. the NPC.
+- Agent requests get a tool call (with probability --tool-call-rate, when the
+  agent has tools and has not just received a tool result) or a scripted
+  NPCResponse JSON followed by APPROVE.
+- Every response waits --latency-ms (+/- --jitter-ms); streamed responses
+  spread that wait over the chunks.
+- With --rpm-limit, requests beyond that many per rolling minute get a 429
+  with Retry-After, like a provider quota.
+
+Run standalone:  python bench/fake_model_server.py --port 8901
+"""
+import argparse
+import ast
+import asyncio
+import json
+import random
+import re
+import time
+import uuid
+from collections import deque
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+SELECTOR_RE = re.compile(r"select the next role from (\[.*?\]) to play", re.DOTALL)
+MOODS = ["neutral", "happy", "curious", "excited", "sarcastic"]
+TOOL_ARGS = {
+    "perception_tool": {"event": "A customer walks in."},
+    "personality_tool": {},
+    "memory_tool": {"query": ""},
+}
+
+app = FastAPI(title="Fake model server")
+settings = argparse.Namespace(latency_ms=200.0, jitter_ms=50.0, tool_call_rate=0.2, response_words=40, seed=None, rpm_limit=0)
+rng = random.Random()
+accepted: deque[float] = deque()  # Times of requests inside the current quota window
+
+
+def _latency() -> float:
+    return max(settings.latency_ms + rng.uniform(-settings.jitter_ms, settings.jitter_ms), 0.0) / 1000
+
+
+def _text_of(message: dict) -> str:
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        return " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content
+
+
+def _estimate_tokens(text: str) -> int:
+    return max(len(text) // 4, 1)
+
+
+def _npc_reply(structured: bool) -> str:
+    words = " ".join(rng.choice(["well", "the", "aisle", "shiny", "customer", "hmm", "indeed", "store"]) for _ in range(settings.response_words))
+    reply = {
+        "thoughts": "Scripted benchmark reply.",
+        "response": f"Welcome! {words}.",
+        "mood": rng.choice(MOODS),
+        "action": "RESPOND: user",
+        "animation": "talk",
+    }
+    # A schema-constrained reply is the bare JSON object, like a real provider's.
+    return json.dumps(reply) if structured else json.dumps(reply) + "\nAPPROVE"
+
+
+def _plan(body: dict) -> dict:
+    """Decides what to answer: {'content': str} or {'tool_call': (name, args)}."""
+    # Memory contents are appended as system messages; look past them.
+    last = next((m for m in reversed(body.get("messages", [])) if m.get("role") != "system"), {})
+    match = SELECTOR_RE.search(_text_of(last))
+    if match:
+        participants = ast.literal_eval(match.group(1))
+        return {"content": participants[0]}
+    tool_names = [t["function"]["name"] for t in body.get("tools", []) if t.get("type") == "function"]
+    usable = [name for name in tool_names if name in TOOL_ARGS]
+    if usable and last.get("role") != "tool" and rng.random() < settings.tool_call_rate:
+        name = rng.choice(usable)
+        return {"tool_call": (name, TOOL_ARGS[name])}
+    structured = (body.get("response_format") or {}).get("type") == "json_schema"
+    return {"content": _npc_reply(structured)}
+
+
+def _usage(body: dict, completion: str) -> dict:
+    prompt = "".join(_text_of(m) for m in body.get("messages", []))
+    prompt_tokens, completion_tokens = _estimate_tokens(prompt), _estimate_tokens(completion)
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+
+
+def _tool_call(name: str, args: dict) -> dict:
+    return {"id": f"call_{uuid.uuid4().hex[:12]}", "type": "function", "function": {"name": name, "arguments": json.dumps(args)}}
+
+
+def _over_quota() -> float | None:
+    """Seconds until the rolling-minute quota has room again, or None if this request fits."""
+    if not settings.rpm_limit:
+        return None
+    now = time.monotonic()
+    while accepted and now - accepted[0] >= 60:
+        accepted.popleft()
+    if len(accepted) >= settings.rpm_limit:
+        return 60 - (now - accepted[0])
+    accepted.append(now)
+    return None
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    retry_after = _over_quota()
+    if retry_after is not None:
+        return JSONResponse(
+            {"error": {"message": "Rate limit exceeded", "type": "rate_limit_exceeded", "code": 429}},
+            status_code=429,
+            headers={"Retry-After": f"{retry_after:.2f}"},
+        )
+    plan = _plan(body)
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+    created = int(time.time())
+    model = body.get("model", "fake")
+    if body.get("stream"):
+        return StreamingResponse(_stream(body, plan, completion_id, created, model), media_type="text/event-stream")
+
+    await asyncio.sleep(_latency())
+    if "tool_call" in plan:
+        message = {"role": "assistant", "content": None, "tool_calls": [_tool_call(*plan["tool_call"])]}
+        finish_reason, completion = "tool_calls", json.dumps(plan["tool_call"][1])
+    else:
+        message = {"role": "assistant", "content": plan["content"]}
+        finish_reason, completion = "stop", plan["content"]
+    return JSONResponse({
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": created,
+        "model": model,
+        "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+        "usage": _usage(body, completion),
+    })
+
+
+async def _stream(body: dict, plan: dict, completion_id: str, created: int, model: str):
+    def chunk(delta: dict, finish_reason=None, usage=None) -> str:
+        payload = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [] if usage else [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        if usage:
+            payload["usage"] = usage
+        return f"data: {json.dumps(payload)}\n\n"
+
+    total = _latency()
+    if "tool_call" in plan:
+        await asyncio.sleep(total)
+        call = _tool_call(*plan["tool_call"])
+        yield chunk({"role": "assistant", "tool_calls": [{"index": 0, **call}]})
+        yield chunk({}, finish_reason="tool_calls")
+        completion = call["function"]["arguments"]
+    else:
+        completion = plan["content"]
+        pieces = re.findall(r"\S+\s*", completion) or [completion]
+        # Roughly half the latency before the first token, the rest spread over the tokens.
+        await asyncio.sleep(total / 2)
+        yield chunk({"role": "assistant", "content": ""})
+        for piece in pieces:
+            await asyncio.sleep(total / 2 / len(pieces))
+            yield chunk({"content": piece})
+        yield chunk({}, finish_reason="stop")
+    if (body.get("stream_options") or {}).get("include_usage"):
+        yield chunk({}, usage=_usage(body, completion))
+    yield "data: [DONE]\n\n"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8901)
+    parser.add_argument("--latency-ms", type=float, default=settings.latency_ms, help="Mean time per model request.")
+    parser.add_argument("--jitter-ms", type=float, default=settings.jitter_ms)
+    parser.add_argument("--tool-call-rate", type=float, default=settings.tool_call_rate, help="Chance an agent answers with a tool call first.")
+    parser.add_argument("--response-words", type=int, default=settings.response_words)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--rpm-limit", type=int, default=0, help="Answer 429 past this many requests per minute (0: no quota).")
+    args = parser.parse_args()
+    for key in ("latency_ms", "jitter_ms", "tool_call_rate", "response_words", "seed", "rpm_limit"):
+        setattr(settings, key, getattr(args, key))
+    rng.seed(args.seed)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+# bench/load_test.py
+"""
+Offline load test for fastapi_app.
+
+Starts bench/fake_model_server.py and the app (uvicorn, in a scratch working
+directory so state/ and memory/ of the checkout are untouched), then drives N
+concurrent clients through /initialize + /ws/{session_id} with a scripted
+conversation. Reports turn latency percentiles, time to first streamed token,
+throughput, event-loop lag and RSS of the app process, and state-file write
+times (from the app's /metrics).
+
+    python bench/load_test.py --clients 50 --turns 5 --latency-ms 300
+    python bench/load_test.py --clients 20 --max-p95-ms 2500 --json bench_result.json
+    python bench/load_test.py --clients 40 --personas 4 --ramp 20   # returning, popular NPCs
+    python bench/load_test.py --clients 10 --quota-rpm 120          # behind a provider quota
+
+Exits non-zero if any turn failed or --max-p95-ms is exceeded.
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+import psutil
+import websockets
+
+APP_DIR = Path(__file__).resolve().parent.parent
+BENCH_DIR = Path(__file__).resolve().parent
+SCRIPT = [
+    "Hello there!",
+    "How is business today?",
+    "What do you think of the new customers?",
+    "Could you tell me a little about yourself?",
+    "Thanks, see you around.",
+]
+FINAL_TYPES = {"dialogue", "dialogue_end", "error"}
+METRIC_RE = re.compile(r'^(\w+)(\{[^}]*\})? ([0-9.eE+-]+)$')
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = min(int(round(pct / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def _parse_metrics(text: str) -> dict[str, float]:
+    """Flattens Prometheus text into {'name{labels}': value}."""
+    values = {}
+    for line in text.splitlines():
+        match = METRIC_RE.match(line)
+        if match:
+            values[match.group(1) + (match.group(2) or "")] = float(match.group(3))
+    return values
+
+
+def _prepare_workdir() -> Path:
+    workdir = Path(tempfile.mkdtemp(prefix="npc_bench_"))
+    for name in ("prompts", "public"):
+        shutil.copytree(APP_DIR / name, workdir / name)
+    shutil.copytree(APP_DIR / "data", workdir / "data", ignore=shutil.ignore_patterns("uploads"))
+    (workdir / "state").mkdir()
+    return workdir
+
+
+async def _wait_ready(client: httpx.AsyncClient, url: str, proc: subprocess.Popen, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"{url} exited with code {proc.returncode} before becoming ready")
+        try:
+            await client.get(url)
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not become ready within {timeout:.0f}s")
+
+
+class Sampler:
+    """Polls RSS of the app process and its event-loop lag gauge while the test runs."""
+
+    def __init__(self, client: httpx.AsyncClient, metrics_url: str, pid: int, interval: float = 0.5):
+        self.client = client
+        self.metrics_url = metrics_url
+        self.process = psutil.Process(pid)
+        self.interval = interval
+        self.rss: list[float] = []
+        self.loop_lag: list[float] = []
+
+    async def run(self) -> None:
+        while True:
+            self.rss.append(self.process.memory_info().rss / 1024 / 1024)
+            try:
+                metrics = _parse_metrics((await self.client.get(self.metrics_url)).text)
+                self.loop_lag.append(metrics.get("npc_event_loop_lag_seconds", 0.0) * 1000)
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(self.interval)
+
+
+async def run_client(index: int, args, base_url: str, ws_url: str, client: httpx.AsyncClient, results: dict) -> None:
+    await asyncio.sleep(index * args.ramp / max(args.clients, 1))
+    started = time.perf_counter()
+    response = await client.post(f"{base_url}/initialize", json={
+        "name": f"BenchNPC{index % args.personas if args.personas else index:04d}",
+        "background": "A shopkeeper at the grocery store used for load testing.",
+        "behavior": "Friendly and brief.",
+    })
+    if response.status_code != 200:
+        results["errors"].append(f"client {index}: /initialize returned {response.status_code}")
+        return
+    results["init_ms"].append((time.perf_counter() - started) * 1000)
+    session_id = response.json()["session_id"]
+
+    async with websockets.connect(f"{ws_url}/ws/{session_id}", max_size=None) as ws:
+        for turn in range(args.turns):
+            sent = time.perf_counter()
+            first_delta = None
+            await ws.send(SCRIPT[turn % len(SCRIPT)])
+            while True:
+                raw = await asyncio.wait_for(ws.recv(), timeout=args.turn_timeout)
+                try:
+                    frame = json.loads(raw)
+                except json.JSONDecodeError:
+                    results["errors"].append(f"client {index}: {raw}")
+                    return
+                if frame.get("type") == "dialogue_delta" and first_delta is None:
+                    first_delta = time.perf_counter()
+                if frame.get("type") in FINAL_TYPES:
+                    break
+            done = time.perf_counter()
+            if frame["type"] == "error":
+                results["errors"].append(f"client {index} turn {turn}: {frame.get('message')}")
+                continue
+            results["turn_ms"].append((done - sent) * 1000)
+            if first_delta is not None:
+                results["first_token_ms"].append((first_delta - sent) * 1000)
+        await ws.send("_TERMINATE_")
+        # The server saves state and closes the socket.
+        try:
+            await asyncio.wait_for(ws.wait_closed(), timeout=args.turn_timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+def _summarize(values: list[float]) -> dict:
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "p50": round(_percentile(values, 50), 1),
+        "p90": round(_percentile(values, 90), 1),
+        "p95": round(_percentile(values, 95), 1),
+        "p99": round(_percentile(values, 99), 1),
+        "max": round(max(values), 1),
+        "mean": round(statistics.fmean(values), 1),
+    }
+
+
+async def main_async(args) -> int:
+    model_port, app_port = args.model_port or _free_port(), args.app_port or _free_port()
+    workdir = _prepare_workdir()
+    logs = open(workdir / "server.log", "w")
+    fake = subprocess.Popen(
+        [sys.executable, str(BENCH_DIR / "fake_model_server.py"), "--port", str(model_port),
+         "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms),
+         "--tool-call-rate", str(args.tool_call_rate), "--seed", str(args.seed), "--rpm-limit", str(args.quota_rpm)],
+        stdout=logs, stderr=subprocess.STDOUT,
+    )
+    env = {
+        **os.environ,
+        "MODEL_BASE_URL": f"http://127.0.0.1:{model_port}/v1",
+        "MODEL_NAME": "fake-npc-model",
+        "OPEN_ROUTER_API_KEY": "bench",
+        "NPC_STREAMING": "1" if args.stream else "0",
+        "MODEL_RATE_LIMIT_RPM": str(args.quota_rpm if args.app_rpm is None else args.app_rpm),
+        # No model downloads: the load test must run offline.
+        "HF_HUB_OFFLINE": "1",
+        "TRANSFORMERS_OFFLINE": "1",
+    }
+    app = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "fastapi_app:app", "--app-dir", str(APP_DIR),
+         "--host", "127.0.0.1", "--port", str(app_port), "--log-level", "warning"],
+        cwd=workdir, env=env, stdout=logs, stderr=subprocess.STDOUT,
+    )
+    base_url, ws_url = f"http://127.0.0.1:{app_port}", f"ws://127.0.0.1:{app_port}"
+    results = {"init_ms": [], "turn_ms": [], "first_token_ms": [], "errors": []}
+    limits = httpx.Limits(max_connections=args.clients + 10)
+    try:
+        async with httpx.AsyncClient(timeout=args.turn_timeout, limits=limits) as client:
+            await _wait_ready(client, f"http://127.0.0.1:{model_port}/docs", fake)
+            await _wait_ready(client, f"{base_url}/sessions/stats", app)
+            sampler = Sampler(client, f"{base_url}/metrics", app.pid)
+            sampler_task = asyncio.create_task(sampler.run())
+
+            started = time.perf_counter()
+            outcomes = await asyncio.gather(
+                *(run_client(i, args, base_url, ws_url, client, results) for i in range(args.clients)),
+                return_exceptions=True,
+            )
+            wall = time.perf_counter() - started
+            for i, outcome in enumerate(outcomes):
+                if isinstance(outcome, BaseException):
+                    results["errors"].append(f"client {i}: {type(outcome).__name__}: {outcome}")
+
+            # Wait for the server to finish saving closed sessions before reading write times.
+            deadline = time.monotonic() + args.turn_timeout
+            while time.monotonic() < deadline and (await client.get(f"{base_url}/sessions/stats")).json().get("live"):
+                await asyncio.sleep(0.2)
+            sampler_task.cancel()
+            metrics = _parse_metrics((await client.get(f"{base_url}/metrics")).text)
+            sessions = (await client.get(f"{base_url}/sessions/stats")).json()
+    finally:
+        for proc in (app, fake):
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        logs.close()
+
+    retries = sum(v for k, v in metrics.items() if k.startswith("npc_llm_scheduler_retries_total"))
+    state_label = '{kind="state",name="save"}'
+    save_count = metrics.get(f"npc_span_duration_seconds_count{state_label}", 0)
+    save_sum = metrics.get(f"npc_span_duration_seconds_sum{state_label}", 0)
+    report = {
+        "config": {k: v for k, v in vars(args).items() if k != "json"},
+        "wall_s": round(wall, 2),
+        "turns_ok": len(results["turn_ms"]),
+        "turns_per_s": round(len(results["turn_ms"]) / wall, 2) if wall else 0,
+        "errors": len(results["errors"]),
+        "init_ms": _summarize(results["init_ms"]),
+        "turn_ms": _summarize(results["turn_ms"]),
+        "first_token_ms": _summarize(results["first_token_ms"]),
+        "event_loop_lag_ms": _summarize(sampler.loop_lag),
+        "rss_mb": {
+            "start": round(sampler.rss[0], 1) if sampler.rss else None,
+            "peak": round(max(sampler.rss), 1) if sampler.rss else None,
+            "end": round(sampler.rss[-1], 1) if sampler.rss else None,
+        },
+        "sessions": sessions,
+        "scheduler_retries": int(retries),
+        "state_save_ms": {
+            "count": int(save_count),
+            "mean": round(save_sum / save_count * 1000, 2) if save_count else None,
+        },
+        "workdir": str(workdir),
+    }
+    print(json.dumps(report, indent=2))
+    for error in results["errors"][:10]:
+        print(f"‼️ {error}")
+    if args.json:
+        Path(args.json).write_text(json.dumps({**report, "error_samples": results["errors"][:50]}, indent=2))
+    if not args.keep_workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    failed = bool(results["errors"])
+    if args.max_p95_ms and report["turn_ms"].get("p95", 0) > args.max_p95_ms:
+        print(f"‼️ p95 turn latency {report['turn_ms']['p95']} ms exceeds --max-p95-ms {args.max_p95_ms}")
+        failed = True
+    return 1 if failed else 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=20, help="Concurrent conversations.")
+    parser.add_argument("--turns", type=int, default=5, help="Messages per conversation.")
+    parser.add_argument("--ramp", type=float, default=2.0, help="Seconds over which clients are started.")
+    parser.add_argument("--personas", type=int, default=0,
+                        help="Share this many NPC names between clients (returning NPCs); 0 gives each client its own.")
+    parser.add_argument("--latency-ms", type=float, default=200.0, help="Fake model latency per request.")
+    parser.add_argument("--jitter-ms", type=float, default=50.0)
+    parser.add_argument("--tool-call-rate", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--quota-rpm", type=int, default=0, help="Fake provider quota in requests per minute (0: none).")
+    parser.add_argument("--app-rpm", type=float, default=None,
+                        help="The app's own rate limit (MODEL_RATE_LIMIT_RPM); defaults to --quota-rpm, 0 turns it off.")
+    parser.add_argument("--stream", action=argparse.BooleanOptionalAction, default=True, help="Run with NPC_STREAMING on.")
+    parser.add_argument("--turn-timeout", type=float, default=120.0)
+    parser.add_argument("--model-port", type=int, default=0)
+    parser.add_argument("--app-port", type=int, default=0)
+    parser.add_argument("--max-p95-ms", type=float, default=0, help="Fail if p95 turn latency is above this.")
+    parser.add_argument("--json", help="Also write the report to this file.")
+    parser.add_argument("--keep-workdir", action="store_true", help="Keep the scratch dir (server.log, state/).")
+    sys.exit(asyncio.run(main_async(parser.parse_args())))
+
+
+if __name__ == "__main__":
+    main()
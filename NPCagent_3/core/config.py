@@ -3,6 +3,7 @@ import os
 from pathlib import Path
 from typing import Literal, Optional
 
+import httpx
 from autogen_ext.models.openai import OpenAIChatCompletionClient
 from dotenv import load_dotenv
 from pydantic import BaseModel
@@ -10,6 +11,99 @@ from pydantic import BaseModel
 load_dotenv()
 PROMPT_DIR = Path(__file__).parent.parent / "prompts"
 
+# OpenAI-compatible endpoint; bench/ points this at a local fake server.
+MODEL_BASE_URL = os.getenv("MODEL_BASE_URL", "https://openrouter.ai/api/v1")
+MODEL_NAME = os.getenv("MODEL_NAME", "meta-llama/llama-4-maverick:free")
+
+# Shared HTTP pool used by every session's model client (see core/model_pool.py)
+MODEL_POOL_MAX_CONNECTIONS = int(os.getenv("MODEL_POOL_MAX_CONNECTIONS", "100"))
+MODEL_POOL_MAX_KEEPALIVE = int(os.getenv("MODEL_POOL_MAX_KEEPALIVE", "20"))
+MODEL_POOL_KEEPALIVE_EXPIRY = float(os.getenv("MODEL_POOL_KEEPALIVE_EXPIRY", "30"))
+
+# Every model request goes through core/scheduler.py. Set the rate limit to the provider's
+# quota (OpenRouter free models: 20/min); 0 leaves only the concurrency cap.
+MODEL_RATE_LIMIT_RPM = float(os.getenv("MODEL_RATE_LIMIT_RPM", "0"))
+MODEL_RATE_LIMIT_BURST = int(os.getenv("MODEL_RATE_LIMIT_BURST", "5"))
+MODEL_MAX_CONCURRENCY = int(os.getenv("MODEL_MAX_CONCURRENCY", "32"))
+MODEL_MAX_RETRIES = int(os.getenv("MODEL_MAX_RETRIES", "4"))
+MODEL_BACKOFF_BASE = float(os.getenv("MODEL_BACKOFF_BASE", "0.5"))  # Seconds
+MODEL_BACKOFF_MAX = float(os.getenv("MODEL_BACKOFF_MAX", "20"))  # Seconds
+
+# Stream the NPC's dialogue to the websocket token by token (dialogue_delta frames).
+NPC_STREAMING = os.getenv("NPC_STREAMING", "1") == "1"
+
+# Constrain the NPC's replies to the NPCResponse JSON schema (response_format) and end
+# the turn on its reply instead of on "APPROVE".
+NPC_STRUCTURED_OUTPUT = os.getenv("NPC_STRUCTURED_OUTPUT", "1") == "1"
+
+# Send each turn's latency breakdown to the websocket as a 'trace' frame (debugging only).
+NPC_TRACE_DEBUG = os.getenv("NPC_TRACE_DEBUG", "0") == "1"
+
+# Pick obvious next speakers locally (core/router.py) instead of asking the model.
+ROUTER_ENABLED = os.getenv("ROUTER_ENABLED", "1") == "1"
+ROUTER_MIN_CONFIDENCE = float(os.getenv("ROUTER_MIN_CONFIDENCE", "0.6"))
+
+# Agent model context: "summary" keeps recent turns verbatim and folds older ones
+# into a rolling summary (core/context.py); "unbounded" keeps everything.
+CONTEXT_MODE = os.getenv("CONTEXT_MODE", "summary")
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))
+CONTEXT_RECENT_TURNS = int(os.getenv("CONTEXT_RECENT_TURNS", "6"))
+CONTEXT_SUMMARY_TOKENS = int(os.getenv("CONTEXT_SUMMARY_TOKENS", "400"))
+CONTEXT_SELECTOR_MESSAGES = int(os.getenv("CONTEXT_SELECTOR_MESSAGES", "12"))  # History shown to the LLM selector
+CONTEXT_SELECTOR_THREAD = int(os.getenv("CONTEXT_SELECTOR_THREAD", "40"))  # Group chat thread kept (and saved) by the team
+
+# Per-turn task prompt (core/prompts.py): scene, inventory and lookups are trimmed past this.
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "2500"))
+
+# Semantic cache of NPC replies in front of the team run (core/response_cache.py).
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "1") == "1"
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "5000"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "600"))  # Seconds
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.92"))  # Cosine similarity for a hit
+
+WORLD_STATE_PATH = "data/world_state.json"
+# World objects live in memory (core/world_state.py); changes are written back at most this often (seconds).
+WORLD_STATE_FLUSH_INTERVAL = float(os.getenv("WORLD_STATE_FLUSH_INTERVAL", "1.0"))
+# Recent world changes kept for sessions that missed some (seq gap) before a full resync is needed.
+WORLD_FEED_HISTORY = int(os.getenv("WORLD_FEED_HISTORY", "256"))
+
+# Designer edits to these are picked up while the server runs (core/watcher.py).
+ENVIRONMENT_DIR = Path("data/environment")
+FILE_WATCH = os.getenv("FILE_WATCH", "1") == "1"
+FILE_WATCH_DEBOUNCE_MS = int(os.getenv("FILE_WATCH_DEBOUNCE_MS", "300"))  # Changes within this window are reloaded together
+
+# Run story and environment lookups concurrently for questions that need both (core/fanout.py).
+FANOUT_ENABLED = os.getenv("FANOUT_ENABLED", "1") == "1"
+
+# Give the NPC the compact environment snapshot every turn (core/environment.py)
+# instead of a CodeAnalyzerAgent/get_environment_data round trip.
+ENV_SNAPSHOT_IN_PROMPT = os.getenv("ENV_SNAPSHOT_IN_PROMPT", "1") == "1"
+
+# Session records: "memory" for a single worker, "sqlite" to share them between workers.
+SESSION_STORE = os.getenv("SESSION_STORE", "memory")
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "state/sessions.sqlite3")
+SESSION_MAX_RESIDENT = int(os.getenv("SESSION_MAX_RESIDENT", "200"))  # Loaded teams per worker
+SESSION_UNCONNECTED_TTL = float(os.getenv("SESSION_UNCONNECTED_TTL", "300"))  # Seconds
+SESSION_IDLE_TIMEOUT = float(os.getenv("SESSION_IDLE_TIMEOUT", "900"))  # Seconds
+SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", "30"))  # Seconds
+# Returning NPCs: /initialize only stores the record; the team is built in the background
+# (single-worker store only), and the most popular personas keep a prebuilt team ready.
+SESSION_PREBUILD = os.getenv("SESSION_PREBUILD", "1") == "1"
+SESSION_WARM_TEMPLATES = int(os.getenv("SESSION_WARM_TEMPLATES", "8"))  # Personas kept prebuilt
+SESSION_WARM_WINDOW = float(os.getenv("SESSION_WARM_WINDOW", "3600"))  # Seconds of /initialize history ranked
+SESSION_WARM_MIN_SESSIONS = int(os.getenv("SESSION_WARM_MIN_SESSIONS", "2"))  # Sessions in the window to count as popular
+PERSONA_DB_PATH = os.getenv("PERSONA_DB_PATH", "state/personas.sqlite3")
+
+# Content-addressed player uploads (see core/uploads.py)
+UPLOAD_DIR = Path("data/uploads")
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024  # 10 MB file size limit
+
+# Scene images are fitted into this many pixels per side and re-encoded before the vision call (core/vision.py).
+VISION_MAX_SIZE = int(os.getenv("VISION_MAX_SIZE", "1024"))
+VISION_JPEG_QUALITY = int(os.getenv("VISION_JPEG_QUALITY", "85"))
+VISION_CACHE_ENTRIES = int(os.getenv("VISION_CACHE_ENTRIES", "256"))  # Descriptions kept by image hash
+UPLOAD_ORPHAN_TTL = float(os.getenv("UPLOAD_ORPHAN_TTL", "86400"))  # Seconds an unreferenced file is kept
+
 
 def get_api_key() -> str:
     api_key = os.getenv("OPEN_ROUTER_API_KEY")
@@ -20,11 +114,17 @@ def get_api_key() -> str:
     return api_key
 
 
-def get_model_client(api_key: str) -> OpenAIChatCompletionClient:
+def get_model_client(
+    api_key: str, http_client: httpx.AsyncClient | None = None, max_retries: int | None = None
+) -> OpenAIChatCompletionClient:
+    extra_kwargs = {"http_client": http_client} if http_client is not None else {}
+    if max_retries is not None:
+        extra_kwargs["max_retries"] = max_retries
     return OpenAIChatCompletionClient(
-        base_url="https://openrouter.ai/api/v1",
-        model="meta-llama/llama-4-maverick:free",
+        base_url=MODEL_BASE_URL,
+        model=MODEL_NAME,
         api_key=api_key,
+        **extra_kwargs,
         model_info={
             "family": "meta-llama",
             "vision": True,
@@ -43,6 +143,13 @@ class NPCResponse(BaseModel):
     action: str
     animation: str
 
+# Non-strict json_schema response format: unlike json_output=NPCResponse it can be
+# combined with the NPC's (non-strict) tools, and parsing stays with core/npc_response.py.
+NPC_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "NPCResponse", "schema": NPCResponse.model_json_schema()},
+}
+
 # ADD THIS FUNCTION
 def get_valid_moods() -> list[str]:
     """Extracts the list of valid moods from the NPCResponse model."""
@@ -56,14 +163,3 @@ def get_npc_config_from_user() -> dict:
         "background": input("Enter NPC background: "),
         "behavior": input("Enter NPC behavior: "),
     }
-
-
-def load_prompt(filename: str, **kwargs) -> str:
-    try:
-        with open(PROMPT_DIR / filename, "r") as f:
-            prompt = f.read()
-        return prompt.format(**kwargs)
-    except FileNotFoundError:
-        raise FileNotFoundError(f"Prompt file not found: {filename}")
-    except KeyError as e:
-        raise KeyError(f"Missing placeholder in prompt {filename}: {e}")
\ No newline at end of file
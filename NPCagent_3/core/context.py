@@ -0,0 +1,194 @@
+# core/context.py
+import asyncio
+from typing import Any, Awaitable, Callable, List, Mapping
+
+from autogen_core.model_context import (
+    ChatCompletionContext,
+    ChatCompletionContextState,
+    UnboundedChatCompletionContext,
+)
+from autogen_core.models import (
+    AssistantMessage,
+    ChatCompletionClient,
+    FunctionExecutionResultMessage,
+    LLMMessage,
+    SystemMessage,
+    UserMessage,
+)
+
+from core import config
+from core.prompts import count_tokens, load_prompt
+
+SUMMARY_PREFIX = "Summary of your earlier conversation with the player:\n"
+
+# Returns text shown to the agent as a system message on every call without being stored in its history.
+PinnedProvider = Callable[[], Awaitable[str | None]]
+
+
+def _message_text(message: LLMMessage) -> str:
+    content = message.content
+    if isinstance(content, str):
+        return content
+    if isinstance(message, FunctionExecutionResultMessage):
+        return "\n".join(result.content for result in content)
+    if isinstance(message, AssistantMessage):
+        return "\n".join(f"{call.name}({call.arguments})" for call in content)
+    # Multimodal user content: count the text parts only.
+    return " ".join(part for part in content if isinstance(part, str))
+
+
+def message_tokens(message: LLMMessage) -> int:
+    return count_tokens(_message_text(message)) + 4  # Per-message framing overhead
+
+
+async def _with_pinned(pinned: PinnedProvider | None, messages: List[LLMMessage]) -> List[LLMMessage]:
+    text = await pinned() if pinned else None
+    return [SystemMessage(content=text), *messages] if text else messages
+
+
+class PinnedChatCompletionContext(UnboundedChatCompletionContext):
+    """Unbounded context that also shows pinned, always-current text (e.g. the environment snapshot)."""
+
+    def __init__(self, pinned: PinnedProvider, initial_messages: List[LLMMessage] | None = None):
+        super().__init__(initial_messages)
+        self._pinned = pinned
+
+    async def get_messages(self) -> List[LLMMessage]:
+        return await _with_pinned(self._pinned, await super().get_messages())
+
+
+def _transcript_line(message: LLMMessage, limit: int = 600) -> str:
+    text = " ".join(_message_text(message).split())[:limit]
+    if isinstance(message, FunctionExecutionResultMessage):
+        return f"(tool result) {text}"
+    if isinstance(message, AssistantMessage) and not isinstance(message.content, str):
+        return f"{message.source} used tools: {text}"
+    return f"{getattr(message, 'source', 'system')}: {text}"
+
+
+class SummarizingChatCompletionContext(ChatCompletionContext):
+    """
+    Token-budgeted model context for long-lived NPCs.
+
+    The agent sees a rolling summary plus the last `recent_turns` player turns
+    verbatim, trimmed further if they exceed `token_budget`. Older turns are
+    folded into the summary by a background task, so no turn waits on the
+    summarizer. The summary is saved with the rest of the agent's state.
+    """
+
+    def __init__(
+        self,
+        summarizer: ChatCompletionClient | None = None,
+        token_budget: int = config.CONTEXT_TOKEN_BUDGET,
+        recent_turns: int = config.CONTEXT_RECENT_TURNS,
+        summary_tokens: int = config.CONTEXT_SUMMARY_TOKENS,
+        pinned: PinnedProvider | None = None,
+        initial_messages: List[LLMMessage] | None = None,
+    ):
+        super().__init__(initial_messages)
+        self._tokens = [message_tokens(m) for m in self._messages]
+        self._summarizer = summarizer
+        self._token_budget = token_budget
+        self._recent_turns = recent_turns
+        self._summary_tokens = summary_tokens
+        self._pinned = pinned
+        self._summary = ""
+        self._fold_task: asyncio.Task | None = None
+        # Bumped by clear()/load_state() so a running fold never trims messages it did not read.
+        self._generation = 0
+
+    @property
+    def summary(self) -> str:
+        return self._summary
+
+    def _turn_starts(self) -> list[int]:
+        # A turn starts with the player's message; starting there never splits a tool call from its result.
+        return [i for i, m in enumerate(self._messages) if isinstance(m, UserMessage) and m.source == "user"]
+
+    def _window_start(self) -> int:
+        starts = self._turn_starts()
+        if not starts:
+            return 0
+        candidates = starts[-self._recent_turns:]
+        budget = self._token_budget - count_tokens(self._summary)
+        for start in candidates[:-1]:
+            if sum(self._tokens[start:]) <= budget:
+                return start
+        # Even the latest turn alone is over budget: keep it anyway.
+        return candidates[-1]
+
+    async def add_message(self, message: LLMMessage) -> None:
+        self._messages.append(message)
+        self._tokens.append(message_tokens(message))
+
+    async def get_messages(self) -> List[LLMMessage]:
+        start = self._window_start()
+        if start > 0 and (self._fold_task is None or self._fold_task.done()):
+            self._fold_task = asyncio.create_task(self._fold(start, self._generation))
+        messages = list(self._messages[start:])
+        if self._summary:
+            messages.insert(0, SystemMessage(content=SUMMARY_PREFIX + self._summary))
+        return await _with_pinned(self._pinned, messages)
+
+    async def _fold(self, count: int, generation: int) -> None:
+        """Merges the first `count` messages into the summary, in chunks that fit the budget."""
+        pending = list(self._messages[:count])
+        summary = self._summary
+        chunk: list[LLMMessage] = []
+        chunk_tokens = 0
+        try:
+            for message, tokens in zip(pending, self._tokens[:count]):
+                chunk.append(message)
+                chunk_tokens += tokens
+                if chunk_tokens >= self._token_budget:
+                    summary = await self._summarize(summary, chunk)
+                    chunk, chunk_tokens = [], 0
+            if chunk:
+                summary = await self._summarize(summary, chunk)
+        except asyncio.CancelledError:
+            return
+        if generation != self._generation:
+            return
+        self._summary = summary
+        self._messages = self._messages[count:]
+        self._tokens = self._tokens[count:]
+
+    async def _summarize(self, previous: str, messages: list[LLMMessage]) -> str:
+        transcript = "\n".join(_transcript_line(m) for m in messages if not isinstance(m, SystemMessage))
+        if self._summarizer is not None:
+            try:
+                result = await self._summarizer.create([
+                    SystemMessage(content=load_prompt("summary_system_message.txt", max_words=int(self._summary_tokens * 0.7))),
+                    UserMessage(
+                        content=f"Current summary:\n{previous or '(none)'}\n\nNew conversation:\n{transcript}",
+                        source="user",
+                    ),
+                ])
+                if isinstance(result.content, str) and result.content.strip():
+                    return self._trim(result.content.strip())
+            except Exception as e:
+                print(f"⚠️ Summarizer failed, keeping an extractive summary instead: {e}")
+        return self._trim(f"{previous}\n{transcript}".strip())
+
+    def _trim(self, text: str) -> str:
+        """Keeps the most recent part of a summary that is over its token allowance."""
+        while count_tokens(text) > self._summary_tokens and len(text) > 1:
+            text = text[len(text) // 10 or 1:]
+        return text
+
+    async def clear(self) -> None:
+        self._generation += 1
+        self._messages = []
+        self._tokens = []
+        self._summary = ""
+
+    async def save_state(self) -> Mapping[str, Any]:
+        state = ChatCompletionContextState(messages=self._messages).model_dump()
+        state["summary"] = self._summary
+        return state
+
+    async def load_state(self, state: Mapping[str, Any]) -> None:
+        self._generation += 1
+        self._messages = ChatCompletionContextState.model_validate(state).messages
+        self._tokens = [message_tokens(m) for m in self._messages]
+        self._summary = state.get("summary", "")
@@ -0,0 +1,429 @@
+# core/csharp_parser.py
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from typing import NamedTuple
+
+# The subset of C# environment scripts use: namespaces, (nested) classes,
+# field initializers with literals, tuples, Dictionary/List/array collection
+# initializers, `new X { A = ... }` object initializers and vectors. Methods
+# and properties are skipped; expressions that are not plain data are kept as
+# their source text.
+
+_TOKEN_RE = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<name>@?[A-Za-z_]\w*)
+  | (?P<comment>//[^\n]*|/\*.*?\*/|\#[^\n]*)
+  | (?P<string>\$?@"(?:[^"]|"")*"|@\$"(?:[^"]|"")*"|\$?"(?:[^"\\\n]|\\.)*")
+  | (?P<char>'(?:[^'\\\n]|\\.)+')
+  | (?P<number>0[xX][0-9a-fA-F_]+[uUlL]*|(?:\d[\d_]*\.?[\d_]*|\.\d[\d_]*)(?:[eE][+-]?\d+)?[fFdDmMuUlL]*)
+  | (?P<op>=>|\?\?|.)
+""", re.VERBOSE | re.DOTALL)
+
+_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "0": "\0", "a": "\a", "b": "\b", "f": "\f", "v": "\v"}
+_ESCAPE_RE = re.compile(r"\\(u[0-9a-fA-F]{4}|x[0-9a-fA-F]{1,4}|.)", re.DOTALL)
+
+# Constructor arguments of these types become named fields.
+_VECTOR_FIELDS = {
+    "Vector2": ("x", "y"), "Vector3": ("x", "y", "z"), "Vector4": ("x", "y", "z", "w"),
+    "Vector2Int": ("x", "y"), "Vector3Int": ("x", "y", "z"), "Quaternion": ("x", "y", "z", "w"),
+    "Color": ("r", "g", "b", "a"), "Color32": ("r", "g", "b", "a"),
+}
+_DICTIONARY_TYPES = {"Dictionary", "SortedDictionary", "ConcurrentDictionary", "IDictionary", "IReadOnlyDictionary", "Hashtable"}
+_LIST_TYPES = {"List", "HashSet", "SortedSet", "Queue", "Stack", "LinkedList", "IList", "IEnumerable", "ICollection", "IReadOnlyList"}
+_TYPE_KEYWORDS = {"class", "struct", "record", "interface"}
+_STOPS = (",", ";", "}", ")", "]")
+_CLOSING = {"(": ")", "{": "}", "[": "]"}
+
+
+class Token(NamedTuple):
+    kind: str
+    text: str
+    start: int
+    end: int
+
+
+class _Unparsed(Exception):
+    """The expression is not plain data; the caller keeps its source text."""
+
+
+def tokenize(source: str) -> list[Token]:
+    tokens = []
+    append = tokens.append
+    for match in _TOKEN_RE.finditer(source):
+        kind = match.lastgroup
+        if kind != "space" and kind != "comment":
+            append(Token(kind, match.group(), *match.span()))
+    return tokens
+
+
+def _unescape(match: re.Match) -> str:
+    code = match.group(1)
+    if code[0] in "ux" and len(code) > 1:
+        return chr(int(code[1:], 16))
+    return _ESCAPES.get(code, code)
+
+
+def _string_value(text: str) -> str:
+    prefix = text[:text.index('"')]
+    body = text[len(prefix) + 1:-1]
+    if "@" in prefix:
+        return body.replace('""', '"')
+    return _ESCAPE_RE.sub(_unescape, body)
+
+
+def _number_value(text: str) -> int | float:
+    text = text.replace("_", "")
+    if text[:2] in ("0x", "0X"):
+        return int(text.rstrip("uUlL"), 16)
+    digits = text.rstrip("fFdDmMuUlL")
+    if digits != text.rstrip("uUlL") or any(c in digits for c in ".eE"):
+        return float(digits)
+    return int(digits)
+
+
+class _Parser:
+    def __init__(self, source: str):
+        self.source = source
+        self.tokens = tokenize(source)
+        self.pos = 0
+
+    def peek(self, offset: int = 0) -> str:
+        index = self.pos + offset
+        return self.tokens[index].text if index < len(self.tokens) else ""
+
+    def kind(self, offset: int = 0) -> str:
+        index = self.pos + offset
+        return self.tokens[index].kind if index < len(self.tokens) else ""
+
+    def take(self) -> str:
+        text = self.peek()
+        self.pos += 1
+        return text
+
+    def expect(self, text: str) -> None:
+        if self.peek() == text:
+            self.pos += 1
+
+    def source_between(self, start: int, end: int) -> str:
+        if start >= end:
+            return ""
+        return self.source[self.tokens[start].start:self.tokens[end - 1].end]
+
+    def skip_balanced(self) -> None:
+        """Skips from an opening bracket to just past its match."""
+        opener = self.take()
+        closer = ">" if opener == "<" else _CLOSING[opener]
+        depth = 1
+        while depth and self.pos < len(self.tokens):
+            text = self.take()
+            if text == opener:
+                depth += 1
+            elif text == closer:
+                depth -= 1
+
+    def skip_expression(self, stops=_STOPS) -> None:
+        while self.pos < len(self.tokens) and self.peek() not in stops:
+            if self.peek() in _CLOSING:
+                self.skip_balanced()
+            else:
+                self.pos += 1
+
+    # --- Declarations ---
+
+    def parse_block(self, body: dict) -> None:
+        while self.pos < len(self.tokens) and self.peek() != "}":
+            start = self.pos
+            self.parse_member(body)
+            if self.pos == start:
+                self.pos += 1  # Never stall on something unexpected
+
+    def parse_type_body(self, body: dict, name: str) -> None:
+        # Header: generic parameters, base list, constraints; a positional record may end with ';'.
+        while self.pos < len(self.tokens) and self.peek() not in ("{", ";"):
+            if self.peek() in ("(", "<", "["):
+                self.skip_balanced()
+            else:
+                self.pos += 1
+        if self.take() != "{":
+            return
+        members: dict = {}
+        self.parse_block(members)
+        self.expect("}")
+        if members:
+            # Partial classes: members from every part end up together.
+            body.setdefault(name, {}).update(members)
+
+    def parse_member(self, body: dict) -> None:
+        text = self.peek()
+        if text in (";", "]", ")"):
+            self.pos += 1
+            return
+        if text == "[":  # Attribute
+            self.skip_balanced()
+            return
+        if text in ("using", "delegate", "event"):
+            self.skip_expression((";",))
+            self.expect(";")
+            return
+        if text == "namespace":
+            self.skip_expression((";", "{"))
+            if self.take() == "{":
+                self.parse_block(body)
+                self.expect("}")
+            return
+        header = []
+        while self.pos < len(self.tokens):
+            text = self.peek()
+            if text in _TYPE_KEYWORDS:
+                self.pos += 1
+                self.parse_type_body(body, self.take())
+                return
+            if text == "enum":
+                self.skip_expression((";", "{"))
+                if self.peek() == "{":
+                    self.skip_balanced()
+                return
+            if text == "operator":
+                self.skip_expression((";", "("))
+                break
+            if text in ("=", ";", "{", "(", "=>", "}"):
+                break
+            if text in ("<", "["):
+                self.skip_balanced()
+                continue
+            header.append(self.take())
+        text = self.peek()
+        if text == "(":  # Method or constructor
+            self.skip_balanced()
+            while self.pos < len(self.tokens) and self.peek() not in ("{", ";", "=>"):
+                if self.peek() == "(":
+                    self.skip_balanced()
+                else:
+                    self.pos += 1
+            self.skip_body()
+        elif text == "{":  # Property; its default value is not world data
+            self.skip_balanced()
+            if self.peek() == "=":
+                self.skip_expression((";",))
+            self.expect(";")
+        elif text == "=>":
+            self.skip_body()
+        elif text == "=" and header:
+            self.parse_declarators(body, header[-1])
+        elif text == ";":
+            self.pos += 1
+
+    def skip_body(self) -> None:
+        if self.peek() == "{":
+            self.skip_balanced()
+        else:
+            self.skip_expression((";",))
+            self.expect(";")
+
+    def parse_declarators(self, body: dict, name: str) -> None:
+        # `int a = 1, b = 2;`
+        while self.peek() == "=":
+            self.pos += 1
+            body[name.lstrip("@")] = self.parse_value()
+            if self.peek() != ",":
+                break
+            self.pos += 1
+            name = self.take()
+        self.skip_expression((";", "}"))
+        self.expect(";")
+
+    # --- Values ---
+
+    def parse_value(self, stops=_STOPS):
+        start = self.pos
+        try:
+            value = self.value()
+            if self.peek() in stops or self.pos >= len(self.tokens):
+                return value
+        except (_Unparsed, IndexError, ValueError):
+            pass
+        self.pos = start
+        self.skip_expression(stops)
+        return self.source_between(start, self.pos)
+
+    def value(self):
+        kind, text = self.kind(), self.peek()
+        if kind == "string":
+            self.pos += 1
+            return _string_value(text)
+        if kind == "char":
+            self.pos += 1
+            return _ESCAPE_RE.sub(_unescape, text[1:-1])
+        if kind == "number":
+            self.pos += 1
+            return _number_value(text)
+        if text in ("-", "+") and self.kind(1) == "number":
+            self.pos += 2
+            number = _number_value(self.tokens[self.pos - 1].text)
+            return -number if text == "-" else number
+        if text in ("true", "false"):
+            self.pos += 1
+            return text == "true"
+        if text == "null":
+            self.pos += 1
+            return None
+        if text == "(":
+            return self.tuple_value()
+        if text == "{":  # Array initializer: `int[] a = { 1, 2 };`
+            return self.initializer(list_like=True, dict_like=False)
+        if text == "new":
+            return self.new_value()
+        if kind == "name":
+            # Enum members and constants keep their name: `Weather.Sunny`.
+            parts = [self.take()]
+            while self.peek() == "." and self.kind(1) == "name":
+                self.pos += 1
+                parts.append(self.take())
+            if self.peek() in ("(", "<", "["):
+                raise _Unparsed()
+            return ".".join(parts)
+        raise _Unparsed()
+
+    def tuple_value(self):
+        self.pos += 1
+        items = []
+        while self.peek() not in (")", ""):
+            if self.kind() == "name" and self.peek(1) == ":":
+                self.pos += 2  # Named element: `(x: 1, y: 2)`
+            items.append(self.parse_value((",", ")")))
+            self.expect(",")
+        self.expect(")")
+        return items[0] if len(items) == 1 else items
+
+    def new_value(self):
+        self.pos += 1
+        type_name, is_array = "", False
+        while self.peek() not in ("(", "{", "") and self.peek() not in _STOPS:
+            if self.peek() == "<":
+                self.skip_balanced()
+            elif self.peek() == "[":
+                is_array = True
+                self.skip_balanced()
+            elif self.kind() == "name":
+                type_name = self.take()  # Last segment of `System.Collections.Generic.List`
+            else:
+                self.pos += 1
+        args = []
+        if self.peek() == "(":
+            self.pos += 1
+            while self.peek() not in (")", ""):
+                args.append(self.parse_value((",", ")")))
+                self.expect(",")
+            self.expect(")")
+        dict_like = type_name in _DICTIONARY_TYPES
+        list_like = is_array or type_name in _LIST_TYPES or not type_name
+        if self.peek() == "{":
+            return self.initializer(list_like, dict_like)
+        if type_name in _VECTOR_FIELDS:
+            return dict(zip(_VECTOR_FIELDS[type_name], args))
+        if dict_like:
+            return {}
+        if list_like:
+            return []
+        return args or {}
+
+    def initializer(self, list_like: bool, dict_like: bool):
+        self.pos += 1
+        if self.peek() == "}":
+            self.pos += 1
+            return {} if dict_like or not list_like else []
+        if not list_like and not dict_like and self.kind() == "name" and self.peek(1) == "=":
+            result = self.object_initializer()
+        elif self.peek() == "[":
+            result = self.index_initializer()
+        elif self.peek() == "{" and not list_like:
+            result = self.pair_initializer()
+        else:
+            result = []
+            while self.peek() not in ("}", ""):
+                result.append(self.parse_value((",", "}")))
+                self.expect(",")
+        self.expect("}")
+        return result
+
+    def object_initializer(self) -> dict:
+        # `new StoreObject { Name = "Door", Contents = { "a" } }`
+        result = {}
+        while self.kind() == "name" and self.peek(1) == "=":
+            name = self.take().lstrip("@")
+            self.pos += 1
+            result[name] = self.parse_value((",", "}"))
+            self.expect(",")
+        return result
+
+    def index_initializer(self) -> dict:
+        # `new Dictionary<string, int> { ["a"] = 1 }`
+        result = {}
+        while self.peek() == "[":
+            self.pos += 1
+            key = self.parse_value(("]",))
+            self.expect("]")
+            self.expect("=")
+            result[key if isinstance(key, str) else str(key)] = self.parse_value((",", "}"))
+            self.expect(",")
+        return result
+
+    def pair_initializer(self) -> dict:
+        # `new Dictionary<string, string> { {"a", "b"}, ... }`
+        result = {}
+        while self.peek() == "{":
+            self.pos += 1
+            key = self.parse_value((",", "}"))
+            self.expect(",")
+            value = self.parse_value((",", "}"))
+            self.skip_expression(("}",))
+            self.expect("}")
+            self.expect(",")
+            result[key if isinstance(key, str) else str(key)] = value
+        return result
+
+
+def parse_csharp(source: str) -> dict:
+    """
+    Static data of a C# environment script as {class name: {field: value}}.
+    Namespaces are flattened; nested classes become nested dicts; classes
+    without initialized fields are left out.
+    """
+    parser = _Parser(source)
+    data: dict = {}
+    while parser.pos < len(parser.tokens):
+        parser.parse_block(data)
+        parser.expect("}")  # Stray closing brace at top level
+    return data
+
+
+_parsed: OrderedDict[str, dict] = OrderedDict()
+_parsed_lock = threading.Lock()
+PARSE_CACHE_ENTRIES = 64
+
+
+def parse_csharp_file(path: str, digest: str | None = None) -> dict:
+    """
+    parse_csharp() of a file, memoized by content hash: a given file content
+    is parsed once per process. Pass the file's sha256 `digest` if already
+    known to skip reading the file on a hit. The result is shared; do not modify it.
+    """
+    if digest is not None:
+        with _parsed_lock:
+            if digest in _parsed:
+                _parsed.move_to_end(digest)
+                return _parsed[digest]
+    with open(path, "rb") as f:
+        raw = f.read()
+    digest = hashlib.sha256(raw).hexdigest() if digest is None else digest
+    with _parsed_lock:
+        cached = _parsed.get(digest)
+    if cached is None:
+        cached = parse_csharp(raw.decode("utf-8-sig"))
+        with _parsed_lock:
+            _parsed[digest] = cached
+            while len(_parsed) > PARSE_CACHE_ENTRIES:
+                _parsed.popitem(last=False)
+    return cached
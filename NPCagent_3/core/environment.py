@@ -0,0 +1,205 @@
+# core/environment.py
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from core.csharp_parser import parse_csharp_file
+from core.world_state import get_world_state, object_key
+
+SNAPSHOT_HEADER = (
+    "Game World Snapshot (current; objects come from the live world state, "
+    "layout and characters from the C# file):\n"
+)
+# Decision-framework line for turn prompts when the NPC has the snapshot.
+SNAPSHOT_RULE = (
+    "   - **The Game World Snapshot in your context is always current:** answer layout, item and object "
+    "questions from it directly; only lore needs `StoryAgent`.\n"
+)
+
+_digests: dict[str, tuple[tuple[int, int], str]] = {}
+_digests_lock = threading.Lock()
+# Directories core/watcher.py watches: their files' digests are only recomputed on a change event.
+_watched_dirs: set[str] = set()
+
+
+def world_version() -> str:
+    """Changes whenever a world object does (core/world_state.py)."""
+    return f"v{get_world_state().version}"
+
+
+def watch_directory(path: str, watched: bool = True) -> None:
+    if watched:
+        _watched_dirs.add(os.path.abspath(path))
+    else:
+        _watched_dirs.discard(os.path.abspath(path))
+
+
+def file_digest(path: str) -> str:
+    """
+    sha256 of a file, recomputed only when its mtime or size changes. Files
+    in a watched directory are not even stat'ed; refresh_file() updates them.
+    """
+    path = os.path.abspath(path)
+    with _digests_lock:
+        cached = _digests.get(path)
+    if cached and os.path.dirname(path) in _watched_dirs:
+        return cached[1]
+    stat = os.stat(path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    if cached and cached[0] == signature:
+        return cached[1]
+    with open(path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    with _digests_lock:
+        _digests[path] = (signature, digest)
+    return digest
+
+
+def refresh_file(path: str) -> str | None:
+    """
+    Re-reads a file that changed on disk: new digest and, for C# scripts, the
+    parse, so the next snapshot swaps over without any work in the turn.
+    Returns None if the file is gone. Blocking; run it in a worker thread.
+    """
+    path = os.path.abspath(path)
+    with _digests_lock:
+        _digests.pop(path, None)
+    try:
+        digest = file_digest(path)
+    except FileNotFoundError:
+        return None
+    if path.endswith(".cs"):
+        parse_csharp_file(path, digest)
+    return digest
+
+
+def environment_sections(tree: dict) -> dict:
+    """
+    Splits a parsed C# environment (core/csharp_parser.py) into snapshot
+    sections. Objects are left out: they come from the world state.
+    """
+    layout = tree.get("StoreLayout", {})
+    data = {
+        "gameState": tree.get("GameState", {}),
+        "storeLayout": {"locations": layout.get("Locations", {}), "aisleContents": layout.get("AisleContents", {})},
+        "characters": [],
+        "environment": {},
+    }
+    for class_name, members in tree.items():
+        if class_name in ("GameState", "Objects"):
+            continue
+        rest = {}
+        for name, value in members.items():
+            if (class_name == "StoreLayout" and name in ("Locations", "AisleContents")) or name == "Objects":
+                continue
+            if (class_name == "Characters" or name == "Characters") and isinstance(value, list):
+                data["characters"].extend(value)
+            else:
+                rest[name] = value
+        if rest:
+            data["environment"][class_name] = rest
+    return data
+
+
+class EnvironmentSnapshots:
+    """
+    Compact environment JSON per (C# file hash, world state version).
+
+    The snapshot only changes when the C# file or a world object does, so it
+    is built once per version and then served from memory: to the NPC's
+    context on every turn and to the get_environment_data tool. World objects
+    are kept up to date by applying the store's change log, not by copying
+    the whole store again after every change.
+    """
+
+    def __init__(self, max_entries: int = 64):
+        self.max_entries = max_entries
+        self._snapshots: OrderedDict[tuple, str] = OrderedDict()
+        self._lock = threading.Lock()
+        self._world_seq = 0
+        self._world_objects: dict[str, dict] | None = None
+
+    def _remember(self, cache: OrderedDict, key, value) -> None:
+        with self._lock:
+            cache[key] = value
+            while len(cache) > self.max_entries:
+                cache.popitem(last=False)
+
+    def _static_data(self, csharp_path: str | None, digest: str) -> dict:
+        tree = parse_csharp_file(csharp_path, digest) if digest else {}
+        return environment_sections(tree)
+
+    def _world(self) -> tuple[int, list[dict]]:
+        store = get_world_state()
+        with self._lock:
+            if self._world_objects is None or self._world_seq != store.version:
+                changes = store.changes_since(self._world_seq) if self._world_objects is not None else None
+                if changes is None:
+                    self._world_seq, objects = store.snapshot()
+                    self._world_objects = {object_key(obj["Name"]): obj for obj in objects}
+                elif changes:
+                    for change in changes:
+                        self._world_objects[object_key(change.object["Name"])] = change.object
+                    self._world_seq = changes[-1].seq
+            return self._world_seq, list(self._world_objects.values())
+
+    def _build(self, csharp_path: str | None, digest: str, objects: list[dict]) -> str:
+        static = self._static_data(csharp_path, digest)
+        data = {
+            "gameState": static["gameState"],
+            "storeLayout": static["storeLayout"],
+            "objects": objects,
+            "characters": static["characters"],
+        }
+        if static["environment"]:
+            data["environment"] = static["environment"]
+        return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+
+    def _get(self, csharp_path: str | None) -> tuple[str, str]:
+        try:
+            digest = file_digest(csharp_path) if csharp_path else ""
+        except FileNotFoundError:
+            digest = ""
+        key = (digest, world_version())
+        snapshot = self._snapshots.get(key)
+        if snapshot is None:
+            version, objects = self._world()
+            key = (digest, f"v{version}")
+            snapshot = self._build(csharp_path, digest, objects)
+            self._remember(self._snapshots, key, snapshot)
+        else:
+            with self._lock:
+                if key in self._snapshots:
+                    self._snapshots.move_to_end(key)
+        return f"{digest[:12] or 'none'}@{key[1]}", snapshot
+
+    async def get(self, csharp_path: str | None) -> tuple[str, str]:
+        """Returns (version, compact JSON). C# file access happens off the event loop."""
+        return await asyncio.to_thread(self._get, csharp_path)
+
+
+_SNAPSHOTS: EnvironmentSnapshots | None = None
+
+
+def get_environment_snapshots() -> EnvironmentSnapshots:
+    global _SNAPSHOTS
+    if _SNAPSHOTS is None:
+        _SNAPSHOTS = EnvironmentSnapshots()
+    return _SNAPSHOTS
+
+
+def snapshot_provider(csharp_path: str | None):
+    """Async callable for a model context: the current snapshot as prompt text, or None."""
+
+    async def provide() -> str | None:
+        try:
+            _, snapshot = await get_environment_snapshots().get(csharp_path)
+        except Exception as e:
+            print(f"⚠️ Could not build environment snapshot: {e}")
+            return None
+        return SNAPSHOT_HEADER + snapshot
+
+    return provide
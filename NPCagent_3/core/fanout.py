@@ -0,0 +1,42 @@
+# core/fanout.py
+import asyncio
+
+from autogen_core import CancellationToken
+
+from core.tracing import traced
+
+# Marks a task whose specialist data was already gathered; the router sends it straight to the NPC.
+FANOUT_MARKER = "--- SPECIALIST DATA ---"
+
+LOOKUP_TOOLS = {"story": "rag_tool", "world": "get_environment_data"}
+LOOKUP_LABELS = {
+    "story": "Story knowledge (from rag_tool)",
+    "world": "Game world data (from get_environment_data)",
+}
+
+
+async def gather_specialist_data(all_tools: list, lookups, query: str) -> str:
+    """
+    Runs the story and environment lookups concurrently instead of as two
+    selector-chosen agent hops, and returns the results as a prompt section.
+    """
+    tools_by_name = {tool.name: tool for tool in all_tools}
+
+    async def run(category: str) -> tuple[str, str]:
+        tool = tools_by_name[LOOKUP_TOOLS[category]]
+        args = {"query": query} if category == "story" else {"llm_provided_path": ""}
+        try:
+            result = await tool.run_json(args, CancellationToken())
+            return category, tool.return_value_as_string(result)
+        except Exception as e:
+            print(f"⚠️ Fan-out lookup '{tool.name}' failed: {e}")
+            return category, f"Error: {e}"
+
+    categories = [c for c in lookups if LOOKUP_TOOLS.get(c) in tools_by_name]
+    with traced("fanout", "+".join(categories)):
+        results = await asyncio.gather(*(run(c) for c in categories))
+
+    sections = [FANOUT_MARKER]
+    sections += [f"{LOOKUP_LABELS[category]}:\n{text}" for category, text in results]
+    sections.append("This data has already been gathered for you. Answer directly as the NPC; do not ask specialist agents again.")
+    return "\n\n".join(sections)
@@ -1,36 +1,111 @@
 import os
+import threading
 
 import aiofiles
+import chromadb
 from autogen_core.memory import ListMemory, MemoryContent, MemoryMimeType
 from autogen_ext.memory.chromadb import (
     ChromaDBVectorMemory,
     PersistentChromaDBVectorMemoryConfig,
     SentenceTransformerEmbeddingFunctionConfig,
 )
+from chromadb.config import Settings
+from chromadb.utils.embedding_functions import SentenceTransformerEmbeddingFunction
 from pypdf import PdfReader
 
+RAG_COLLECTION_NAME = "npc_story"
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+
+# Process-wide singletons shared by every session's RAG view.
+_EMBEDDING_FUNCTION = None
+_CHROMA_CLIENT = None
+_RAG_COLLECTION = None
+_SHARED_LOCK = threading.Lock()
+
+
+def get_embedding_function() -> SentenceTransformerEmbeddingFunction:
+    """Loads the sentence-transformer model once per process."""
+    global _EMBEDDING_FUNCTION
+    with _SHARED_LOCK:
+        if _EMBEDDING_FUNCTION is None:
+            _EMBEDDING_FUNCTION = SentenceTransformerEmbeddingFunction(
+                model_name=EMBEDDING_MODEL_NAME
+            )
+        return _EMBEDDING_FUNCTION
+
+
+def get_rag_collection():
+    """Opens the persistent Chroma client and story collection once per process."""
+    global _CHROMA_CLIENT, _RAG_COLLECTION
+    embedding_function = get_embedding_function()
+    with _SHARED_LOCK:
+        if _CHROMA_CLIENT is None:
+            _CHROMA_CLIENT = chromadb.PersistentClient(
+                path=os.path.join(os.getcwd(), "memory"),
+                settings=Settings(allow_reset=False),
+            )
+        if _RAG_COLLECTION is None:
+            _RAG_COLLECTION = _CHROMA_CLIENT.get_or_create_collection(
+                name=RAG_COLLECTION_NAME,
+                metadata={"distance_metric": "cosine"},
+                embedding_function=embedding_function,
+            )
+        return _RAG_COLLECTION
+
+
+class SharedChromaDBVectorMemory(ChromaDBVectorMemory):
+    """
+    A lightweight per-session view over the shared story collection.
+
+    The Chroma client and embedding model are owned by the process, so creating
+    and closing a view is free. If `sources` is given, queries only return
+    chunks indexed from those files.
+    """
+
+    def __init__(self, config: PersistentChromaDBVectorMemoryConfig, sources: list[str] | None = None):
+        super().__init__(config=config)
+        self._sources = [s for s in (sources or []) if s]
+
+    def _ensure_initialized(self) -> None:
+        if self._collection is None:
+            self._collection = get_rag_collection()
+
+    async def query(self, query, cancellation_token=None, **kwargs):
+        if self._sources and "where" not in kwargs:
+            if len(self._sources) == 1:
+                kwargs["where"] = {"source": self._sources[0]}
+            else:
+                kwargs["where"] = {"source": {"$in": self._sources}}
+        return await super().query(query, cancellation_token, **kwargs)
+
+    async def close(self) -> None:
+        # Only drop this view's reference; the shared client stays open.
+        self._collection = None
+
 
 def setup_short_term_memory() -> ListMemory:
     return ListMemory()
 
 
-def setup_rag_memory() -> ChromaDBVectorMemory:
-    return ChromaDBVectorMemory(
+def setup_rag_memory(sources: list[str] | None = None) -> SharedChromaDBVectorMemory:
+    return SharedChromaDBVectorMemory(
         config=PersistentChromaDBVectorMemoryConfig(
-            collection_name="npc_story",
+            collection_name=RAG_COLLECTION_NAME,
             persistence_path=os.path.join(os.getcwd(), "memory"),
             k=3,
             score_threshold=0.4,
             embedding_function_config=SentenceTransformerEmbeddingFunctionConfig(
-                model_name="all-MiniLM-L6-v2"
+                model_name=EMBEDDING_MODEL_NAME
             ),
-        )
+        ),
+        sources=sources,
     )
 
 
 async def index_story_file(
     file_path: str, rag_memory: ChromaDBVectorMemory
-) -> None:
+) -> bool:
+    """Chunks and indexes a .txt/.pdf story. Returns True if anything was indexed."""
     try:
         text = ""
         file_extension = os.path.splitext(file_path)[1].lower()
@@ -46,11 +121,11 @@ async def index_story_file(
             print(
                 f"Unsupported file type: {file_extension}. Only .txt and .pdf are supported."
             )
-            return
+            return False
 
         if not text:
             print(f"No text found in the file: {file_path}")
-            return
+            return False
 
         chunks = [text[i : i + 1200] for i in range(0, len(text), 1200)]
         for i, chunk in enumerate(chunks):
@@ -62,8 +137,10 @@ async def index_story_file(
                 )
             )
         print(f"Indexed {len(chunks)} chunks from {file_path}")
+        return True
     except Exception as e:
         print(f"Error indexing story file: {str(e)}")
+        return False
 
 
 async def add_user_text_story(
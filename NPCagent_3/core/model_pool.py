@@ -0,0 +1,272 @@
+# core/model_pool.py
+import time
+from typing import AsyncGenerator, Mapping, Sequence
+
+import httpx
+from autogen_core import CancellationToken
+from autogen_core.models import (
+    ChatCompletionClient,
+    CreateResult,
+    LLMMessage,
+    ModelInfo,
+    RequestUsage,
+)
+from autogen_core.tools import Tool, ToolSchema
+
+from core import config
+from core.scheduler import PRIORITY_AGENT, get_scheduler
+from core.tracing import LLM_ERRORS, on_http_request, record_llm_result, role_label, traced
+
+
+class SessionModelClient(ChatCompletionClient):
+    """
+    A per-session view over the process-wide model client.
+
+    Requests go through the shared client (and its keep-alive connection pool);
+    token usage is accounted to this session only. Closing it releases the
+    lease and never closes the shared client.
+
+    labeled() returns a view for one caller (an agent, the selector) so traces
+    can tell model requests apart; usage still rolls up to the session. A view
+    can also carry a response_format that every request it makes is sent with,
+    and the scheduler priority its requests wait with (core/scheduler.py).
+    """
+
+    def __init__(
+        self,
+        pool: "ModelClientPool",
+        session_id: str,
+        label: str = "session",
+        parent: "SessionModelClient | None" = None,
+        response_format: dict | None = None,
+        priority: int = PRIORITY_AGENT,
+    ):
+        self._pool = pool
+        self._session_id = session_id
+        self._label = label
+        self._parent = parent
+        self._response_format = response_format
+        self._priority = priority
+        self._actual_usage = RequestUsage(prompt_tokens=0, completion_tokens=0)
+        self._total_usage = RequestUsage(prompt_tokens=0, completion_tokens=0)
+        self.request_count = 0
+
+    @property
+    def session_id(self) -> str:
+        # A lease can be handed to another session (ModelClientPool.rekey); the root knows the current one.
+        return (self._parent or self)._session_id
+
+    @property
+    def label(self) -> str:
+        return self._label
+
+    def labeled(self, label: str, response_format: dict | None = None, priority: int = PRIORITY_AGENT) -> "SessionModelClient":
+        root = self._parent or self
+        return SessionModelClient(
+            self._pool, root._session_id, label=label, parent=root, response_format=response_format, priority=priority
+        )
+
+    def _create_args(self, json_output, extra_create_args: Mapping) -> Mapping:
+        if self._response_format is None or json_output is not None or "response_format" in extra_create_args:
+            return extra_create_args
+        return {**extra_create_args, "response_format": self._response_format}
+
+    def _record_usage(self, usage: RequestUsage) -> None:
+        if self._parent is not None:
+            self._actual_usage = usage
+            self._parent._record_usage(usage)
+            return
+        self.request_count += 1
+        self._actual_usage = usage
+        self._total_usage = RequestUsage(
+            prompt_tokens=self._total_usage.prompt_tokens + usage.prompt_tokens,
+            completion_tokens=self._total_usage.completion_tokens + usage.completion_tokens,
+        )
+
+    async def create(
+        self,
+        messages: Sequence[LLMMessage],
+        *,
+        tools: Sequence[Tool | ToolSchema] = [],
+        tool_choice="auto",
+        json_output=None,
+        extra_create_args: Mapping = {},
+        cancellation_token: CancellationToken | None = None,
+    ) -> CreateResult:
+        with traced("llm", role_label(self._label), agent=self._label) as span:
+            try:
+                result = await self._pool.scheduler.run(self._priority, lambda: self._pool.client.create(
+                    messages,
+                    tools=tools,
+                    tool_choice=tool_choice,
+                    json_output=json_output,
+                    extra_create_args=self._create_args(json_output, extra_create_args),
+                    cancellation_token=cancellation_token,
+                ), cancellation_token)
+            except Exception:
+                LLM_ERRORS.inc(name=role_label(self._label))
+                raise
+            record_llm_result(span, result.usage)
+        self._record_usage(result.usage)
+        return result
+
+    async def create_stream(
+        self,
+        messages: Sequence[LLMMessage],
+        *,
+        tools: Sequence[Tool | ToolSchema] = [],
+        tool_choice="auto",
+        json_output=None,
+        extra_create_args: Mapping = {},
+        cancellation_token: CancellationToken | None = None,
+    ) -> AsyncGenerator[str | CreateResult, None]:
+        with traced("llm", role_label(self._label), agent=self._label, streamed=True) as span:
+            started = time.perf_counter()
+            try:
+                async for chunk in self._pool.scheduler.stream(self._priority, lambda: self._pool.client.create_stream(
+                    messages,
+                    tools=tools,
+                    tool_choice=tool_choice,
+                    json_output=json_output,
+                    extra_create_args=self._create_args(json_output, extra_create_args),
+                    cancellation_token=cancellation_token,
+                ), cancellation_token):
+                    if isinstance(chunk, CreateResult):
+                        record_llm_result(span, chunk.usage)
+                        self._record_usage(chunk.usage)
+                    elif "first_token_ms" not in span.attributes:
+                        span.attributes["first_token_ms"] = round((time.perf_counter() - started) * 1000, 1)
+                    yield chunk
+            except Exception:
+                LLM_ERRORS.inc(name=role_label(self._label))
+                raise
+
+    async def close(self) -> None:
+        if self._parent is None:
+            self._pool.release(self.session_id)
+
+    def actual_usage(self) -> RequestUsage:
+        return self._actual_usage
+
+    def total_usage(self) -> RequestUsage:
+        return self._total_usage
+
+    def count_tokens(self, messages: Sequence[LLMMessage], *, tools: Sequence[Tool | ToolSchema] = []) -> int:
+        return self._pool.client.count_tokens(messages, tools=tools)
+
+    def remaining_tokens(self, messages: Sequence[LLMMessage], *, tools: Sequence[Tool | ToolSchema] = []) -> int:
+        return self._pool.client.remaining_tokens(messages, tools=tools)
+
+    @property
+    def capabilities(self):  # type: ignore
+        return self._pool.client.model_info
+
+    @property
+    def model_info(self) -> ModelInfo:
+        return self._pool.client.model_info
+
+
+class ModelClientPool:
+    """
+    Owns one keep-alive HTTP connection pool and one model client for the whole
+    process. Sessions borrow a SessionModelClient via lease() and give it back
+    via release(); the pool itself is only closed at application shutdown.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        max_connections: int = config.MODEL_POOL_MAX_CONNECTIONS,
+        max_keepalive_connections: int = config.MODEL_POOL_MAX_KEEPALIVE,
+        keepalive_expiry: float = config.MODEL_POOL_KEEPALIVE_EXPIRY,
+    ):
+        self._http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry,
+            ),
+            # Counts every HTTP attempt so SDK-level retries show up in traces.
+            event_hooks={"request": [on_http_request]},
+        )
+        # Retries are the scheduler's job; SDK retries would bypass its backoff and rate limit.
+        self.client = config.get_model_client(api_key, http_client=self._http_client, max_retries=0)
+        self.scheduler = get_scheduler(config.MODEL_NAME)
+        self._leases: dict[str, SessionModelClient] = {}
+        # Usage of sessions that have already released their lease.
+        self._released_usage = RequestUsage(prompt_tokens=0, completion_tokens=0)
+        self._released_requests = 0
+
+    def lease(self, session_id: str) -> SessionModelClient:
+        if session_id not in self._leases:
+            self._leases[session_id] = SessionModelClient(self, session_id)
+        return self._leases[session_id]
+
+    def rekey(self, old_session_id: str, new_session_id: str) -> SessionModelClient:
+        """Moves a lease (and the team built on it) from a prebuilt template to a real session."""
+        lease = self._leases.pop(old_session_id)
+        lease._session_id = new_session_id
+        self._leases[new_session_id] = lease
+        return lease
+
+    def release(self, session_id: str) -> None:
+        lease = self._leases.pop(session_id, None)
+        if lease is None:
+            return
+        usage = lease.total_usage()
+        self._released_usage = RequestUsage(
+            prompt_tokens=self._released_usage.prompt_tokens + usage.prompt_tokens,
+            completion_tokens=self._released_usage.completion_tokens + usage.completion_tokens,
+        )
+        self._released_requests += lease.request_count
+
+    def session_usage(self, session_id: str) -> dict | None:
+        lease = self._leases.get(session_id)
+        if lease is None:
+            return None
+        usage = lease.total_usage()
+        return {
+            "requests": lease.request_count,
+            "prompt_tokens": usage.prompt_tokens,
+            "completion_tokens": usage.completion_tokens,
+        }
+
+    def stats(self) -> dict:
+        prompt_tokens = self._released_usage.prompt_tokens
+        completion_tokens = self._released_usage.completion_tokens
+        requests = self._released_requests
+        for lease in self._leases.values():
+            usage = lease.total_usage()
+            prompt_tokens += usage.prompt_tokens
+            completion_tokens += usage.completion_tokens
+            requests += lease.request_count
+        return {
+            "active_leases": len(self._leases),
+            "requests": requests,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            **{f"scheduler_{k}": v for k, v in self.scheduler.stats().items()},
+        }
+
+    async def close(self) -> None:
+        self._leases.clear()
+        await self.client.close()
+        await self._http_client.aclose()
+
+
+_POOL: ModelClientPool | None = None
+
+
+def get_model_pool() -> ModelClientPool:
+    """Returns the process-wide pool, creating it on first use."""
+    global _POOL
+    if _POOL is None:
+        _POOL = ModelClientPool(config.get_api_key())
+    return _POOL
+
+
+async def close_model_pool() -> None:
+    global _POOL
+    if _POOL is not None:
+        await _POOL.close()
+        _POOL = None
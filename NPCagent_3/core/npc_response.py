@@ -0,0 +1,137 @@
+# core/npc_response.py
+import difflib
+import json
+from typing import Awaitable, Callable
+
+from autogen_agentchat.messages import TextMessage
+from autogen_core import CancellationToken
+from pydantic import ValidationError
+
+from core.config import NPCResponse, get_valid_moods
+from core.prompts import load_prompt
+from core.tracing import Counter, register
+
+VALIDATION_EVENTS = register(Counter(
+    "npc_response_validation_total",
+    "Final NPC replies by outcome: valid, repaired, retried (valid after one retry) or invalid.",
+))
+REPAIRS = register(Counter("npc_response_repairs_total", "Local fixes applied to near-miss NPC replies, by field."))
+
+# Moods models reach for that are not in NPCResponse, mapped to the closest allowed one.
+MOOD_SYNONYMS = {
+    "cheerful": "happy", "joyful": "happy", "glad": "happy", "content": "happy", "friendly": "happy",
+    "pleased": "happy", "amused": "happy", "upset": "sad", "disappointed": "sad", "melancholy": "sad",
+    "annoyed": "angry", "irritated": "angry", "frustrated": "angry", "furious": "angry",
+    "interested": "curious", "intrigued": "curious", "thoughtful": "curious", "enthusiastic": "excited",
+    "eager": "excited", "thrilled": "excited", "puzzled": "confused", "uncertain": "confused",
+    "surprised": "confused", "calm": "neutral", "relaxed": "neutral", "professional": "neutral",
+    "wry": "sarcastic", "ironic": "sarcastic", "playful": "sarcastic",
+}
+# Fields the player never sees directly; a missing one is filled rather than failing the turn.
+FIELD_DEFAULTS = {"thoughts": "", "action": "RESPOND: user", "animation": "talk"}
+
+RetryFunc = Callable[[str], Awaitable[str]]
+
+
+def extract_json_from_string(text: str) -> dict | None:
+    """Returns the first JSON object in `text` (models sometimes wrap it in prose or code fences)."""
+    decoder = json.JSONDecoder()
+    start = text.find("{")
+    while start != -1:
+        try:
+            value, _ = decoder.raw_decode(text, start)
+            if isinstance(value, dict):
+                return value
+        except json.JSONDecodeError:
+            pass
+        start = text.find("{", start + 1)
+    print(f"⚠️ No JSON object found in: {text[:200]}")
+    return None
+
+
+def _nearest_mood(mood: str) -> str:
+    valid = get_valid_moods()
+    mood = mood.strip().lower()
+    if mood in valid:
+        return mood
+    if mood in MOOD_SYNONYMS:
+        return MOOD_SYNONYMS[mood]
+    close = difflib.get_close_matches(mood, valid, n=1, cutoff=0.6)
+    return close[0] if close else "neutral"
+
+
+def repair_npc_response(data: dict) -> tuple[NPCResponse | None, list[str]]:
+    """
+    Validates a reply, fixing near misses locally: an unknown mood becomes the
+    nearest valid one and missing bookkeeping fields get defaults. A reply
+    without "response" text cannot be repaired. Returns (reply or None, fixes).
+    """
+    try:
+        return NPCResponse(**data), []
+    except (ValidationError, TypeError):
+        pass
+    if not isinstance(data.get("response"), str) or not data["response"].strip():
+        return None, []
+    fixed, repairs = dict(data), []
+    for name, default in FIELD_DEFAULTS.items():
+        if not isinstance(fixed.get(name), str):
+            fixed[name] = default if fixed.get(name) is None else json.dumps(fixed[name])
+            repairs.append(name)
+    mood = fixed.get("mood")
+    nearest = _nearest_mood(mood if isinstance(mood, str) else "")
+    if nearest != mood:
+        fixed["mood"] = nearest
+        repairs.append("mood")
+    try:
+        return NPCResponse(**fixed), repairs
+    except (ValidationError, TypeError) as e:
+        print(f"⚠️ NPC reply could not be repaired: {e}")
+        return None, []
+
+
+def final_agent_retry(agent, cancellation_token: CancellationToken | None = None) -> RetryFunc:
+    """Re-asks only the final agent (with its own context) for a corrected reply."""
+
+    async def retry(errors: str) -> str:
+        # Not a "user" message, so the summarizing context does not count it as a new player turn.
+        request = TextMessage(source="validator", content=load_prompt("npc_retry_message.txt", errors=errors))
+        response = await agent.on_messages([request], cancellation_token or CancellationToken())
+        return response.chat_message.to_text()
+
+    return retry
+
+
+def _validate(raw: str) -> tuple[NPCResponse | None, list[str], str]:
+    data = extract_json_from_string(raw)
+    if data is None:
+        return None, [], "The reply did not contain a JSON object."
+    reply, repairs = repair_npc_response(data)
+    if reply is None:
+        try:
+            NPCResponse(**data)
+        except (ValidationError, TypeError) as e:
+            return None, [], str(e)
+    return reply, repairs, ""
+
+
+async def parse_npc_response(raw: str, retry: RetryFunc | None = None) -> tuple[NPCResponse | None, str]:
+    """
+    Turns the final team message into an NPCResponse, repairing near misses
+    locally. If that fails, `retry` (which re-asks only the final agent) is
+    called once with the validation errors. Returns (reply or None, the raw
+    text the result came from).
+    """
+    reply, repairs, errors = _validate(raw)
+    outcome = "repaired" if repairs else "valid"
+    if reply is None and retry is not None:
+        print(f"⚠️ NPC reply invalid, asking the NPC once more: {errors}")
+        try:
+            raw = await retry(errors)
+            reply, repairs, errors = _validate(raw)
+            outcome = "retried"
+        except Exception as e:
+            print(f"⚠️ NPC retry failed: {e}")
+    for name in repairs:
+        REPAIRS.inc(field=name)
+    VALIDATION_EVENTS.inc(result=outcome if reply is not None else "invalid")
+    return reply, raw
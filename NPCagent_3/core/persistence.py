@@ -0,0 +1,187 @@
+# core/persistence.py
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+# Lists in a team state that hold chat messages. Each message is stored once in
+# an append-only log next to the snapshot, and the snapshot keeps only keys.
+MESSAGE_LIST_KEYS = {"messages", "message_buffer", "message_thread"}
+REF_KEY = "$message_refs"
+
+# Rewrite the log once it holds this many times more lines than the snapshot references.
+COMPACT_RATIO = 2
+COMPACT_MIN_LINES = 200
+
+_locks: dict[str, threading.Lock] = {}
+_locks_guard = threading.Lock()
+# Per-log bookkeeping so appends do not have to re-read the log:
+# {"keys": set, "lines": int, "size": bytes after our last write}
+_log_index: dict[str, dict] = {}
+
+
+def message_log_path(state_path: Path) -> Path:
+    state_path = Path(state_path)
+    return state_path.with_name(state_path.stem + ".messages.jsonl")
+
+
+def _lock_for(state_path: Path) -> threading.Lock:
+    with _locks_guard:
+        return _locks.setdefault(str(state_path), threading.Lock())
+
+
+def _message_key(message: dict) -> str:
+    if isinstance(message.get("id"), str):
+        return message["id"]
+    canonical = json.dumps(message, sort_keys=True, separators=(",", ":"), default=str)
+    return "sha1:" + hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+
+def _externalize(node, messages: dict):
+    """Returns a copy of `node` with message lists replaced by key references."""
+    if isinstance(node, dict):
+        out = {}
+        for key, value in node.items():
+            if key in MESSAGE_LIST_KEYS and isinstance(value, list) and all(isinstance(m, dict) for m in value):
+                refs = []
+                for message in value:
+                    msg_key = _message_key(message)
+                    messages.setdefault(msg_key, message)
+                    refs.append(msg_key)
+                out[key] = {REF_KEY: refs}
+            else:
+                out[key] = _externalize(value, messages)
+        return out
+    if isinstance(node, list):
+        return [_externalize(item, messages) for item in node]
+    return node
+
+
+def _resolve(node, messages: dict):
+    if isinstance(node, dict):
+        if REF_KEY in node and len(node) == 1:
+            # A message lost to a torn log line is dropped rather than failing the whole load.
+            return [messages[key] for key in node[REF_KEY] if key in messages]
+        return {key: _resolve(value, messages) for key, value in node.items()}
+    if isinstance(node, list):
+        return [_resolve(item, messages) for item in node]
+    return node
+
+
+def _has_refs(node) -> bool:
+    if isinstance(node, dict):
+        return REF_KEY in node or any(_has_refs(v) for v in node.values())
+    if isinstance(node, list):
+        return any(_has_refs(v) for v in node)
+    return False
+
+
+def _read_log(log_path: Path) -> tuple[dict, int]:
+    messages = {}
+    lines = 0
+    if log_path.exists():
+        with open(log_path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                    messages[entry["k"]] = entry["m"]
+                except (json.JSONDecodeError, TypeError, KeyError):
+                    # A torn line from a crash mid-append; everything before it is intact.
+                    continue
+                lines += 1
+    return messages, lines
+
+
+def atomic_write(path: Path, text: str) -> None:
+    """Writes to a temp file next to `path`, fsyncs it and renames it over `path`."""
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _ends_with_newline(log_path: Path, size: int) -> bool:
+    if size == 0:
+        return True
+    with open(log_path, "rb") as f:
+        f.seek(size - 1)
+        return f.read(1) == b"\n"
+
+
+def _log_line(key: str, message: dict) -> str:
+    return json.dumps({"k": key, "m": message}, separators=(",", ":"), default=str) + "\n"
+
+
+def save_state_file(state_path: Path, state: dict) -> None:
+    """
+    Persists a state dict. Messages not yet in the log are appended, then the
+    small snapshot (with message keys only) is atomically replaced, so the cost
+    of a save follows the number of new messages rather than the whole history.
+    """
+    state_path = Path(state_path)
+    log_path = message_log_path(state_path)
+    with _lock_for(state_path):
+        messages: dict = {}
+        snapshot = _externalize(state, messages)
+
+        index = _log_index.get(str(log_path))
+        log_size = log_path.stat().st_size if log_path.exists() else 0
+        if index is None or index["size"] != log_size:
+            # First save in this process, or another worker touched the log.
+            existing, lines = _read_log(log_path)
+            index = {"keys": set(existing), "lines": lines, "size": log_size}
+            _log_index[str(log_path)] = index
+
+        new_keys = [key for key in messages if key not in index["keys"]]
+        if new_keys:
+            # After a crash mid-append the log ends in a torn line; new lines must not continue it.
+            separator = "" if _ends_with_newline(log_path, log_size) else "\n"
+            with open(log_path, "a", encoding="utf-8") as f:
+                f.write(separator + "".join(_log_line(key, messages[key]) for key in new_keys))
+                f.flush()
+                os.fsync(f.fileno())
+            index["keys"].update(new_keys)
+            index["lines"] += len(new_keys)
+            index["size"] = log_path.stat().st_size
+
+        # The log must hold every referenced message before the snapshot points at it.
+        atomic_write(state_path, json.dumps(snapshot, separators=(",", ":"), default=str))
+
+        if index["lines"] > max(COMPACT_MIN_LINES, COMPACT_RATIO * len(messages)):
+            atomic_write(log_path, "".join(_log_line(key, msg) for key, msg in messages.items()))
+            index["keys"] = set(messages)
+            index["lines"] = len(messages)
+            index["size"] = log_path.stat().st_size
+
+
+def delete_state_file(state_path: Path) -> None:
+    """Removes a snapshot and its message log."""
+    state_path = Path(state_path)
+    log_path = message_log_path(state_path)
+    with _lock_for(state_path):
+        for path in (state_path, log_path):
+            path.unlink(missing_ok=True)
+        _log_index.pop(str(log_path), None)
+    with _locks_guard:
+        _locks.pop(str(state_path), None)
+
+
+def load_state_file(state_path: Path, resolve: bool = True) -> dict:
+    """
+    Loads a snapshot written by save_state_file() or a legacy fully inlined
+    state file. With resolve=False the message log is not read at all, which
+    is enough for callers that only need persona/mood/context files.
+    """
+    state_path = Path(state_path)
+    with open(state_path, "r", encoding="utf-8") as f:
+        snapshot = json.load(f)
+    if not resolve or not _has_refs(snapshot):
+        return snapshot
+    messages, _ = _read_log(message_log_path(state_path))
+    return _resolve(snapshot, messages)
@@ -0,0 +1,111 @@
+# core/personas.py
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+from core import config
+from core.persistence import load_state_file
+
+
+class PersonaIndex:
+    """
+    Manifest of saved NPC personas (name, background, behavior), updated on
+    every state save so /avatars never has to open the state files themselves.
+    Also holds per-persona settings that every session of a persona shares.
+    """
+
+    def __init__(self, db_path: str):
+        self._db_path = db_path
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS personas ("
+                "name_key TEXT PRIMARY KEY, name TEXT NOT NULL, background TEXT NOT NULL, "
+                "behavior TEXT NOT NULL, state_path TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS persona_settings (name_key TEXT PRIMARY KEY, response_cache INTEGER NOT NULL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self._db_path, timeout=30)
+
+    def upsert(self, persona: dict, state_path: str) -> None:
+        name = str(persona.get("name", "")).strip()
+        if not name:
+            return
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO personas "
+                "(name_key, name, background, behavior, state_path, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    name.lower(),
+                    name,
+                    persona.get("background", "") or "",
+                    persona.get("behavior", "") or "",
+                    str(state_path),
+                    time.time(),
+                ),
+            )
+
+    def set_response_cache(self, name: str, enabled: bool) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO persona_settings (name_key, response_cache) VALUES (?, ?)",
+                (name.strip().lower(), int(enabled)),
+            )
+
+    def response_cache_enabled(self, name: str) -> bool:
+        """Whether this persona may answer from core/response_cache.py (the default)."""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT response_cache FROM persona_settings WHERE name_key = ?", (name.strip().lower(),)
+            ).fetchone()
+        return row is None or bool(row[0])
+
+    def list(self, prefix: str | None = None, offset: int = 0, limit: int = 100) -> tuple[list[dict], int]:
+        """Returns one page of personas ordered by name, plus the total match count."""
+        where, params = "", []
+        if prefix:
+            escaped = prefix.strip().lower().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            where, params = "WHERE name_key LIKE ? ESCAPE '\\'", [escaped + "%"]
+        with self._connect() as conn:
+            total = conn.execute(f"SELECT COUNT(*) FROM personas {where}", params).fetchone()[0]
+            rows = conn.execute(
+                f"SELECT name, background, behavior FROM personas {where} ORDER BY name_key LIMIT ? OFFSET ?",
+                [*params, limit, offset],
+            ).fetchall()
+        return [{"name": n, "background": bg, "behavior": bh} for n, bg, bh in rows], total
+
+    def is_empty(self) -> bool:
+        with self._connect() as conn:
+            return conn.execute("SELECT 1 FROM personas LIMIT 1").fetchone() is None
+
+    def rebuild(self, state_dir: Path) -> int:
+        """One-time backfill from existing state files (reads snapshots only)."""
+        count = 0
+        for filename in os.listdir(state_dir):
+            if not filename.endswith("_state.json"):
+                continue
+            fp = state_dir / filename
+            try:
+                persona = load_state_file(fp, resolve=False).get("persona")
+            except Exception as e:
+                print(f"⚠️ Could not read/parse state file {filename}: {e}")
+                continue
+            if persona:
+                self.upsert(persona, str(fp))
+                count += 1
+        return count
+
+
+_INDEX: PersonaIndex | None = None
+
+
+def get_persona_index() -> PersonaIndex:
+    global _INDEX
+    if _INDEX is None:
+        _INDEX = PersonaIndex(config.PERSONA_DB_PATH)
+    return _INDEX
@@ -0,0 +1,134 @@
+# core/prompts.py
+import string
+from dataclasses import dataclass
+from functools import lru_cache
+
+from core import config
+from core.tracing import TOKEN_BUCKETS, Histogram, register
+
+PROMPT_TOKENS = register(Histogram("npc_prompt_tokens", "Tokens per turn prompt, by section.", buckets=TOKEN_BUCKETS))
+
+_ENCODING = None
+
+
+def count_tokens(text: str) -> int:
+    """tiktoken count (cl100k_base); falls back to ~4 chars per token if the encoding is unavailable offline."""
+    global _ENCODING
+    if _ENCODING is None:
+        try:
+            import tiktoken
+
+            _ENCODING = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            print(f"⚠️ tiktoken encoding unavailable, estimating tokens from length: {e}")
+            _ENCODING = False
+    if _ENCODING:
+        return len(_ENCODING.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """Keeps the beginning of `text` that fits in `max_tokens`, cut at a line or word boundary."""
+    if max_tokens <= 0:
+        return ""
+    if _ENCODING:
+        tokens = _ENCODING.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        text = _ENCODING.decode(tokens[:max_tokens])
+    elif count_tokens(text) > max_tokens:
+        text = text[:max_tokens * 4]
+    else:
+        return text
+    cut = max(text.rfind("\n"), text.rfind(" "))
+    return (text[:cut] if cut > len(text) // 2 else text).rstrip() + " …"
+
+
+class PromptTemplate:
+    """
+    A prompt file read and parsed once; render() only substitutes. Every file
+    is a str.format template, with or without fields: literal braces are
+    always written doubled.
+    """
+
+    def __init__(self, name: str, text: str):
+        self.name = name
+        self.text = text
+        self.fields = frozenset(field for _, field, _, _ in string.Formatter().parse(text) if field)
+
+    def render(self, **kwargs) -> str:
+        missing = self.fields - kwargs.keys()
+        if missing:
+            raise KeyError(f"Missing placeholder in prompt {self.name}: {', '.join(sorted(missing))}")
+        return self.text.format(**kwargs)
+
+
+@lru_cache(maxsize=None)
+def get_template(filename: str) -> PromptTemplate:
+    try:
+        with open(config.PROMPT_DIR / filename, "r") as f:
+            return PromptTemplate(filename, f.read())
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Prompt file not found: {filename}")
+
+
+@lru_cache(maxsize=256)
+def _render(filename: str, items: tuple) -> str:
+    return get_template(filename).render(**dict(items))
+
+
+def load_prompt(filename: str, **kwargs) -> str:
+    """Renders a file from prompts/; files are read once and identical renders are reused."""
+    return _render(filename, tuple(sorted(kwargs.items())))
+
+
+@dataclass
+class PromptSection:
+    name: str
+    text: str
+    # Sections with priority > 0 may be shortened or dropped to fit the budget, lowest priority first.
+    priority: int = 0
+
+
+class TurnPrompt:
+    """
+    Per-turn task prompt, assembled static-first and volatile-last.
+
+    Add sections from the most stable (instructions, session facts) to the most
+    volatile (mood, lookups, the player's message) so consecutive turns share
+    the longest possible prefix for provider-side prompt caching. build()
+    trims optional context to `token_budget` and logs what each section cost.
+    """
+
+    def __init__(self, token_budget: int = config.PROMPT_TOKEN_BUDGET):
+        self.token_budget = token_budget
+        self.sections: list[PromptSection] = []
+
+    def add(self, name: str, text: str | None, priority: int = 0) -> "TurnPrompt":
+        if text:
+            self.sections.append(PromptSection(name, text.strip("\n") + "\n", priority))
+        return self
+
+    def _trim(self, costs: dict[str, int]) -> list[str]:
+        trimmed = []
+        over = sum(costs.values()) - self.token_budget
+        for section in sorted((s for s in self.sections if s.priority > 0), key=lambda s: s.priority):
+            if over <= 0:
+                break
+            keep = costs[section.name] - over
+            section.text = truncate_tokens(section.text, keep) + "\n" if keep > 16 else ""
+            new_cost = count_tokens(section.text) if section.text else 0
+            over -= costs[section.name] - new_cost
+            costs[section.name] = new_cost
+            trimmed.append(section.name)
+        return trimmed
+
+    def build(self, label: str = "") -> str:
+        costs = {s.name: count_tokens(s.text) for s in self.sections}
+        trimmed = self._trim(costs) if sum(costs.values()) > self.token_budget else []
+        for name, cost in costs.items():
+            PROMPT_TOKENS.observe(cost, section=name)
+        breakdown = ", ".join(f"{name} {cost}" for name, cost in costs.items())
+        note = f"; trimmed {', '.join(trimmed)} to fit {self.token_budget}" if trimmed else ""
+        print(f"DEBUG: Turn prompt{f' for {label!r}' if label else ''}: {sum(costs.values())} tokens ({breakdown}){note}")
+        return "\n".join(s.text for s in self.sections if s.text)
@@ -0,0 +1,153 @@
+# core/response_cache.py
+import asyncio
+import hashlib
+import re
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from core import config
+from core.environment import world_version
+from core.tracing import Counter, Gauge, register
+
+CACHE_EVENTS = register(Counter("npc_response_cache_total", "Response cache lookups and writes by result."))
+CACHE_ENTRIES = register(Gauge("npc_response_cache_entries", "Entries currently held by the response cache."))
+
+HASH_DIMENSIONS = 512
+
+
+def persona_key(persona: dict, context_files: dict) -> str:
+    """Same NPC, same story and same environment file: answers are interchangeable."""
+    parts = [
+        persona.get("name", "").strip().lower(),
+        persona.get("background", ""),
+        persona.get("behavior", ""),
+        context_files.get("story") or "",
+        context_files.get("csharp") or "",
+    ]
+    return hashlib.sha1("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+
+def _hashed_embedding(text: str) -> np.ndarray:
+    """Bag of word and character-trigram hashes; used when no sentence-transformer is available."""
+    vector = np.zeros(HASH_DIMENSIONS, dtype=np.float32)
+    words = re.findall(r"[a-z0-9']+", text.lower())
+    grams = words + [w[i:i + 3] for w in words for i in range(max(len(w) - 2, 1))]
+    for gram in grams:
+        digest = hashlib.md5(gram.encode("utf-8")).digest()
+        vector[int.from_bytes(digest[:4], "little") % HASH_DIMENSIONS] += 1.0
+    return vector
+
+
+@dataclass
+class CacheEntry:
+    bucket: tuple  # (persona key, mood)
+    world_version: str | None  # None: the answer does not depend on the world state
+    message: str
+    embedding: np.ndarray
+    payload: dict
+    created_at: float = field(default_factory=time.time)
+
+
+class ResponseCache:
+    """
+    Semantic cache of validated NPC replies.
+
+    Lookups only consider entries for the same persona (and context files)
+    and mood; world-dependent entries must also match the current world
+    version. A hit is the most similar stored message above `threshold`.
+    Entries expire after `ttl` seconds and the least recently used are evicted
+    past `max_entries`.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, threshold: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self._entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        self._buckets: dict[tuple, set[str]] = {}
+        self._embed_func = None
+
+    def _embed(self, text: str) -> np.ndarray:
+        if self._embed_func is None:
+            try:
+                from core.memory import get_embedding_function
+
+                embedding_function = get_embedding_function()
+                self._embed_func = lambda t: np.asarray(embedding_function([t])[0], dtype=np.float32)
+            except Exception as e:
+                print(f"⚠️ Response cache using hashed embeddings (sentence-transformer unavailable): {e}")
+                self._embed_func = _hashed_embedding
+        vector = self._embed_func(text)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    async def embed(self, text: str) -> np.ndarray:
+        return await asyncio.to_thread(self._embed, " ".join(text.split()).lower())
+
+    def _remove(self, entry_id: str) -> None:
+        entry = self._entries.pop(entry_id, None)
+        if entry is not None:
+            bucket = self._buckets.get(entry.bucket)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[entry.bucket]
+
+    async def lookup(self, persona: str, mood: str, message: str) -> tuple[dict | None, np.ndarray]:
+        """Returns (payload or None, embedding); pass the embedding back to store() on a miss."""
+        embedding = await self.embed(message)
+        now, current_world = time.time(), world_version()
+        best_id, best_score = None, self.threshold
+        for entry_id in list(self._buckets.get((persona, mood), ())):
+            entry = self._entries[entry_id]
+            if now - entry.created_at > self.ttl or entry.world_version not in (None, current_world):
+                self._remove(entry_id)
+                continue
+            score = float(np.dot(entry.embedding, embedding))
+            if score >= best_score:
+                best_id, best_score = entry_id, score
+        CACHE_ENTRIES.set(len(self._entries))
+        if best_id is None:
+            CACHE_EVENTS.inc(result="miss")
+            return None, embedding
+        self._entries.move_to_end(best_id)
+        CACHE_EVENTS.inc(result="hit")
+        return self._entries[best_id].payload, embedding
+
+    def store(self, persona: str, mood: str, message: str, embedding: np.ndarray, payload: dict, world_version: str | None) -> None:
+        entry_id = uuid.uuid4().hex
+        bucket = (persona, mood)
+        self._entries[entry_id] = CacheEntry(bucket, world_version, message, embedding, payload)
+        self._buckets.setdefault(bucket, set()).add(entry_id)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+        CACHE_EVENTS.inc(result="store")
+        CACHE_ENTRIES.set(len(self._entries))
+
+    def invalidate_world(self) -> int:
+        """Drops every world-dependent entry; called after a world state write."""
+        stale = [entry_id for entry_id, entry in self._entries.items() if entry.world_version is not None]
+        for entry_id in stale:
+            self._remove(entry_id)
+        if stale:
+            CACHE_EVENTS.inc(len(stale), result="invalidated")
+        CACHE_ENTRIES.set(len(self._entries))
+        return len(stale)
+
+
+_CACHE: ResponseCache | None = None
+
+
+def get_response_cache() -> ResponseCache:
+    global _CACHE
+    if _CACHE is None:
+        _CACHE = ResponseCache(
+            max_entries=config.RESPONSE_CACHE_MAX_ENTRIES,
+            ttl=config.RESPONSE_CACHE_TTL,
+            threshold=config.RESPONSE_CACHE_SIMILARITY,
+        )
+    return _CACHE
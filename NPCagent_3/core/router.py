@@ -0,0 +1,122 @@
+# core/router.py
+import re
+from dataclasses import dataclass
+from typing import Sequence
+
+from autogen_agentchat.messages import BaseAgentEvent, BaseChatMessage, MultiModalMessage, ToolCallSummaryMessage
+
+from core import config
+from core.fanout import FANOUT_MARKER
+from core.tracing import Counter, register, role_label
+
+ROUTER_DECISIONS = register(Counter("npc_router_decisions_total", "Speaker selections by route (fast path or LLM selector)."))
+
+STORY_AGENT = "story_agent"
+CODE_AGENT = "CodeAnalyzerAgent"
+VISION_AGENT = "VisionAgent"
+
+# The websocket wraps the player's text in a larger task prompt; only the text is classified.
+_USER_MESSAGE_RE = re.compile(r"The user's message is: '(.*?)'\.\n", re.DOTALL)
+
+# (pattern, weight) per intent. Leading imperatives weigh more than the nouns they act on.
+_RULES = {
+    "social": [
+        (r"\b(hi|hello|hey|howdy|greetings|yo|good (morning|afternoon|evening|night))\b", 1.0),
+        (r"\b(thanks|thank you|bye|goodbye|see you|cheers|sorry|please forgive)\b", 1.0),
+        (r"\bhow are you\b|\bhow('s| is) it going\b|\bwhat'?s up\b|\bhow do you feel\b", 1.5),
+        (r"\b(your name|who are you|about yourself|are you (ok|okay|happy|sad|angry|busy))\b", 1.5),
+        (r"\bwhat do you think\b|\bdo you (like|enjoy|love|hate)\b|\bhow('s| is| was) (business|your day|life|work)\b", 1.5),
+        (r"\b(lol|haha|nice|cool|great|awesome|funny|i like you|you're)\b", 0.5),
+    ],
+    "command": [
+        (r"^\s*(please\s+)?(pick up|grab|take|open|close|shut|lock|unlock|go to|walk to|move to|run to|come here|follow me|"
+         r"give me|hand me|turn (on|off)|push|pull|sit|stand|dance|wave|jump|drop|put|clean|fix)\b", 3.0),
+        (r"\b(can|could|would|will) you (please )?(pick up|grab|take|open|close|shut|go|walk|move|give|hand|turn|drop|put|clean|fix)\b", 3.0),
+    ],
+    "world": [
+        (r"\bwhere\b", 1.5),
+        (r"\bwhat('s| is| are)? (in|on|near|behind|around|inside)\b|\b(is|are) there (any|a|an)\b", 1.5),
+        (r"\b(is|are) (on|in|near|behind|inside|under) the\b", 1.0),
+        (r"\b(status|layout|map|located|location|position|stock|price|nearby)\b", 1.0),
+        (r"\b(aisle|shelf|shelves|register|counter|door|room|object|item|items|floor|wall|entrance|exit|store|shop)\b", 0.5),
+    ],
+    "story": [
+        (r"\b(story|history|lore|legend|backstory|origin|myth|tale|long ago|founded|founder|grand opening)\b", 1.5),
+        (r"\bwho (was|were|built|owns|owned|founded|runs)\b|\bwhat happened\b|\bwhy did\b", 1.5),
+        (r"\b(past|remember|before|used to|event|opening)\b", 0.5),
+    ],
+}
+# A world/story score this high means the question needs that specialist's data.
+LOOKUP_MIN_SCORE = 1.5
+
+_COMPILED = {intent: [(re.compile(p, re.IGNORECASE), w) for p, w in rules] for intent, rules in _RULES.items()}
+
+
+@dataclass(frozen=True)
+class Intent:
+    category: str  # social, command, world, story or unknown
+    confidence: float
+    lookups: tuple[str, ...] = ()  # Specialist data the message clearly asks for (world, story)
+
+
+def classify_intent(text: str) -> Intent:
+    """Scores the player's message against keyword rules; no model call."""
+    scores = {intent: sum(w for rx, w in rules if rx.search(text)) for intent, rules in _COMPILED.items()}
+    lookups = tuple(intent for intent in ("world", "story") if scores[intent] >= LOOKUP_MIN_SCORE)
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    (top, top_score), (_, second_score) = ranked[0], ranked[1]
+    if top_score == 0:
+        # Short chatter with no question in it ("ok", "hmm I see") is still social.
+        if len(text.split()) <= 4 and "?" not in text:
+            return Intent("social", 0.6)
+        return Intent("unknown", 0.0)
+    return Intent(top, top_score / (top_score + second_score + 0.5), lookups)
+
+
+def _user_text(message: BaseChatMessage) -> str:
+    content = message.to_model_text()
+    match = _USER_MESSAGE_RE.search(content)
+    return match.group(1) if match else content
+
+
+def make_selector_func(npc_name: str, min_confidence: float = config.ROUTER_MIN_CONFIDENCE, world_in_context: bool = False):
+    """
+    Returns a SelectorGroupChat selector_func that picks the next speaker
+    locally when the choice is obvious and returns None (LLM selector) otherwise:
+    social talk and commands go to the NPC, world/story questions to the
+    matching specialist, and the NPC always speaks after a specialist.
+    With world_in_context the NPC already sees the environment snapshot and
+    answers world questions itself.
+    """
+    targets = {
+        "social": npc_name,
+        "command": npc_name,
+        "world": npc_name if world_in_context else CODE_AGENT,
+        "story": STORY_AGENT,
+    }
+
+    def select(messages: Sequence[BaseAgentEvent | BaseChatMessage]) -> str | None:
+        # Only the latest chat message matters; scanned from the end so long threads cost nothing.
+        last = next((m for m in reversed(messages) if isinstance(m, BaseChatMessage)), None)
+        if last is None:
+            return None
+        speaker = None
+        if last.source == "user":
+            if isinstance(last, MultiModalMessage):
+                speaker = VISION_AGENT
+            elif FANOUT_MARKER in last.to_model_text():
+                # Lookups already ran in parallel (core/fanout.py); only the NPC is left to speak.
+                speaker = npc_name
+            else:
+                intent = classify_intent(_user_text(last))
+                if intent.confidence >= min_confidence:
+                    speaker = targets.get(intent.category)
+        elif last.source in (STORY_AGENT, CODE_AGENT, VISION_AGENT):
+            speaker = npc_name
+        elif last.source == npc_name and isinstance(last, ToolCallSummaryMessage):
+            # The NPC used one of its own tools and still owes the JSON reply.
+            speaker = npc_name
+        ROUTER_DECISIONS.inc(route="fast" if speaker else "llm", speaker=role_label(speaker) if speaker else "")
+        return speaker
+
+    return select
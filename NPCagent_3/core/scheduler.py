@@ -0,0 +1,256 @@
+# core/scheduler.py
+import asyncio
+import email.utils
+import heapq
+import itertools
+import random
+import time
+from typing import AsyncGenerator, Awaitable, Callable, TypeVar
+
+from autogen_core import CancellationToken
+from openai import APIConnectionError, APIStatusError, APITimeoutError
+
+from core import config
+from core.tracing import Counter, Gauge, Histogram, register
+
+T = TypeVar("T")
+
+# Lower runs first: the player is waiting on the NPC's reply; selector and
+# specialist calls are on the way there; vision and summaries can wait.
+PRIORITY_NPC = 0
+PRIORITY_AGENT = 1
+PRIORITY_BACKGROUND = 2
+PRIORITY_NAMES = {PRIORITY_NPC: "npc", PRIORITY_AGENT: "agent", PRIORITY_BACKGROUND: "background"}
+
+QUEUE_DEPTH = register(Gauge("npc_llm_queue_depth", "Model requests waiting for a scheduler slot, by priority."))
+IN_FLIGHT = register(Gauge("npc_llm_in_flight", "Model requests currently running, by model."))
+QUEUE_WAIT = register(Histogram("npc_llm_queue_wait_seconds", "Time a model request waited for a slot, by priority."))
+SCHEDULER_RETRIES = register(Counter("npc_llm_scheduler_retries_total", "Model requests retried by the scheduler, by reason."))
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+def _retry_after(error: Exception) -> float | None:
+    """Seconds from a Retry-After / retry-after-ms response header, if the provider sent one."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        parsed = email.utils.parsedate_to_datetime(value)
+        return max(parsed.timestamp() - time.time(), 0.0) if parsed else None
+
+
+async def _cancellable(awaitable: Awaitable[T], cancellation_token: CancellationToken | None) -> T:
+    """Awaits `awaitable`, cancelling it if the token is cancelled first."""
+    future = asyncio.ensure_future(awaitable)
+    if cancellation_token is not None:
+        cancellation_token.link_future(future)
+    return await future
+
+
+def _retry_reason(error: Exception) -> str | None:
+    if isinstance(error, APIStatusError):
+        return str(error.status_code) if error.status_code in RETRYABLE_STATUS else None
+    if isinstance(error, APITimeoutError):
+        return "timeout"
+    if isinstance(error, APIConnectionError):
+        return "connection"
+    return None
+
+
+class TokenBucket:
+    """`rate` requests per second with bursts up to `capacity`; a rate of 0 means unlimited."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(capacity, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def delay(self) -> float:
+        """Seconds until a token is available (0: one was taken)."""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def drain(self) -> None:
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+
+
+class ModelScheduler:
+    """
+    Process-wide gate for one model's requests.
+
+    Requests wait in a priority queue and are let through at most
+    `max_concurrency` at a time and no faster than the token bucket allows.
+    Retryable failures (429, 5xx, timeouts) are retried with full-jitter
+    exponential backoff, and never sooner than the provider's Retry-After. A
+    429 pauses the whole queue for that long, so waiting requests do not all
+    hit the limit again at once.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        requests_per_minute: float = config.MODEL_RATE_LIMIT_RPM,
+        burst: int = config.MODEL_RATE_LIMIT_BURST,
+        max_concurrency: int = config.MODEL_MAX_CONCURRENCY,
+        max_retries: int = config.MODEL_MAX_RETRIES,
+        backoff_base: float = config.MODEL_BACKOFF_BASE,
+        backoff_max: float = config.MODEL_BACKOFF_MAX,
+    ):
+        self.model = model
+        self.bucket = TokenBucket(requests_per_minute / 60, burst)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._queue: list[tuple[int, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+        self._active = 0
+        self._paused_until = 0.0
+        self._wakeup = asyncio.Event()
+        self._dispatcher: asyncio.Task | None = None
+
+    def _update_gauges(self) -> None:
+        depth = {name: 0 for name in PRIORITY_NAMES.values()}
+        for priority, _, future in self._queue:
+            if not future.done():
+                depth[PRIORITY_NAMES.get(priority, str(priority))] += 1
+        for name, count in depth.items():
+            QUEUE_DEPTH.set(count, priority=name)
+        IN_FLIGHT.set(self._active, model=self.model)
+
+    async def _dispatch(self) -> None:
+        while True:
+            self._wakeup.clear()
+            while self._queue and self._queue[0][2].done():
+                heapq.heappop(self._queue)  # Cancelled while waiting
+            if not self._queue or self._active >= self.max_concurrency:
+                await self._wakeup.wait()
+                continue
+            wait = max(self._paused_until - time.monotonic(), 0.0) or self.bucket.delay()
+            if wait > 0:
+                # A release or a new request does not make a token appear sooner.
+                await asyncio.sleep(wait)
+                continue
+            _, _, future = heapq.heappop(self._queue)
+            if future.done():
+                self.bucket.tokens += 1  # Give back the token taken for a cancelled waiter
+                continue
+            self._active += 1
+            future.set_result(None)
+            self._update_gauges()
+
+    async def _acquire(self, priority: int, cancellation_token: CancellationToken | None = None) -> None:
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        future = asyncio.get_running_loop().create_future()
+        if cancellation_token is not None:
+            # A cancelled turn leaves the queue without ever reaching the provider.
+            cancellation_token.link_future(future)
+        heapq.heappush(self._queue, (priority, next(self._sequence), future))
+        self._update_gauges()
+        self._wakeup.set()
+        started = time.perf_counter()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release()  # The slot was granted just as the caller gave up
+            self._update_gauges()
+            raise
+        QUEUE_WAIT.observe(time.perf_counter() - started, priority=PRIORITY_NAMES.get(priority, str(priority)))
+
+    def _release(self) -> None:
+        self._active -= 1
+        self._update_gauges()
+        self._wakeup.set()
+
+    def _backoff(self, error: Exception, attempt: int) -> float:
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, retry_after + random.uniform(0, self.backoff_base))
+        if getattr(error, "status_code", None) == 429:
+            # Everyone waits out the limit, not only this request.
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            self.bucket.drain()
+        return delay
+
+    def _should_retry(self, error: Exception, attempt: int) -> bool:
+        reason = _retry_reason(error)
+        if reason is None or attempt >= self.max_retries:
+            return False
+        SCHEDULER_RETRIES.inc(reason=reason, model=self.model)
+        return True
+
+    async def run(
+        self, priority: int, call: Callable[[], Awaitable[T]], cancellation_token: CancellationToken | None = None
+    ) -> T:
+        """Runs `await call()` in a slot, retrying it on retryable errors until `cancellation_token` is cancelled."""
+        for attempt in itertools.count():
+            await self._acquire(priority, cancellation_token)
+            try:
+                return await _cancellable(call(), cancellation_token)
+            except Exception as e:
+                if not self._should_retry(e, attempt):
+                    raise
+                delay = self._backoff(e, attempt)
+                print(f"⚠️ Model request failed ({type(e).__name__}); retry {attempt + 1} in {delay:.1f}s")
+            finally:
+                self._release()
+            await _cancellable(asyncio.sleep(delay), cancellation_token)
+
+    async def stream(
+        self, priority: int, call: Callable[[], AsyncGenerator], cancellation_token: CancellationToken | None = None
+    ) -> AsyncGenerator:
+        """Like run() for a stream; only retried if it fails before its first chunk."""
+        for attempt in itertools.count():
+            await self._acquire(priority, cancellation_token)
+            started = False
+            try:
+                async for chunk in call():
+                    started = True
+                    yield chunk
+                return
+            except Exception as e:
+                if started or not self._should_retry(e, attempt):
+                    raise
+                delay = self._backoff(e, attempt)
+                print(f"⚠️ Model stream failed ({type(e).__name__}); retry {attempt + 1} in {delay:.1f}s")
+            finally:
+                self._release()
+            await _cancellable(asyncio.sleep(delay), cancellation_token)
+
+    def stats(self) -> dict:
+        return {
+            "queued": sum(1 for _, _, future in self._queue if not future.done()),
+            "in_flight": self._active,
+            "paused_s": round(max(self._paused_until - time.monotonic(), 0.0), 2),
+        }
+
+
+_SCHEDULERS: dict[str, ModelScheduler] = {}
+
+
+def get_scheduler(model: str = config.MODEL_NAME) -> ModelScheduler:
+    if model not in _SCHEDULERS:
+        _SCHEDULERS[model] = ModelScheduler(model)
+    return _SCHEDULERS[model]
@@ -0,0 +1,610 @@
+# core/sessions.py
+import asyncio
+import os
+import re
+import sqlite3
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict, deque
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from pydantic import BaseModel, Field
+
+from agents.team import create_agent_team
+from core import config, memory, tools
+from core.environment import snapshot_provider
+from core.model_pool import get_model_pool
+from core.persistence import delete_state_file, load_state_file, save_state_file
+from core.personas import get_persona_index
+from core.response_cache import persona_key
+from core.uploads import get_upload_store
+from core.tracing import record_span
+
+STATE_DIR = Path("state")
+# Teams spilled while their session is still open; one file per session, never shared.
+SPILL_DIR = STATE_DIR / "sessions"
+
+
+def get_state_path(character_name: str) -> Path:
+    safe_name = re.sub(r'[^a-zA-Z0-9_-]', '', character_name.lower().replace(' ', '_'))
+    return STATE_DIR / f"{safe_name}_state.json"
+
+
+def get_spill_path(session_id: str) -> Path:
+    return SPILL_DIR / f"{session_id}.json"
+
+
+class SessionRecord(BaseModel):
+    """Everything needed to rebuild a session's team on any worker."""
+    session_id: str
+    name: str
+    background: str
+    behavior: str
+    npc_mood: str = "neutral"
+    npc_inventory: list[str] = Field(default_factory=list)
+    context_files: dict[str, str | None] = Field(default_factory=dict)  # story, csharp, image
+    is_new_session: bool = True
+    connected: bool = False  # A websocket has attached to this session at least once
+    spilled: bool = False  # The team was evicted to state/ and must be resumed from there
+    # This session's own spill file; the persona's state file is only written when the session ends.
+    spill_path: str | None = None
+    # In-flight team state, set when a session is handed off without a saved state file.
+    team_state: dict | None = None
+    created_at: float = Field(default_factory=time.time)
+    updated_at: float = Field(default_factory=time.time)
+
+    @property
+    def persona(self) -> dict:
+        return {"name": self.name, "background": self.background, "behavior": self.behavior}
+
+
+class SessionStore(ABC):
+    """Where session records live between /initialize and /ws/{session_id}."""
+
+    @abstractmethod
+    async def get(self, session_id: str) -> SessionRecord | None: ...
+
+    @abstractmethod
+    async def save(self, record: SessionRecord) -> None: ...
+
+    @abstractmethod
+    async def delete(self, session_id: str) -> None: ...
+
+    @abstractmethod
+    async def list_ids(self) -> list[str]: ...
+
+
+class InMemorySessionStore(SessionStore):
+    """Single-process store; records are only visible to this worker."""
+
+    def __init__(self):
+        self._records: dict[str, str] = {}
+
+    async def get(self, session_id: str) -> SessionRecord | None:
+        raw = self._records.get(session_id)
+        return SessionRecord.model_validate_json(raw) if raw else None
+
+    async def save(self, record: SessionRecord) -> None:
+        record.updated_at = time.time()
+        self._records[record.session_id] = record.model_dump_json()
+
+    async def delete(self, session_id: str) -> None:
+        self._records.pop(session_id, None)
+
+    async def list_ids(self) -> list[str]:
+        return list(self._records)
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Store shared by every worker on the host through one SQLite file.
+    Calls run in a worker thread so the event loop never blocks on the database.
+    """
+
+    def __init__(self, db_path: str):
+        self._db_path = db_path
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "session_id TEXT PRIMARY KEY, record TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self._db_path, timeout=30)
+
+    def _get(self, session_id: str) -> SessionRecord | None:
+        with self._connect() as conn:
+            row = conn.execute("SELECT record FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return SessionRecord.model_validate_json(row[0]) if row else None
+
+    def _save(self, record: SessionRecord) -> None:
+        record.updated_at = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, record, updated_at) VALUES (?, ?, ?)",
+                (record.session_id, record.model_dump_json(), record.updated_at),
+            )
+
+    def _delete(self, session_id: str) -> None:
+        with self._connect() as conn:
+            conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    def _list_ids(self) -> list[str]:
+        with self._connect() as conn:
+            return [row[0] for row in conn.execute("SELECT session_id FROM sessions")]
+
+    async def get(self, session_id: str) -> SessionRecord | None:
+        return await asyncio.to_thread(self._get, session_id)
+
+    async def save(self, record: SessionRecord) -> None:
+        await asyncio.to_thread(self._save, record)
+
+    async def delete(self, session_id: str) -> None:
+        await asyncio.to_thread(self._delete, session_id)
+
+    async def list_ids(self) -> list[str]:
+        return await asyncio.to_thread(self._list_ids)
+
+
+_STORE: SessionStore | None = None
+
+
+def get_session_store() -> SessionStore:
+    """Returns the configured store (SESSION_STORE=memory|sqlite)."""
+    global _STORE
+    if _STORE is None:
+        if config.SESSION_STORE == "sqlite":
+            _STORE = SQLiteSessionStore(config.SESSION_DB_PATH)
+        elif config.SESSION_STORE == "memory":
+            _STORE = InMemorySessionStore()
+        else:
+            raise RuntimeError(f"Unknown SESSION_STORE '{config.SESSION_STORE}'. Use 'memory' or 'sqlite'.")
+    return _STORE
+
+
+@dataclass
+class LiveSession:
+    """The process-local, non-serializable half of a session."""
+    record: SessionRecord
+    team: object
+    npc_memory: object
+    rag_memory: object
+    model_client: object
+    all_tools: list = field(default_factory=list)
+    busy: bool = False  # A turn is running; never evicted while set
+    last_active: float = field(default_factory=time.time)
+    # False until load_history(); an unloaded team has nothing new to save.
+    history_loaded: bool = True
+    history_lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+
+async def rehydrate_session(record: SessionRecord) -> LiveSession:
+    """
+    Builds the agent team for a stored session record on this worker. The
+    team starts without history; load_history() adds it before the first turn.
+    """
+    model_client = get_model_pool().lease(record.session_id)
+    try:
+        story_path = record.context_files.get("story")
+        csharp_path = record.context_files.get("csharp")
+        npc_memory = memory.setup_short_term_memory()
+        rag_memory = memory.setup_rag_memory(sources=[story_path])
+        all_tools = tools.get_tools(
+            npc_config=record.persona,
+            npc_memory=npc_memory,
+            rag_memory=rag_memory,
+            csharp_file_path_from_main=csharp_path,
+        )
+        npc_team = create_agent_team(
+            model_client,
+            record.persona,
+            npc_memory,
+            all_tools,
+            stream_responses=config.NPC_STREAMING,
+            environment_context=snapshot_provider(csharp_path) if config.ENV_SNAPSHOT_IN_PROMPT else None,
+        )
+    except Exception:
+        await model_client.close()
+        raise
+
+    return LiveSession(
+        record=record,
+        team=npc_team,
+        npc_memory=npc_memory,
+        rag_memory=rag_memory,
+        model_client=model_client,
+        all_tools=all_tools,
+        history_loaded=record.is_new_session and record.team_state is None,
+    )
+
+
+async def load_history(live: LiveSession) -> None:
+    """
+    Loads the session's history into its team, once: the record's in-flight
+    team state if present, then its spill file, otherwise the NPC's saved
+    state file.
+    """
+    async with live.history_lock:
+        if live.history_loaded:
+            return
+        record = live.record
+        team_state = record.team_state
+        if team_state is None and not record.is_new_session:
+            state_path = record.spill_path or get_state_path(record.name)
+            if os.path.exists(state_path):
+                state_json = await asyncio.to_thread(load_state_file, state_path)
+                team_state = state_json.get("team_state")
+        if team_state:
+            await live.team.load_state(team_state)
+            print(f"✅ State for '{record.name}' loaded into session {record.session_id}.")
+        live.history_loaded = True
+
+
+async def save_session_state(live: LiveSession, state_path: Path | None = None) -> Path:
+    """
+    Writes the session's persona, context files and team state to state/:
+    the persona's state file, or `state_path` (a spill file) if given.
+    Only messages that are new since the last save are appended to disk.
+    """
+    record = live.record
+    spilling = state_path is not None
+    state_path = state_path or get_state_path(record.name)
+    team_state = await live.team.save_state()
+    full_session_state = {
+        "persona": record.persona,
+        "context_files": {
+            "csharp": record.context_files.get("csharp"),
+            "story": record.context_files.get("story"),
+        },
+        "team_state": team_state,
+        "npc_mood": record.npc_mood,
+        "npc_inventory": record.npc_inventory,
+    }
+    started = time.perf_counter()
+    await asyncio.to_thread(save_state_file, state_path, full_session_state)
+    if not spilling:
+        # Keeps /avatars current without it ever opening state files.
+        await asyncio.to_thread(get_persona_index().upsert, record.persona, str(state_path))
+    elapsed = time.perf_counter() - started
+    record_span("state", "save", elapsed)
+    print(f"DEBUG: Saved state for '{record.name}' in {elapsed * 1000:.1f} ms")
+    return state_path
+
+
+async def release_session(live: LiveSession) -> None:
+    """Frees a live session's per-process resources; shared pools stay open."""
+    await live.rag_memory.close()
+    usage = get_model_pool().session_usage(live.record.session_id)
+    if usage:
+        print(f"Model usage for session {live.record.session_id}: {usage}")
+    # Returns the lease only; the shared client pool stays open.
+    await live.model_client.close()
+
+
+class SessionManager:
+    """
+    Bounds how many sessions this worker keeps in memory.
+
+    - Records whose websocket never connects are dropped after `unconnected_ttl`.
+    - Connected sessions are closed after `idle_timeout` seconds without a
+      message (enforced by the websocket loop, see `idle_timeout`).
+    - At most `max_resident` teams stay loaded; the least recently used idle
+      team is spilled to its own file in state/sessions/ via
+      save_session_state() and rehydrated on its next message; the
+      persona's state file is only written when the session ends.
+    - Teams are built in the background after create() and history is only
+      loaded for the first turn; the `warm_templates` personas with the most
+      sessions in the last `warm_window` seconds keep a team prebuilt.
+    """
+
+    def __init__(
+        self,
+        store: SessionStore,
+        max_resident: int,
+        unconnected_ttl: float,
+        idle_timeout: float,
+        warm_templates: int = config.SESSION_WARM_TEMPLATES,
+        warm_window: float = config.SESSION_WARM_WINDOW,
+    ):
+        self.store = store
+        self.max_resident = max_resident
+        self.unconnected_ttl = unconnected_ttl
+        self.idle_timeout = idle_timeout
+        self.warm_templates = warm_templates
+        self.warm_window = warm_window
+        self._live: OrderedDict[str, LiveSession] = OrderedDict()
+        self._building: dict[str, asyncio.Task] = {}
+        self._background: set[asyncio.Task] = set()
+        # Persona key -> prebuilt team not yet bound to a session.
+        self._templates: dict[str, LiveSession] = {}
+        self._recent: deque[tuple[float, str]] = deque()
+        self._persona_specs: dict[str, tuple[dict, dict]] = {}
+        self._refill_task: asyncio.Task | None = None
+        self._sweeper: asyncio.Task | None = None
+        self.counters = {
+            "created": 0,
+            "closed": 0,
+            "resumed": 0,
+            "evicted_ttl": 0,
+            "evicted_idle": 0,
+            "evicted_lru": 0,
+            "template_hits": 0,
+        }
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return task
+
+    async def create(self, record: SessionRecord) -> None:
+        await self.store.save(record)
+        self.counters["created"] += 1
+        key = persona_key(record.persona, record.context_files)
+        self._recent.append((time.time(), key))
+        self._persona_specs[key] = (record.persona, {k: v for k, v in record.context_files.items() if k != "image"})
+        # Records in a shared store may be picked up by another worker; only prebuild when this one owns them.
+        if config.SESSION_PREBUILD and isinstance(self.store, InMemorySessionStore):
+            self._spawn(self._prebuild(record.session_id))
+        if self.warm_templates > 0 and (self._refill_task is None or self._refill_task.done()):
+            self._refill_task = self._spawn(self._refill_templates())
+
+    async def _prebuild(self, session_id: str) -> None:
+        try:
+            await self.get_live(session_id, with_history=False)
+        except Exception as e:
+            print(f"⚠️ Background team build for session {session_id} failed: {e}")
+
+    async def connect(self, session_id: str) -> SessionRecord | None:
+        """Marks a stored session as connected so the TTL sweep leaves it alone."""
+        record = await self.store.get(session_id)
+        if record is not None and not record.connected:
+            record.connected = True
+            await self.store.save(record)
+        return record
+
+    async def get_live(self, session_id: str, with_history: bool = True, busy: bool = False) -> LiveSession | None:
+        """
+        Returns the resident team for a session, building it (or joining a
+        build already in progress) if needed. History is loaded unless
+        `with_history` is False. With `busy`, the team is marked busy before
+        anything else can run, so it cannot be spilled; the caller clears it.
+        """
+        while True:
+            live = self._live.get(session_id)
+            if live is None:
+                task = self._building.get(session_id)
+                if task is None:
+                    task = self._building[session_id] = asyncio.create_task(self._load(session_id))
+                    task.add_done_callback(lambda _: self._building.pop(session_id, None))
+                live = await asyncio.shield(task)
+                if live is None:
+                    return None
+            # Another session's load may have spilled it again before this caller resumed.
+            if self._live.get(session_id) is live:
+                break
+        if busy:
+            live.busy = True
+        self._live.move_to_end(session_id)
+        live.last_active = time.time()
+        if with_history:
+            # An interrupted turn must not leave the team half-loaded.
+            await asyncio.shield(load_history(live))
+        return live
+
+    async def _load(self, session_id: str) -> LiveSession | None:
+        record = await self.store.get(session_id)
+        if record is None:
+            return None
+        live = await self._take_template(record) or await rehydrate_session(record)
+        if record.spilled:
+            record.spilled = False
+            self.counters["resumed"] += 1
+            print(f"♻️ Resumed spilled session {session_id} for '{record.name}'.")
+        self._live[session_id] = live
+        await self._enforce_resident_cap(keep=session_id)
+        return live
+
+    async def _take_template(self, record: SessionRecord) -> LiveSession | None:
+        key = persona_key(record.persona, record.context_files)
+        live = self._templates.pop(key, None)
+        if live is None:
+            return None
+        get_model_pool().rekey(live.record.session_id, record.session_id)
+        live.record = record
+        live.history_loaded = record.is_new_session and record.team_state is None
+        live.last_active = time.time()
+        self.counters["template_hits"] += 1
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = self._spawn(self._refill_templates())
+        return live
+
+    def popular_personas(self) -> list[str]:
+        """Persona keys with the most sessions created within the warm window."""
+        cutoff = time.time() - self.warm_window
+        while self._recent and self._recent[0][0] < cutoff:
+            self._recent.popleft()
+        counts = Counter(key for _, key in self._recent)
+        for key in [k for k in self._persona_specs if k not in counts]:
+            del self._persona_specs[key]
+        return [
+            key for key, count in counts.most_common(self.warm_templates)
+            if count >= config.SESSION_WARM_MIN_SESSIONS
+        ]
+
+    async def _refill_templates(self) -> None:
+        popular = self.popular_personas()
+        for key in [k for k in self._templates if k not in popular]:
+            await release_session(self._templates.pop(key))
+        for key in popular:
+            if key in self._templates or key not in self._persona_specs:
+                continue
+            persona, context_files = self._persona_specs[key]
+            record = SessionRecord(session_id=f"template-{uuid.uuid4().hex}", context_files=context_files, **persona)
+            try:
+                self._templates[key] = await rehydrate_session(record)
+                print(f"♻️ Prebuilt a team template for popular persona '{persona['name']}'.")
+            except Exception as e:
+                print(f"⚠️ Could not prebuild a team for '{persona['name']}': {e}")
+            # Builds run on the event loop; let queued requests through between them.
+            await asyncio.sleep(0)
+
+    async def _enforce_resident_cap(self, keep: str | None = None) -> None:
+        # `keep` is the session being loaded for a caller. When every other team is busy,
+        # the table stays over the cap until a later load finds one idle.
+        while len(self._live) > self.max_resident:
+            victim = next((sid for sid, live in self._live.items() if not live.busy and sid != keep), None)
+            if victim is None:
+                return
+            await self.spill(victim)
+            self.counters["evicted_lru"] += 1
+
+    async def spill(self, session_id: str) -> None:
+        """Saves a resident team to state/ and frees it; the record stays in the store."""
+        live = self._live.pop(session_id, None)
+        if live is None:
+            return
+        record = live.record
+        if live.history_loaded:
+            try:
+                spill_path = get_spill_path(session_id)
+                await asyncio.to_thread(spill_path.parent.mkdir, parents=True, exist_ok=True)
+                await save_session_state(live, spill_path)
+                record.spill_path = str(spill_path)
+                record.is_new_session = False
+                record.team_state = None
+                record.spilled = True
+            except Exception as e:
+                # Keep the history with the record so nothing is lost.
+                print(f"⚠️ Could not spill session {session_id} to state/: {e}")
+                record.team_state = await live.team.save_state()
+        await self.store.save(record)
+        await release_session(live)
+        print(f"Spilled session {session_id} for '{record.name}' to state/.")
+
+    async def _settle_build(self, session_id: str) -> None:
+        task = self._building.get(session_id)
+        if task is not None:
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def close(self, session_id: str, idle: bool = False) -> None:
+        """Final save and release when a websocket ends."""
+        await self._settle_build(session_id)
+        live = self._live.pop(session_id, None)
+        if live is not None:
+            # A team whose history was never loaded has no new turns to save.
+            if live.history_loaded:
+                try:
+                    state_path = await save_session_state(live)
+                    print(f"✅ Session state for '{live.record.name}' saved to '{state_path}'")
+                except Exception as e:
+                    print(f"⚠️ Failed to save session state: {e}")
+            await release_session(live)
+            await self._release_uploads(live.record)
+            await self._drop_spill(live.record)
+        else:
+            record = await self.store.get(session_id)
+            if record is not None:
+                await self._release_uploads(record)
+                await self._drop_spill(record, keep_history=True)
+        await self.store.delete(session_id)
+        self.counters["evicted_idle" if idle else "closed"] += 1
+
+    async def _drop_spill(self, record: SessionRecord, keep_history: bool = False) -> None:
+        """Deletes the session's spill file; with `keep_history`, its state first becomes the persona's."""
+        if not record.spill_path:
+            return
+        spill_path, record.spill_path = Path(record.spill_path), None
+        try:
+            if keep_history and spill_path.exists():
+                state = await asyncio.to_thread(load_state_file, spill_path)
+                state_path = get_state_path(record.name)
+                await asyncio.to_thread(save_state_file, state_path, state)
+                await asyncio.to_thread(get_persona_index().upsert, record.persona, str(state_path))
+            await asyncio.to_thread(delete_state_file, spill_path)
+        except Exception as e:
+            print(f"⚠️ Could not retire spill file {spill_path}: {e}")
+
+    async def _release_uploads(self, record: SessionRecord) -> None:
+        # Shared files are only dropped by the upload store once nothing references them.
+        for file_path in record.context_files.values():
+            await get_upload_store().release(file_path)
+
+    async def sweep(self) -> None:
+        """Drops records whose websocket never connected within the TTL."""
+        now = time.time()
+        for session_id in await self.store.list_ids():
+            record = await self.store.get(session_id)
+            if record is None or record.connected:
+                continue
+            if now - record.created_at > self.unconnected_ttl:
+                await self._settle_build(session_id)
+                live = self._live.pop(session_id, None)
+                if live is not None:
+                    await release_session(live)
+                await self._release_uploads(record)
+                await self._drop_spill(record)
+                await self.store.delete(session_id)
+                self.counters["evicted_ttl"] += 1
+                print(f"Evicted unconnected session {session_id} for '{record.name}'.")
+
+    async def _sweep_forever(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sweep()
+                await get_upload_store().prune()
+                # Personas that fell out of the window give their templates back.
+                if self._refill_task is None or self._refill_task.done():
+                    self._refill_task = self._spawn(self._refill_templates())
+            except Exception as e:
+                print(f"⚠️ Session sweep failed: {e}")
+
+    def start(self, interval: float) -> None:
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_forever(interval))
+
+    async def shutdown(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        for task in list(self._background):
+            task.cancel()
+        await asyncio.gather(*self._background, *self._building.values(), return_exceptions=True)
+        for session_id in list(self._live):
+            await self.spill(session_id)
+        if isinstance(self.store, InMemorySessionStore):
+            # These records die with the process; their spilled history goes to the personas' files.
+            for session_id in await self.store.list_ids():
+                record = await self.store.get(session_id)
+                if record is not None:
+                    await self._drop_spill(record, keep_history=True)
+        for key in list(self._templates):
+            await release_session(self._templates.pop(key))
+
+    def stats(self) -> dict:
+        return {
+            "live": len(self._live),
+            "building": len(self._building),
+            "templates": len(self._templates),
+            **self.counters,
+        }
+
+
+_MANAGER: SessionManager | None = None
+
+
+def get_session_manager() -> SessionManager:
+    global _MANAGER
+    if _MANAGER is None:
+        _MANAGER = SessionManager(
+            get_session_store(),
+            max_resident=config.SESSION_MAX_RESIDENT,
+            unconnected_ttl=config.SESSION_UNCONNECTED_TTL,
+            idle_timeout=config.SESSION_IDLE_TIMEOUT,
+        )
+    return _MANAGER
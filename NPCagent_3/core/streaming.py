@@ -0,0 +1,72 @@
+# core/streaming.py
+import json
+import re
+
+_ESCAPES = {
+    '"': '"', "\\": "\\", "/": "/",
+    "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t",
+}
+
+
+class JsonFieldStreamer:
+    """
+    Incrementally extracts one string field from a JSON object that is still
+    being generated, e.g. the NPC's "response" while the model streams tokens.
+
+    feed() takes raw model chunks and returns only the newly decoded characters
+    of the field's value; it returns "" until the field starts and after it ends.
+    """
+
+    def __init__(self, field: str = "response"):
+        self._key_pattern = re.compile(r'(?<!\\)"' + re.escape(field) + r'"\s*:\s*"')
+        self._buffer = ""
+        self._pos = 0  # Index into _buffer of the next undecoded value char
+        self._started = False
+        self.done = False
+        self.text = ""
+
+    def feed(self, chunk: str) -> str:
+        if self.done or not chunk:
+            return ""
+        self._buffer += chunk
+
+        if not self._started:
+            match = self._key_pattern.search(self._buffer)
+            if not match:
+                return ""
+            self._started = True
+            self._pos = match.end()
+
+        out = []
+        buf = self._buffer
+        i = self._pos
+        while i < len(buf):
+            ch = buf[i]
+            if ch == '"':
+                self.done = True
+                i += 1
+                break
+            if ch != "\\":
+                out.append(ch)
+                i += 1
+                continue
+            # Escape sequence: wait for the rest of it if it is split across chunks.
+            if i + 1 >= len(buf):
+                break
+            esc = buf[i + 1]
+            if esc == "u":
+                if i + 6 > len(buf):
+                    break
+                try:
+                    out.append(json.loads(f'"{buf[i:i + 6]}"'))
+                except json.JSONDecodeError:
+                    pass
+                i += 6
+            else:
+                out.append(_ESCAPES.get(esc, esc))
+                i += 2
+        self._pos = i
+
+        new_text = "".join(out)
+        self.text += new_text
+        return new_text
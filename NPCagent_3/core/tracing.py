@@ -0,0 +1,254 @@
+# core/tracing.py
+import asyncio
+import functools
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+
+from opentelemetry import trace as otel_trace
+
+_tracer = otel_trace.get_tracer("pixel_minds")
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+
+
+class Histogram:
+    """Prometheus-style cumulative histogram with a fixed label set per series."""
+
+    def __init__(self, name: str, help_text: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self._series: dict[tuple, dict] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        series = self._series.setdefault(key, {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series["counts"][i] += 1
+        series["sum"] += value
+        series["count"] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, series in self._series.items():
+            for bound, count in zip(self.buckets, series["counts"]):
+                lines.append(f'{self.name}_bucket{_labels(key, le=bound)} {count}')
+            lines.append(f'{self.name}_bucket{_labels(key, le="+Inf")} {series["count"]}')
+            lines.append(f"{self.name}_sum{_labels(key)} {series['sum']:.6f}")
+            lines.append(f"{self.name}_count{_labels(key)} {series['count']}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_labels(key)} {value}" for key, value in self._values.items()]
+        return lines
+
+
+class Gauge:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._values: dict[tuple, float] = {}
+
+    def set(self, value: float, **labels) -> None:
+        self._values[tuple(sorted(labels.items()))] = value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        lines += [f"{self.name}{_labels(key)} {value}" for key, value in self._values.items()]
+        return lines
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(key: tuple, **extra) -> str:
+    items = list(key) + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+
+# Metric labels name a role, never a persona: persona names are player input
+# and each one would add new series. Agent names other than these are the NPC.
+AGENT_ROLES = {
+    "selector": "selector",
+    "summarizer": "summarizer",
+    "session": "session",
+    "story_agent": "specialist",
+    "CodeAnalyzerAgent": "specialist",
+    "VisionAgent": "specialist",
+}
+
+
+def role_label(name: str) -> str:
+    return AGENT_ROLES.get(name, "npc")
+
+
+REGISTRY: list = []
+
+
+def register(metric):
+    REGISTRY.append(metric)
+    return metric
+
+
+TURN_DURATION = register(Histogram("npc_turn_duration_seconds", "Wall time of one player turn (npc_team.run)."))
+TURNS_INTERRUPTED = register(Counter(
+    "npc_turns_interrupted_total",
+    "Player turns cancelled before their reply was sent, by reason (message, interrupt, disconnect).",
+))
+SPAN_DURATION = register(Histogram("npc_span_duration_seconds", "Duration of traced steps by kind and name."))
+LLM_TOKENS = register(Histogram("npc_llm_tokens", "Tokens per model request.", buckets=TOKEN_BUCKETS))
+LLM_RETRIES = register(Counter("npc_llm_retries_total", "HTTP retries made by the model client."))
+LLM_ERRORS = register(Counter("npc_llm_errors_total", "Model requests that raised."))
+EVENT_LOOP_LAG = register(Gauge("npc_event_loop_lag_seconds", "Latest measured event-loop scheduling delay."))
+
+
+def render_metrics(extra_gauges: dict[str, float] | None = None) -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    for name, value in (extra_gauges or {}).items():
+        lines += [f"# TYPE {name} gauge", f"{name} {value}"]
+    return "\n".join(lines) + "\n"
+
+
+@dataclass
+class TurnTrace:
+    """All spans recorded while handling one player message."""
+    session_id: str
+    started: float = field(default_factory=time.perf_counter)
+    spans: list = field(default_factory=list)
+    interrupted: bool = False  # Cancelled by a newer player message before its reply was sent
+    effects: list = field(default_factory=list)  # What tools changed outside the agents; not undone by a rollback
+
+    def summary(self) -> dict:
+        return {
+            "type": "trace",
+            "session_id": self.session_id,
+            "turn_ms": round((time.perf_counter() - self.started) * 1000, 1),
+            "interrupted": self.interrupted,
+            "effects": self.effects,
+            "spans": self.spans,
+        }
+
+
+@dataclass
+class Span:
+    kind: str
+    name: str
+    attributes: dict = field(default_factory=dict)
+    http_attempts: int = 0
+
+
+current_trace: ContextVar[TurnTrace | None] = ContextVar("current_trace", default=None)
+_current_span: ContextVar[Span | None] = ContextVar("current_span", default=None)
+
+
+@contextmanager
+def traced(kind: str, name: str, **attributes):
+    """
+    Times a step (kind: turn, selector, agent, tool, llm) into the metrics,
+    an OpenTelemetry span and the current TurnTrace if one is active.
+    """
+    span = Span(kind=kind, name=name, attributes=dict(attributes))
+    token = _current_span.set(span)
+    started = time.perf_counter()
+    error = None
+    with _tracer.start_as_current_span(f"{kind}:{name}") as otel_span:
+        try:
+            yield span
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            try:
+                _current_span.reset(token)
+            except ValueError:
+                # Async generator closed from another context; nothing to restore.
+                pass
+            duration = time.perf_counter() - started
+            SPAN_DURATION.observe(duration, kind=kind, name=name)
+            for key, value in span.attributes.items():
+                if isinstance(value, (str, int, float, bool)):
+                    otel_span.set_attribute(key, value)
+            if error:
+                otel_span.set_attribute("error", error)
+            trace = current_trace.get()
+            if trace is not None:
+                entry = {"kind": kind, "name": name, "ms": round(duration * 1000, 1), **span.attributes}
+                if error:
+                    entry["error"] = error
+                trace.spans.append(entry)
+
+
+def record_span(kind: str, name: str, duration: float, **attributes) -> None:
+    """Records a step whose start and end were observed separately (e.g. from a message stream)."""
+    SPAN_DURATION.observe(duration, kind=kind, name=name)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.spans.append({"kind": kind, "name": name, "ms": round(duration * 1000, 1), **attributes})
+
+
+def record_llm_result(span: Span, usage) -> None:
+    span.attributes["prompt_tokens"] = usage.prompt_tokens
+    span.attributes["completion_tokens"] = usage.completion_tokens
+    LLM_TOKENS.observe(usage.prompt_tokens, kind="prompt", name=span.name)
+    LLM_TOKENS.observe(usage.completion_tokens, kind="completion", name=span.name)
+    retries = max(span.http_attempts - 1, 0)
+    span.attributes["retries"] = retries
+    if retries:
+        LLM_RETRIES.inc(retries, name=span.name)
+
+
+async def on_http_request(request) -> None:
+    """httpx request hook: counts attempts (including SDK retries) for the active model span."""
+    span = _current_span.get()
+    if span is not None and span.kind == "llm":
+        span.http_attempts += 1
+
+
+def record_effect(description: str) -> None:
+    """Notes a lasting change made by a tool (e.g. "set 'Door' to 'Open'") on the current turn."""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.effects.append(description)
+
+
+def traced_tool(func):
+    """Wraps an async tool function so each invocation is recorded as a 'tool' span."""
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with traced("tool", func.__name__):
+            return await func(*args, **kwargs)
+
+    return wrapper
+
+
+async def monitor_event_loop_lag(interval: float = 0.5) -> None:
+    """Measures how late the loop wakes a sleeping task; runs until cancelled."""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lag = max(loop.time() - expected, 0.0)
+        EVENT_LOOP_LAG.set(lag)
+        SPAN_DURATION.observe(lag, kind="loop", name="event_loop_lag")
@@ -0,0 +1,179 @@
+# core/uploads.py
+import asyncio
+import hashlib
+import os
+import sqlite3
+import time
+import uuid
+from pathlib import Path
+
+import aiofiles
+from fastapi import HTTPException, UploadFile
+
+from core import config
+
+CHUNK_SIZE = 1024 * 1024  # 1 MB
+
+
+class UploadStore:
+    """
+    Content-addressed store for player uploads.
+
+    Files are streamed to disk in chunks, hashed while streaming and kept as
+    `<sha256><ext>`, so the same story or environment uploaded by many players
+    is stored once. Sessions acquire()/release() references; a file is only
+    deleted by prune() once nothing references it and it has sat unused for
+    `orphan_ttl` seconds. The index is a small SQLite file so every worker
+    sees the same reference counts.
+    """
+
+    def __init__(self, upload_dir: Path, max_file_size: int, orphan_ttl: float):
+        self.upload_dir = upload_dir
+        self.max_file_size = max_file_size
+        self.orphan_ttl = orphan_ttl
+        self.upload_dir.mkdir(parents=True, exist_ok=True)
+        self._db_path = str(self.upload_dir / "index.sqlite3")
+        self._index_locks: dict[str, asyncio.Lock] = {}
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS blobs ("
+                "digest TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER NOT NULL, "
+                "refcount INTEGER NOT NULL DEFAULT 0, indexed INTEGER NOT NULL DEFAULT 0, "
+                "last_used REAL NOT NULL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self._db_path, timeout=30)
+
+    def digest_of(self, file_path: str | None) -> str | None:
+        """Returns the content hash for a path inside this store, else None."""
+        if not file_path:
+            return None
+        path = Path(file_path).resolve()
+        if path.parent != self.upload_dir.resolve():
+            return None
+        with self._connect() as conn:
+            row = conn.execute("SELECT digest FROM blobs WHERE digest = ?", (path.stem,)).fetchone()
+        return row[0] if row else None
+
+    async def save(self, upload_file: UploadFile) -> str:
+        """Streams an upload to disk off the event loop and returns its stored path."""
+        extension = Path(Path(upload_file.filename).name).suffix.lower() or ".dat"
+        temp_path = self.upload_dir / f".{uuid.uuid4().hex}.part"
+        hasher = hashlib.sha256()
+        size = 0
+        try:
+            async with aiofiles.open(temp_path, "wb") as buffer:
+                while chunk := await upload_file.read(CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > self.max_file_size:
+                        raise HTTPException(
+                            status_code=413,
+                            detail=f"File size exceeds the limit of {self.max_file_size / 1024 / 1024} MB.",
+                        )
+                    hasher.update(chunk)
+                    await buffer.write(chunk)
+            digest = hasher.hexdigest()
+            final_path = self.upload_dir / f"{digest}{extension}"
+            final_path = await asyncio.to_thread(self._commit, temp_path, final_path, digest, size)
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Could not save file: {e}")
+        finally:
+            await upload_file.close()
+            if temp_path.exists():
+                temp_path.unlink()
+        return str(final_path.resolve())
+
+    def _commit(self, temp_path: Path, final_path: Path, digest: str, size: int) -> Path:
+        with self._connect() as conn:
+            row = conn.execute("SELECT path FROM blobs WHERE digest = ?", (digest,)).fetchone()
+            if row and Path(row[0]).exists():
+                # Already stored; the temp copy is discarded by the caller.
+                conn.execute("UPDATE blobs SET last_used = ? WHERE digest = ?", (time.time(), digest))
+                print(f"♻️ Upload deduplicated: {Path(row[0]).name}")
+                return Path(row[0])
+            os.replace(temp_path, final_path)
+            conn.execute(
+                "INSERT OR REPLACE INTO blobs (digest, path, size, refcount, indexed, last_used) "
+                "VALUES (?, ?, ?, 0, 0, ?)",
+                (digest, str(final_path.resolve()), size, time.time()),
+            )
+        return final_path
+
+    def _adjust(self, digest: str, delta: int) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE blobs SET refcount = MAX(refcount + ?, 0), last_used = ? WHERE digest = ?",
+                (delta, time.time(), digest),
+            )
+
+    async def acquire(self, file_path: str | None) -> None:
+        digest = await asyncio.to_thread(self.digest_of, file_path)
+        if digest:
+            await asyncio.to_thread(self._adjust, digest, 1)
+
+    async def release(self, file_path: str | None) -> None:
+        digest = await asyncio.to_thread(self.digest_of, file_path)
+        if digest:
+            await asyncio.to_thread(self._adjust, digest, -1)
+
+    def _is_indexed(self, digest: str) -> bool:
+        with self._connect() as conn:
+            row = conn.execute("SELECT indexed FROM blobs WHERE digest = ?", (digest,)).fetchone()
+        return bool(row and row[0])
+
+    def _mark_indexed(self, digest: str) -> None:
+        with self._connect() as conn:
+            conn.execute("UPDATE blobs SET indexed = 1 WHERE digest = ?", (digest,))
+
+    async def index_once(self, file_path: str, index_func) -> None:
+        """
+        Runs `await index_func(file_path)` the first time a stored file is used;
+        once it returns True, later callers with the same content skip it. Files
+        outside the store are always indexed.
+        """
+        digest = await asyncio.to_thread(self.digest_of, file_path)
+        if digest is None:
+            await index_func(file_path)
+            return
+        lock = self._index_locks.setdefault(digest, asyncio.Lock())
+        async with lock:
+            if await asyncio.to_thread(self._is_indexed, digest):
+                print(f"♻️ Reusing existing index for {Path(file_path).name}")
+                return
+            if await index_func(file_path):
+                await asyncio.to_thread(self._mark_indexed, digest)
+
+    def _prune(self) -> int:
+        cutoff = time.time() - self.orphan_ttl
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT digest, path FROM blobs WHERE refcount = 0 AND last_used < ?", (cutoff,)
+            ).fetchall()
+            for digest, path in rows:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                conn.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+        return len(rows)
+
+    async def prune(self) -> int:
+        """Deletes unreferenced files that have been unused for longer than orphan_ttl."""
+        removed = await asyncio.to_thread(self._prune)
+        if removed:
+            print(f"✅ Pruned {removed} unreferenced upload(s).")
+        return removed
+
+
+_STORE: UploadStore | None = None
+
+
+def get_upload_store() -> UploadStore:
+    global _STORE
+    if _STORE is None:
+        _STORE = UploadStore(config.UPLOAD_DIR, config.MAX_UPLOAD_SIZE, config.UPLOAD_ORPHAN_TTL)
+    return _STORE
@@ -0,0 +1,92 @@
+# core/vision.py
+import asyncio
+import io
+from collections import OrderedDict
+
+from autogen_core import Image as AGImage
+from autogen_core.models import SystemMessage, UserMessage
+from PIL import Image, ImageOps
+
+from core import config
+from core.environment import file_digest
+from core.npc_response import extract_json_from_string
+from core.prompts import load_prompt
+from core.tracing import Counter, register, traced
+
+SCENE_PLACEHOLDER = "The scene is still being looked at; a description will follow shortly."
+SCENE_UNAVAILABLE = "The user did not provide a visual description of the scene."
+SCENE_EVENTS = register(Counter("npc_scene_descriptions_total", "Scene description requests by result (hit, described, failed)."))
+
+
+def downscale_image(image_path: str, max_size: int = config.VISION_MAX_SIZE, quality: int = config.VISION_JPEG_QUALITY) -> AGImage:
+    """Fits the image into max_size x max_size and re-encodes it as JPEG before it is sent to the model."""
+    with Image.open(image_path) as original:
+        image = ImageOps.exif_transpose(original).convert("RGB")
+    image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality, optimize=True)
+    buffer.seek(0)
+    return AGImage(Image.open(buffer))
+
+
+class SceneDescriptions:
+    """
+    Scene descriptions keyed by image content hash. Concurrent requests for the
+    same image share one model call, and a described image is never sent again.
+    """
+
+    def __init__(self, max_entries: int = config.VISION_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._descriptions: OrderedDict[str, str] = OrderedDict()
+        self._pending: dict[str, asyncio.Task] = {}
+
+    async def describe(self, image_path: str, model_client) -> str:
+        try:
+            digest = await asyncio.to_thread(file_digest, image_path)
+        except OSError as e:
+            print(f"⚠️ Could not read image {image_path}: {e}")
+            return SCENE_UNAVAILABLE
+        if digest in self._descriptions:
+            self._descriptions.move_to_end(digest)
+            SCENE_EVENTS.inc(result="hit")
+            return self._descriptions[digest]
+        task = self._pending.get(digest)
+        if task is None:
+            task = self._pending[digest] = asyncio.create_task(self._describe(digest, image_path, model_client))
+            task.add_done_callback(lambda _: self._pending.pop(digest, None))
+        # One session closing must not cancel a description other sessions are waiting for.
+        return await asyncio.shield(task)
+
+    async def _describe(self, digest: str, image_path: str, model_client) -> str:
+        with traced("vision", "describe"):
+            try:
+                image = await asyncio.to_thread(downscale_image, image_path)
+                result = await model_client.create([
+                    SystemMessage(content=load_prompt("vision_agent_system_message.txt")),
+                    UserMessage(content=["Describe this scene for me.", image], source="user"),
+                ])
+            except Exception as e:
+                SCENE_EVENTS.inc(result="failed")
+                print(f"⚠️ Could not describe image {image_path}: {e}")
+                return SCENE_UNAVAILABLE
+        raw = result.content if isinstance(result.content, str) else ""
+        data = extract_json_from_string(raw) if "{" in raw else None
+        description = data["response"] if data and "response" in data else raw.replace("APPROVE", "").strip()
+        if not description:
+            SCENE_EVENTS.inc(result="failed")
+            return SCENE_UNAVAILABLE
+        self._descriptions[digest] = description
+        while len(self._descriptions) > self.max_entries:
+            self._descriptions.popitem(last=False)
+        SCENE_EVENTS.inc(result="described")
+        return description
+
+
+_SCENES: SceneDescriptions | None = None
+
+
+def get_scene_descriptions() -> SceneDescriptions:
+    global _SCENES
+    if _SCENES is None:
+        _SCENES = SceneDescriptions()
+    return _SCENES
@@ -0,0 +1,130 @@
+# core/watcher.py
+import asyncio
+import os
+from dataclasses import dataclass
+
+from watchfiles import Change, awatch
+
+from core import config
+from core.environment import refresh_file, watch_directory
+from core.tracing import Counter, register
+from core.world_state import get_world_state
+
+FILE_RELOADS = register(Counter("npc_file_reloads_total", "Files reloaded after a change on disk, by kind and result."))
+
+
+@dataclass
+class EnvironmentChange:
+    """A C# environment script changed on disk and has been re-parsed."""
+    path: str  # Absolute
+    digest: str | None  # None: the file was deleted
+
+    def frame(self) -> dict:
+        return {"type": "environment_update", "version": (self.digest or "")[:12] or "none"}
+
+
+class FileWatcher:
+    """
+    Picks up designer edits while the server runs: C# scripts in
+    `environment_dir` and the world state file.
+
+    Bursts of changes (an editor saving, a script copying files) are
+    debounced into one reload. Files are re-read and re-parsed in a worker
+    thread and swapped in whole, so turns never read them: the snapshot cache
+    moves to the new digest, the world store replaces its objects and pushes
+    a resync to every session. The store's own write-backs are recognized by
+    their hash and ignored. Sessions using a changed C# script are told via
+    subscribe().
+    """
+
+    def __init__(
+        self,
+        environment_dir: str | os.PathLike = config.ENVIRONMENT_DIR,
+        world_state_path: str | os.PathLike = config.WORLD_STATE_PATH,
+        debounce_ms: int = config.FILE_WATCH_DEBOUNCE_MS,
+    ):
+        self.environment_dir = os.path.abspath(environment_dir)
+        self.world_state_path = os.path.abspath(world_state_path)
+        self.debounce_ms = debounce_ms
+        self._stop = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._subscribers: set[asyncio.Queue] = set()
+
+    def start(self) -> None:
+        if self._task is not None and not self._task.done():
+            return
+        dirs = sorted({d for d in (self.environment_dir, os.path.dirname(self.world_state_path)) if os.path.isdir(d)})
+        if not dirs:
+            return
+        if self.environment_dir in dirs:
+            watch_directory(self.environment_dir)
+        self._stop = asyncio.Event()
+        self._task = asyncio.create_task(self._run(dirs))
+        print(f"✅ Watching {', '.join(dirs)} for changes.")
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._stop.set()
+        await asyncio.wait({self._task})
+        self._task = None
+        # Without change events, digests have to be checked against the file again.
+        watch_directory(self.environment_dir, watched=False)
+
+    def subscribe(self) -> asyncio.Queue:
+        """A queue that receives every EnvironmentChange from now on. Call unsubscribe() when done."""
+        queue: asyncio.Queue = asyncio.Queue()
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        self._subscribers.discard(queue)
+
+    def _wanted(self, change: Change, path: str) -> bool:
+        # Temp files of atomic writes and anything else in data/ are skipped.
+        path = os.path.abspath(path)
+        if path == self.world_state_path:
+            return True
+        return os.path.dirname(path) == self.environment_dir and path.endswith(".cs")
+
+    async def _run(self, dirs: list[str]) -> None:
+        try:
+            async for changes in awatch(
+                *dirs,
+                watch_filter=self._wanted,
+                debounce=self.debounce_ms,
+                recursive=False,
+                stop_event=self._stop,
+            ):
+                await self._reload(sorted({os.path.abspath(path) for _, path in changes}))
+        except Exception as e:
+            print(f"⚠️ File watcher stopped, edits need a restart to be picked up: {e}")
+            watch_directory(self.environment_dir, watched=False)
+
+    async def _reload(self, paths: list[str]) -> None:
+        for path in paths:
+            kind = "world_state" if path == self.world_state_path else "environment"
+            try:
+                if kind == "world_state":
+                    if await get_world_state().reload():
+                        FILE_RELOADS.inc(kind=kind, result="ok")
+                    continue
+                digest = await asyncio.to_thread(refresh_file, path)
+            except Exception as e:
+                FILE_RELOADS.inc(kind=kind, result="failed")
+                print(f"⚠️ Could not reload {path}: {e}")
+                continue
+            FILE_RELOADS.inc(kind=kind, result="ok" if digest else "deleted")
+            print(f"♻️ Reloaded {os.path.basename(path)} ({(digest or 'deleted')[:12]}).")
+            for queue in self._subscribers:
+                queue.put_nowait(EnvironmentChange(path, digest))
+
+
+_WATCHER: FileWatcher | None = None
+
+
+def get_file_watcher() -> FileWatcher:
+    global _WATCHER
+    if _WATCHER is None:
+        _WATCHER = FileWatcher()
+    return _WATCHER
@@ -0,0 +1,210 @@
+# core/world_state.py
+import asyncio
+import hashlib
+import json
+import threading
+from collections import deque
+from dataclasses import dataclass
+from pathlib import Path
+
+from core import config
+from core.persistence import atomic_write
+from core.tracing import Counter, register
+
+WORLD_WRITES = register(Counter("npc_world_state_writes_total", "World state write-backs to disk, by result."))
+WORLD_FEED_DROPS = register(Counter("npc_world_feed_dropped_total", "World changes dropped for a subscriber that fell behind."))
+
+
+def object_key(name: str) -> str:
+    """Index key for an object name: case and whitespace do not matter."""
+    return " ".join(name.split()).casefold()
+
+
+@dataclass
+class WorldChange:
+    """One entry of the change feed. `seq` is the store version the change produced."""
+    seq: int
+    object: dict | None  # The object after the change; None: the whole world was reloaded
+
+    def frame(self) -> dict:
+        return {"type": "world_update", "seq": self.seq, "object": self.object}
+
+
+class WorldStateStore:
+    """
+    Process-wide world state: objects held in memory and indexed by name.
+
+    Reads never touch disk. Mutations are serialized per object and each one
+    bumps `version`. Changes are written back in batches, at most every
+    `flush_interval` seconds, by replacing the file atomically.
+
+    Every change is also published to subscribers (one queue per websocket
+    session) and kept in a short log, so a subscriber that missed some can
+    catch up with changes_since() instead of re-reading everything.
+    """
+
+    def __init__(
+        self,
+        path: str | Path = config.WORLD_STATE_PATH,
+        flush_interval: float = config.WORLD_STATE_FLUSH_INTERVAL,
+        history: int = config.WORLD_FEED_HISTORY,
+    ):
+        self.path = Path(path)
+        self.flush_interval = flush_interval
+        self.version = 0
+        self._objects: dict[str, dict] = {}  # Name key -> object, in file order
+        self._extra: dict = {}  # Other top-level keys of the file, written back unchanged
+        self._locks: dict[str, asyncio.Lock] = {}
+        # Readers may run in worker threads (snapshot building); this only guards the dict itself.
+        self._guard = threading.Lock()
+        self._dirty = False
+        self._writer: asyncio.Task | None = None
+        self._flush_lock = asyncio.Lock()
+        self._log: deque[WorldChange] = deque(maxlen=history)
+        self._subscribers: set[asyncio.Queue] = set()
+        self._disk_digest = ""  # sha256 of the file as last written or loaded, to tell own writes from edits
+
+    def _read(self) -> tuple[str, dict] | None:
+        """(sha256, data) of the file; None if it cannot be read. Blocking."""
+        try:
+            with open(self.path, "rb") as f:
+                raw = f.read()
+            return hashlib.sha256(raw).hexdigest(), json.loads(raw)
+        except FileNotFoundError:
+            return "", {}
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Could not read {self.path}, keeping the current world state: {e}")
+            return None
+
+    def _apply(self, digest: str, data: dict) -> None:
+        objects = {object_key(obj["Name"]): obj for obj in data.get("objects", []) if isinstance(obj.get("Name"), str)}
+        with self._guard:
+            self._objects = objects
+            self._extra = {k: v for k, v in data.items() if k != "objects"}
+            self._disk_digest = digest
+            self.version += 1
+            # Older changes do not lead to this state; anyone behind has to resync.
+            self._log.clear()
+            change = WorldChange(self.version, None)
+        self._publish(change)
+        print(f"✅ World state loaded: {len(objects)} object(s) from {self.path}.")
+
+    def load(self) -> None:
+        """(Re)reads the file, replacing everything in memory."""
+        read = self._read()
+        if read is not None:
+            self._apply(*read)
+
+    async def reload(self) -> bool:
+        """
+        load() for a file changed on disk, read in a worker thread. Does
+        nothing if the file is what this store last wrote or loaded.
+        """
+        read = await asyncio.to_thread(self._read)
+        if read is None or read[0] == self._disk_digest:
+            return False
+        self._apply(*read)
+        return True
+
+    def get(self, name: str) -> dict | None:
+        obj = self._objects.get(object_key(name))
+        return dict(obj) if obj is not None else None
+
+    def objects(self) -> list[dict]:
+        """A copy of all objects, in file order."""
+        with self._guard:
+            return [dict(obj) for obj in self._objects.values()]
+
+    def snapshot(self) -> tuple[int, list[dict]]:
+        """(version, objects) read together."""
+        with self._guard:
+            return self.version, [dict(obj) for obj in self._objects.values()]
+
+    def lock(self, name: str) -> asyncio.Lock:
+        """The lock serializing changes to one object; hold it for read-modify-write sequences."""
+        return self._locks.setdefault(object_key(name), asyncio.Lock())
+
+    async def update(self, name: str, **fields) -> dict:
+        """Sets fields on an object and schedules a write-back. Raises KeyError for an unknown object."""
+        async with self.lock(name):
+            key = object_key(name)
+            with self._guard:
+                if key not in self._objects:
+                    raise KeyError(name)
+                # Replaced, not mutated, so copies handed to readers never change under them.
+                obj = self._objects[key] = {**self._objects[key], **fields}
+                self.version += 1
+                change = WorldChange(self.version, obj)
+                self._log.append(change)
+            self._publish(change)
+            self._schedule_write()
+            return dict(obj)
+
+    def subscribe(self, maxsize: int = config.WORLD_FEED_HISTORY) -> asyncio.Queue:
+        """A queue that receives every WorldChange from now on. Call unsubscribe() when done."""
+        queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        self._subscribers.discard(queue)
+
+    def _publish(self, change: WorldChange) -> None:
+        for queue in self._subscribers:
+            try:
+                queue.put_nowait(change)
+            except asyncio.QueueFull:
+                # The subscriber sees a gap in `seq` and resyncs.
+                WORLD_FEED_DROPS.inc()
+
+    def changes_since(self, seq: int) -> list[WorldChange] | None:
+        """Changes after `seq`, oldest first; None if the log no longer reaches back that far."""
+        with self._guard:
+            if seq == self.version:
+                return []
+            if seq > self.version or not self._log or self._log[0].seq > seq + 1:
+                return None
+            return [change for change in self._log if change.seq > seq]
+
+    def _schedule_write(self) -> None:
+        self._dirty = True
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.create_task(self._write_behind())
+
+    async def _write_behind(self) -> None:
+        # Changes made while waiting (or while the previous write ran) go out in one write.
+        while self._dirty:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def _serialize(self) -> str:
+        with self._guard:
+            data = {**self._extra, "objects": list(self._objects.values())}
+        return json.dumps(data, indent=2, ensure_ascii=False)
+
+    async def flush(self) -> None:
+        """Writes pending changes now (also called on shutdown)."""
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            text = self._serialize()
+            try:
+                await asyncio.to_thread(atomic_write, self.path, text)
+                self._disk_digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+                WORLD_WRITES.inc(result="ok")
+            except OSError as e:
+                self._dirty = True
+                WORLD_WRITES.inc(result="failed")
+                print(f"⚠️ Could not write world state to {self.path}: {e}")
+
+
+_STORE: WorldStateStore | None = None
+
+
+def get_world_state() -> WorldStateStore:
+    global _STORE
+    if _STORE is None:
+        _STORE = WorldStateStore()
+        _STORE.load()
+    return _STORE
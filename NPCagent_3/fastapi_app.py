@@ -1,22 +1,20 @@
 # fastapi_app.py
 import sys
 import os
+import asyncio
 import json
-import shutil
+import time
 import uuid
-import re
 from pathlib import Path
 from dotenv import load_dotenv
 from core.config import get_valid_moods
 from fastapi import FastAPI, HTTPException, UploadFile, File, WebSocket, WebSocketDisconnect
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel, ValidationError
+from pydantic import BaseModel
 from autogen_core import CancellationToken
-from autogen_agentchat.messages import MultiModalMessage
-from autogen_core import Image as AGImage
-from PIL import Image
-from autogen_agentchat.state import BaseState
+from autogen_agentchat.base import TaskResult
+from autogen_agentchat.messages import ModelClientStreamingChunkEvent, SelectSpeakerEvent
 
 # --- IMPORTANT: Load environment variables at the very top ---
 load_dotenv()
@@ -25,10 +23,26 @@ load_dotenv()
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 try:
-    from core import config, memory, tools
-    from agents.team import create_agent_team
+    from core import config, memory
+    from core.model_pool import get_model_pool, close_model_pool
+    from core.streaming import JsonFieldStreamer
+    from core.sessions import STATE_DIR, SessionRecord, get_session_manager, get_state_path
+    from core.uploads import get_upload_store
+    from core.persistence import load_state_file
+    from core.personas import get_persona_index
+    from core.response_cache import get_response_cache, persona_key
+    from core.environment import SNAPSHOT_RULE, world_version
+    from core.world_state import get_world_state
+    from core.watcher import get_file_watcher
+    from core.router import classify_intent
+    from core.fanout import gather_specialist_data
+    from core.scheduler import PRIORITY_BACKGROUND
+    from core.vision import SCENE_PLACEHOLDER, SCENE_UNAVAILABLE, get_scene_descriptions
+    from core.prompts import TurnPrompt, load_prompt
+    from core.tracing import TURN_DURATION, TURNS_INTERRUPTED, TurnTrace, current_trace, monitor_event_loop_lag, record_span, render_metrics, role_label, traced
     from openai import InternalServerError, AuthenticationError
-    from core.config import NPCResponse # Import the Pydantic model
+    from core.npc_response import extract_json_from_string, final_agent_retry, parse_npc_response
+    from agents.team import get_npc_agent
 except ImportError as e:
     print(f"Error: A required module could not be imported. Please ensure core/ and agents/ are in the same directory: {e}")
     sys.exit(1)
@@ -37,11 +51,11 @@ except ImportError as e:
 app = FastAPI(title="AutoGen Character Chat API")
 
 # --- Global state management & File Paths ---
-SESSIONS = {}
-UPLOAD_DIR = Path("data/uploads")
+# Live teams on this worker and the shared session store behind them.
+SESSIONS = get_session_manager()
+UPLOAD_DIR = config.UPLOAD_DIR
 PUBLIC_DIR = Path("public")
-STATE_DIR = Path("state")
-MAX_FILE_SIZE = 10 * 1024 * 1024  # 10 MB file size limit
+MAX_FILE_SIZE = config.MAX_UPLOAD_SIZE
 
 # Create necessary directories on startup
 for d in [UPLOAD_DIR, PUBLIC_DIR, STATE_DIR]:
@@ -54,75 +68,33 @@ class CharacterInit(BaseModel):
     story_file_path: str | None = None
     csharp_file_path: str | None = None
     image_file_path: str | None = None
+    # Persona-wide: False stops every session of this persona answering from the response cache; None keeps the setting.
+    response_cache: bool | None = None
 
-def save_secure_upload(upload_file: UploadFile) -> str:
-    if upload_file.size > MAX_FILE_SIZE:
+async def save_secure_upload(upload_file: UploadFile) -> str:
+    if upload_file.size is not None and upload_file.size > MAX_FILE_SIZE:
         raise HTTPException(status_code=413, detail=f"File size exceeds the limit of {MAX_FILE_SIZE / 1024 / 1024} MB.")
-    
-    base_filename = Path(upload_file.filename).name
-    unique_id = uuid.uuid4().hex
-    extension = Path(base_filename).suffix or ".dat"
-    secure_filename = f"{unique_id}{extension}"
-    file_path = UPLOAD_DIR / secure_filename
-    
-    try:
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(upload_file.file, buffer)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Could not save file: {e}")
-    finally:
-        upload_file.file.close()
-        
-    return str(file_path.resolve())
-
-def get_state_path(character_name: str) -> Path:
-    safe_name = re.sub(r'[^a-zA-Z0-9_-]', '', character_name.lower().replace(' ', '_'))
-    return STATE_DIR / f"{safe_name}_state.json"
-
+    # Streamed and stored by content hash, so identical uploads share one file.
+    return await get_upload_store().save(upload_file)
 
 @app.get("/avatars")
-async def get_avatars():
-    avatars = []
+async def get_avatars(prefix: str | None = None, offset: int = 0, limit: int = 100):
+    """Saved personas from the persona index, filtered by name prefix and paginated."""
     try:
-        if not STATE_DIR.exists():
-            return JSONResponse(content=avatars)
-
-        seen = set()
-        for filename in os.listdir(STATE_DIR):
-            if not filename.endswith("_state.json"):
-                continue
-            fp = STATE_DIR / filename
-            try:
-                with open(fp, "r", encoding="utf-8") as f:
-                    state_data = json.load(f)
-            except Exception as e:
-                print(f"⚠️ Could not read/parse state file {filename}: {e}")
-                continue
-
-            persona = state_data.get("persona")
-            if not persona:
-                continue
-
-            name = str(persona.get("name", "")).strip()
-            if not name:
-                continue
-
-            normalized = name.lower()
-            if normalized in seen:
-                continue
-            seen.add(normalized)
-
-            avatars.append({
-                "name": name,
-                "background": persona.get("background", "") or "",
-                "behavior": persona.get("behavior", "") or ""
-            })
-        return JSONResponse(content=avatars)
+        offset = max(offset, 0)
+        limit = min(max(limit, 1), 500)
+        avatars, total = await asyncio.to_thread(get_persona_index().list, prefix, offset, limit)
+        return JSONResponse(content=avatars, headers={"X-Total-Count": str(total)})
     except Exception as e:
         print(f"‼️ Unexpected error in /avatars: {e}")
         return JSONResponse(content={"detail": "Server error while fetching avatars."}, status_code=500)
 
 
+@app.get("/sessions/stats")
+async def get_session_stats():
+    return SESSIONS.stats()
+
+
 @app.post("/upload")
 async def upload_file(file: UploadFile = File(...)):
     allowed_extensions = {".pdf", ".txt", ".cs", ".png", ".jpg", ".jpeg", ".webp"}
@@ -130,7 +102,7 @@ async def upload_file(file: UploadFile = File(...)):
     if extension not in allowed_extensions:
         raise HTTPException(status_code=400, detail=f"Invalid file type. Allowed: {', '.join(allowed_extensions)}")
         
-    file_path = save_secure_upload(file)
+    file_path = await save_secure_upload(file)
     return {"file_path": file_path}
 
 @app.post("/initialize")
@@ -139,11 +111,8 @@ async def initialize_character(init_data: CharacterInit):
     state_path = get_state_path(init_data.name)
     
     try:
-        api_key = config.get_api_key()
-        model_client = config.get_model_client(api_key)
-        npc_config = {
-            "name": init_data.name, "background": init_data.background, "behavior": init_data.behavior,
-        }
+        # Fail fast on a missing API key; the team itself is built when the websocket connects.
+        get_model_pool()
 
         is_new_session = not os.path.exists(state_path)
         
@@ -152,76 +121,58 @@ async def initialize_character(init_data: CharacterInit):
         
         if is_new_session:
             print(f"No existing state found for '{init_data.name}'. Creating new session.")
-            npc_memory = memory.setup_short_term_memory()
-            rag_memory = memory.setup_rag_memory()
             if story_path and Path(story_path).exists():
-                await memory.index_story_file(story_path, rag_memory)
+                rag_memory = memory.setup_rag_memory(sources=[story_path])
+                # The same story uploaded by many players is only chunked and embedded once.
+                await get_upload_store().index_once(
+                    story_path, lambda path: memory.index_story_file(path, rag_memory)
+                )
+                await rag_memory.close()
             if csharp_path and not Path(csharp_path).exists():
                 csharp_path = None
             npc_mood = "neutral"
             npc_inventory = []
         else:
             print(f"✅ Found existing state for '{init_data.name}'. Loading from '{state_path}'...")
-            with open(state_path, 'r') as f:
-                state_json = json.load(f)
+            # Only the snapshot is needed here; history is loaded with the first message.
+            state_json = await asyncio.to_thread(load_state_file, state_path, False)
             
             context_files = state_json.get("context_files", {})
             csharp_path = context_files.get("csharp")
             story_path = context_files.get("story")
-            npc_memory = memory.setup_short_term_memory()
-            rag_memory = memory.setup_rag_memory()
             npc_mood = state_json.get("npc_mood", "neutral")
             npc_inventory = state_json.get("npc_inventory", [])
 
-        all_tools = tools.get_tools(
-            npc_config=npc_config,
-            npc_memory=npc_memory,
-            rag_memory=rag_memory,
-            csharp_file_path_from_main=csharp_path
-        )
-        npc_team = create_agent_team(model_client, npc_config, npc_memory, all_tools)
-        
-        if not is_new_session:
-            await npc_team.load_state(state_json["team_state"])
-            print(f"✅ State for '{init_data.name}' loaded successfully.")
-
         image_path = init_data.image_file_path if init_data.image_file_path and Path(init_data.image_file_path).exists() else None
         
-        SESSIONS[session_id] = {
-            "team": npc_team,
-            "name": init_data.name,
-            "background": init_data.background,
-            "behavior": init_data.behavior,
-            "rag_memory": rag_memory,
-            "model_client": model_client,
-            "npc_mood": npc_mood,
-            "npc_inventory": npc_inventory,
-            "is_new_session": is_new_session,
-            "uploaded_files": {
+        record = SessionRecord(
+            session_id=session_id,
+            name=init_data.name,
+            background=init_data.background,
+            behavior=init_data.behavior,
+            npc_mood=npc_mood,
+            npc_inventory=npc_inventory,
+            is_new_session=is_new_session,
+            context_files={
                 "story": story_path,
                 "csharp": csharp_path,
                 "image": image_path,
             },
-            "all_tools": all_tools
-        }
+        )
+        if init_data.response_cache is not None:
+            await asyncio.to_thread(get_persona_index().set_response_cache, init_data.name, init_data.response_cache)
+        # Each session holds a reference to its uploads until it is closed.
+        for file_path in record.context_files.values():
+            await get_upload_store().acquire(file_path)
+        # Returns right away; the team is built in the background (or taken from a warm template).
+        await SESSIONS.create(record)
         return {"message": f"Character '{init_data.name}' initialized.", "session_id": session_id}
     except AuthenticationError:
          raise HTTPException(status_code=401, detail="Authentication failed. Check your API key.")
     except Exception as e:
-        if session_id in SESSIONS:
-            del SESSIONS[session_id]
+        await SESSIONS.store.delete(session_id)
         raise HTTPException(status_code=500, detail=f"Failed to initialize character: {str(e)}")
 
-def extract_json_from_string(text: str) -> dict | None:
-    match = re.search(r'\{[\s\S]*\}', text)
-    if match:
-        try:
-            return json.loads(match.group(0))
-        except json.JSONDecodeError:
-            print(f"⚠️ Failed to decode JSON from extracted string: {match.group(0)}")
-            return None
-    return None
-
 def debug_world_state():
     """Debug function to check world state file"""
     import os
@@ -247,230 +198,503 @@ def debug_world_state():
             json.dump(initial_state, f, indent=2)
         print(f"   Created initial world state file")
 
+async def run_team_turn(
+    websocket: WebSocket, npc_team, task, npc_name: str, cancellation_token: CancellationToken | None = None
+) -> tuple[TaskResult | None, bool]:
+    """
+    Runs one team turn via run_stream(), forwarding the NPC's "response" text to
+    the client as dialogue_delta frames while the model is still generating.
+    Selector and agent steps are timed from the SelectSpeakerEvents in the stream.
+    Cancelling `cancellation_token` aborts the agents' model calls.
+    Returns the final TaskResult and whether any delta was sent.
+    """
+    task_result = None
+    streamer = None
+    streamed = False
+    speaker = None
+    step_started = last_speaker_event = time.perf_counter()
+
+    def close_agent_step():
+        if speaker is not None:
+            record_span("agent", role_label(speaker), last_speaker_event - step_started, agent=speaker)
+
+    async for event in npc_team.run_stream(task=task, cancellation_token=cancellation_token):
+        now = time.perf_counter()
+        if isinstance(event, TaskResult):
+            task_result = event
+            close_agent_step()
+        elif isinstance(event, SelectSpeakerEvent):
+            close_agent_step()
+            # Time between the previous agent's last message and this event is the selector's.
+            selected = ", ".join(event.content)
+            record_span("selector", "selector", now - last_speaker_event, selected=selected)
+            speaker = selected
+            step_started = last_speaker_event = now
+        elif isinstance(event, ModelClientStreamingChunkEvent):
+            if event.source != npc_name:
+                continue
+            if streamer is None:
+                streamer = JsonFieldStreamer("response")
+            delta = streamer.feed(event.content)
+            if delta:
+                frame = {"type": "dialogue_delta", "message": delta}
+                if streamed and streamer.text == delta:
+                    # The NPC started a new message this turn; the client should start over.
+                    frame["reset"] = True
+                await websocket.send_text(json.dumps(frame))
+                streamed = True
+        if getattr(event, "source", None) == speaker:
+            last_speaker_event = now
+        if getattr(event, "source", None) == npc_name and not isinstance(event, ModelClientStreamingChunkEvent):
+            # A complete NPC message closes the current stream segment.
+            streamer = None
+    return task_result, streamed
+
+def world_sync_frame() -> dict:
+    version, objects = get_world_state().snapshot()
+    return {"type": "world_sync", "seq": version, "objects": objects}
+
+async def send_world_changes(websocket: WebSocket, since: str) -> None:
+    """Replays the world changes after seq `since`, or sends the whole world if they are no longer logged."""
+    changes = get_world_state().changes_since(int(since)) if since.isdigit() else None
+    if changes is None:
+        await websocket.send_text(json.dumps(world_sync_frame()))
+        return
+    for change in changes:
+        await websocket.send_text(json.dumps(change.frame()))
+
 @app.websocket("/ws/{session_id}")
 async def websocket_endpoint(websocket: WebSocket, session_id: str):
     await websocket.accept()
-    if session_id not in SESSIONS:
+    if await SESSIONS.connect(session_id) is None:
         await websocket.send_text("Error: Invalid session ID. Please initialize a character first.")
         await websocket.close()
         return
 
-    session = SESSIONS[session_id]
-    npc_team = session["team"]
-    image_path = session["uploaded_files"]["image"]
-    csharp_path = session["uploaded_files"]["csharp"]
-    is_new_session = session["is_new_session"]
-    initial_description = "The user did not provide a visual description of the scene."
-
+    # Rebuild the team on whichever worker received the websocket.
     try:
-        if image_path and is_new_session:
-            try:
-                pil_image = Image.open(image_path)
-                ag_image = AGImage(pil_image)
-                task_to_run = MultiModalMessage(source="user", content=["Describe this scene for me.", ag_image])
-                print(f"✅ Created MultiModalMessage task for session {session_id}")
-                
-                initial_description_result = await npc_team.run(task=task_to_run)
-                raw_vision_output = initial_description_result.messages[-1].content
-                
-                vision_data = extract_json_from_string(raw_vision_output)
-                if vision_data and "response" in vision_data:
-                    initial_description = vision_data["response"]
-                else:
-                    initial_description = raw_vision_output.replace("APPROVE", "").strip()
-                print(f"Initial scene description: {initial_description}")
-            except Exception as e:
-                print(f"⚠️ Could not process image file {image_path}: {e}")
-        
-        print("INFO:     Connection open")
-
+        # Usually already built in the background by /initialize; history waits for the first message.
+        session = await SESSIONS.get_live(session_id, with_history=False)
+    except Exception as e:
+        print(f"⚠️ Failed to rehydrate session {session_id}: {e}")
+        await websocket.send_text(json.dumps({"type": "error", "message": "Error: Could not load this character."}))
+        await websocket.close()
+        return
+    record = session.record
+    npc_team = session.team
+    idle_closed = False
+    image_path = record.context_files.get("image")
+    csharp_path = record.context_files.get("csharp")
+    is_new_session = record.is_new_session
+    initial_description = SCENE_UNAVAILABLE
+    scene_task = None
+    # The turn in progress. A new message or '_INTERRUPT_' cancels it, unless its reply is already out.
+    turn_task: asyncio.Task | None = None
+    turn_token: CancellationToken | None = None
+    turn_committed = False
+    interrupt_reason = ""
+    interrupted_message: str | None = None
+    # World updates made by interrupted turns; their history is rolled back but the updates stay.
+    interrupted_effects: list[str] = []
+    # World objects changed by anyone since this NPC's last answered turn, when it has no live snapshot.
+    world_changes: dict[str, dict] = {}
+    world_feed = get_world_state().subscribe()
+    # Set when this session's C# script was edited on disk since the NPC's last answered turn.
+    environment_changed = False
+    environment_feed = get_file_watcher().subscribe()
+
+    async def forward_world_changes() -> None:
+        """Pushes every world change to this client as it happens."""
         while True:
-            message = await websocket.receive_text()
-            if message == '_TERMINATE_':
-                break
-
-            current_mood = SESSIONS[session_id].get("npc_mood", "neutral")
-            current_inventory = SESSIONS[session_id].get("npc_inventory", [])
-            inventory_str = ", ".join(current_inventory) if current_inventory else "nothing"
-            character_name = session.get("name", "The NPC")
-            valid_moods_str = ", ".join([f"'{m}'" for m in get_valid_moods()])
-
-            task_prompt = (
-                f"The user's message is: '{message}'.\n\n"
-                f"--- CONTEXT ---\n"
-                f"Your Current Mood: {current_mood}\n"
-                f"Your Inventory: You are currently holding {inventory_str}.\n"
-                f"Visual Description of the Scene: {initial_description}\n"
-                f"C# File Path: {csharp_path or 'not provided'}\n\n"
+            change = await world_feed.get()
+            if change.object is None:
+                await websocket.send_text(json.dumps(world_sync_frame()))
+                continue
+            await websocket.send_text(json.dumps(change.frame()))
+            if not config.ENV_SNAPSHOT_IN_PROMPT:
+                world_changes[change.object["Name"]] = change.object
+
+    async def forward_environment_changes() -> None:
+        """Tells this client when its C# script is reloaded; turns pick up the new snapshot by themselves."""
+        nonlocal environment_changed
+        watched_path = os.path.abspath(csharp_path) if csharp_path else None
+        while True:
+            change = await environment_feed.get()
+            if change.path != watched_path:
+                continue
+            await websocket.send_text(json.dumps(change.frame()))
+            if not config.ENV_SNAPSHOT_IN_PROMPT:
+                environment_changed = True
+
+    async def run_turn(message: str, cancellation_token: CancellationToken) -> None:
+        nonlocal session
+        # The team may have been spilled to state/ while idle; this resumes it. It stays
+        # busy for the whole turn so another session's load cannot spill it mid-turn.
+        session = await SESSIONS.get_live(session_id, busy=True)
+        try:
+            await answer_message(message, cancellation_token)
+        finally:
+            session.busy = False
+
+    async def answer_message(message: str, cancellation_token: CancellationToken) -> None:
+        nonlocal record, npc_team, initial_description, scene_task, turn_committed, interrupted_message
+        nonlocal environment_changed
+        record = session.record
+        npc_team = session.team
+
+        if scene_task is not None and scene_task.done():
+            initial_description = scene_task.result()
+            print(f"Initial scene description: {initial_description}")
+            scene_task = None
+
+        current_mood = record.npc_mood
+        current_inventory = record.npc_inventory
+        inventory_str = ", ".join(current_inventory) if current_inventory else "nothing"
+        character_name = record.name
+        valid_moods_str = ", ".join([f"'{m}'" for m in get_valid_moods()])
+
+        # Repeated questions to the same persona are answered without running the team.
+        # Commands are never cached: their replies carry actions.
+        cache_key = cache_embedding = None
+        intent = classify_intent(message)
+        turn_world_version = world_version()
+        if (
+            config.RESPONSE_CACHE
+            and intent.category != "command"
+            and await asyncio.to_thread(get_persona_index().response_cache_enabled, character_name)
+        ):
+            cache_key = persona_key(record.persona, record.context_files)
+            cached, cache_embedding = await get_response_cache().lookup(cache_key, current_mood, message)
+            if cached:
+                turn_committed = True
+                record.npc_mood = cached["mood"]
+                await websocket.send_text(json.dumps({"type": "dialogue", "cached": True, **cached}))
+                # The NPC remembers this exchange as if it had answered it itself.
+                reply = {"response": cached["message"], "mood": cached["mood"], "animation": cached["animation"], "action": "RESPOND: user"}
+                await npc_team.record_exchange(f"The user's message is: '{message}'.", json.dumps(reply), character_name)
+                print(f"DEBUG: Served '{character_name}' reply from the response cache.")
+                session.last_active = time.time()
+                return
+
+        # Static instructions first, the player's message last: consecutive turns share a cacheable prefix.
+        turn_prompt = (
+            TurnPrompt()
+            .add("instructions", load_prompt(
+                "turn_instructions.txt",
+                valid_moods=valid_moods_str,
+                npc_name=character_name,
+                snapshot_rule=SNAPSHOT_RULE if config.ENV_SNAPSHOT_IN_PROMPT else "",
+            ))
+            .add("session", f"--- CONTEXT ---\nC# File Path: {csharp_path or 'not provided'}")
+            .add("scene", f"Visual Description of the Scene: {initial_description}", priority=1)
+            .add("inventory", f"Your Inventory: You are currently holding {inventory_str}.", priority=2)
+            .add("mood", f"Your Current Mood: {current_mood}")
+        )
+        print("DEBUG: Task prompt created. About to call npc_team.run...")
+        # --- START OF UPDATED BLOCK ---
+        turn_trace = TurnTrace(session_id)
+        trace_token = current_trace.set(turn_trace)
+        pre_turn_state = None
+        try:
+            # Restored if the turn is interrupted, so a half-finished turn leaves nothing in the agents' contexts.
+            pre_turn_state = await npc_team.save_state()
+            # Deltas are only produced when the NPC agent streams (config.NPC_STREAMING).
+            with traced("turn", "npc", character=character_name):
+                # Mixed lore + layout questions: fetch what the NPC lacks at once instead of agent hops.
+                lookups = []
+                if len(intent.lookups) > 1:
+                    lookups = [c for c in intent.lookups if c != "story" or record.context_files.get("story")]
+                    if config.ENV_SNAPSHOT_IN_PROMPT:
+                        # World data is already in the NPC's context.
+                        lookups = [c for c in lookups if c != "world"]
+                if config.FANOUT_ENABLED and lookups:
+                    turn_prompt.add("lookups", await gather_specialist_data(session.all_tools, lookups, message), priority=3)
+                reported_changes = dict(world_changes)
+                if reported_changes:
+                    changed = "; ".join(f"{name} is now {obj.get('Status')}" for name, obj in reported_changes.items())
+                    turn_prompt.add("world_changes", f"World changes since your last answer: {changed}.", priority=2)
+                reported_environment = environment_changed
+                if reported_environment:
+                    turn_prompt.add("environment_changed", "The game environment was edited since your last answer; look it up again before relying on earlier layout details.", priority=2)
+                if interrupted_message:
+                    note = f"The user interrupted your answer to their previous message ('{interrupted_message}') with this one."
+                    if interrupted_effects:
+                        note += f" Before the interruption you already {'; '.join(interrupted_effects)}; that still holds."
+                    turn_prompt.add("interrupted", note, priority=2)
+                turn_prompt.add("message", f"The user's message is: '{message}'.")
+                task_prompt = turn_prompt.build(character_name)
+                task_result, streamed = await run_team_turn(websocket, npc_team, task_prompt, character_name, cancellation_token)
+            print("DEBUG: npc_team.run completed successfully.")
+            # Streamed turns finish with 'dialogue_end', which carries the full validated text.
+            dialogue_type = "dialogue_end" if streamed else "dialogue"
+            
+            if task_result and task_result.messages:
+                raw_output = task_result.messages[-1].content
+                print(f"DEBUG: Raw output from agent team: {raw_output}")
                 
-                f"--- JSON OUTPUT RULE ---\n"
-                f"Your final response MUST begin with a single valid JSON object. In the 'mood' field of this JSON, you MUST use exactly one of the following string values: {valid_moods_str}.\n\n"
-
-                f"--- DECISION-MAKING FRAMEWORK ---\n"
-                f"1. **Analyze User Intent:** First, classify the user's message into one of three categories:\n"
-                f"   - **Category A (Factual Inquiry):** The user is asking a question that requires you to look up **new information that you do not already have in your context**.\n"
-                f"   - **Category B (Direct Command):** The user is telling you to perform a physical action in the world (e.g., 'Pick up the wrapper', 'Open the door').\n"
-                f"   - **Category C (Social Interaction):** The user is engaging in simple conversation (e.g., 'Hello', 'How are you?').\n\n"
+                # Near misses are repaired locally; otherwise only the NPC is asked once more.
+                npc_agent = get_npc_agent(npc_team, character_name)
+                response_data, raw_output = await parse_npc_response(
+                    raw_output, retry=final_agent_retry(npc_agent, cancellation_token) if npc_agent else None
+                )
+                # The answer is settled; what follows is sent and applied even if the player moves on.
+                turn_committed = True
+                interrupted_message = None
+                interrupted_effects.clear()
+                for name, obj in reported_changes.items():
+                    if world_changes.get(name) is obj:
+                        del world_changes[name]
+                if reported_environment:
+                    environment_changed = False
+
+                if response_data:
+                    print(f"DEBUG: Successfully validated JSON: {response_data.model_dump_json(indent=2)}")
+
+                    print("\n--- NPC Full Response ---")
+                    print(response_data.model_dump_json(indent=2))
+                    print("--------------------------\n")
                 
-                f"2. **Execute the Plan:** Based on the category, follow this logic:\n"
-                f"   - **If Category A:** You MUST use a specialist agent (`CodeAnalyzerAgent` or `StoryAgent`) to gather the new facts. Do not answer directly.\n"
-                f"   - **If the user's question can be answered using information already in your context (from a previous tool use), treat it as Category C.**\n"
-                f"   - **If Category B or C:** No specialist data-gathering tools are needed. The main NPC, `{character_name}`, should respond directly by generating the required JSON.\n"
-            )
-            print("DEBUG: Task prompt created. About to call npc_team.run...")
-            # --- START OF UPDATED BLOCK ---
-            try:
-                task_result = await npc_team.run(task=task_prompt)
-                print("DEBUG: npc_team.run completed successfully.")
+                    record.npc_mood = response_data.mood
                 
-                if task_result and task_result.messages:
-                    raw_output = task_result.messages[-1].content
-                    print(f"DEBUG: Raw output from agent team: {raw_output}")
-                    
-                    response_dict = extract_json_from_string(raw_output)
+                    dialogue_message = {
+                        "type": dialogue_type,
+                        "message": response_data.response,
+                        "animation": response_data.animation.split(':')[0].strip()
+                    }
+                    await websocket.send_text(json.dumps(dialogue_message))
+                    print(f"DEBUG: Sent '{dialogue_type}' message to frontend.")
+
+                    if cache_key and response_data.action.split(":")[0].strip().upper() == "RESPOND":
+                        get_response_cache().store(
+                            cache_key, current_mood, message, cache_embedding,
+                            {"message": response_data.response, "mood": response_data.mood, "animation": dialogue_message["animation"]},
+                            # Small talk and lore do not change with the world; everything else is tied to this version.
+                            world_version=None if intent.category in ("social", "story") and "world" not in intent.lookups else turn_world_version,
+                        )
+
+                    # 2. Handle validated actions
+                    action_parts = [part.strip() for part in response_data.action.split(":", 1)]
+                    if len(action_parts) == 2:
+                        verb, target = action_parts
                     
-                    if response_dict:
-                        try:
-                            # 1. Validate the dictionary against your Pydantic model
-                            response_data = NPCResponse(**response_dict)
-                            print(f"DEBUG: Successfully validated JSON: {response_data.model_dump_json(indent=2)}")
-
-                            print("\n--- NPC Full Response ---")
-                            print(response_data.model_dump_json(indent=2))
-                            print("--------------------------\n")
-                            
-                            SESSIONS[session_id]["npc_mood"] = response_data.mood
-                            
-                            dialogue_message = {
-                                "type": "dialogue",
-                                "message": response_data.response,
+                        if verb.upper() in ["MOVE", "INTERACT"]:
+                            action_message = {
+                                "type": "action",
+                                "command": verb.upper(),
+                                "target": target,
                                 "animation": response_data.animation.split(':')[0].strip()
                             }
-                            await websocket.send_text(json.dumps(dialogue_message))
-                            print("DEBUG: Sent 'dialogue' message to frontend.")
+                            await websocket.send_text(json.dumps(action_message))
+                            print(f"DEBUG: Sent 'action' message ({verb.upper()}) to frontend.")
+
+                        elif verb.upper() == "PICKUP":
+                            item_to_pickup = target
+                            if item_to_pickup and item_to_pickup not in record.npc_inventory:
+                                record.npc_inventory.append(item_to_pickup)
+                                print(f"✅ NPC Inventory Update: Added '{item_to_pickup}'")
+                    
 
-                            # 2. Handle validated actions
-                            action_parts = [part.strip() for part in response_data.action.split(":", 1)]
-                            if len(action_parts) == 2:
-                                verb, target = action_parts
+                        elif verb.upper() == "UPDATE_STATUS":
+                            update_tool = next((t for t in session.all_tools if t.name == "update_world_state"), None)
+                            if update_tool:
+                                try:
+                                    obj_name, new_status = [part.strip() for part in target.split(",", 1)]
                                 
-                                if verb.upper() in ["MOVE", "INTERACT"]:
-                                    action_message = {
-                                        "type": "action",
-                                        "command": verb.upper(),
-                                        "target": target,
-                                        "animation": response_data.animation.split(':')[0].strip()
-                                    }
-                                    await websocket.send_text(json.dumps(action_message))
-                                    print(f"DEBUG: Sent 'action' message ({verb.upper()}) to frontend.")
-
-                                elif verb.upper() == "PICKUP":
-                                    item_to_pickup = target
-                                    if item_to_pickup and item_to_pickup not in SESSIONS[session_id]["npc_inventory"]:
-                                        SESSIONS[session_id]["npc_inventory"].append(item_to_pickup)
-                                        print(f"✅ NPC Inventory Update: Added '{item_to_pickup}'")
+                                    cancellation_token = CancellationToken()
                                 
-
-                                elif verb.upper() == "UPDATE_STATUS":
-                                    update_tool = next((t for t in session["all_tools"] if t.name == "update_world_state"), None)
-                                    if update_tool:
-                                        try:
-                                            obj_name, new_status = [part.strip() for part in target.split(",", 1)]
-                                            
-                                            cancellation_token = CancellationToken()
-                                            
-                                            tool_result = await update_tool.run_json(
-                                                {"target_object": obj_name, "new_status": new_status}, 
-                                                cancellation_token
-                                            )
-                                            
-                                            print(f"✅ World State Update: {update_tool.return_value_as_string(tool_result)}")
-                                            
-                                        except Exception as tool_e:
-                                            print(f"⚠️ Error calling update_world_state tool: {tool_e}")
-                                    else:
-                                        print(f"⚠️ update_world_state tool not found in session tools")
-
-
-
-                        except ValidationError as e:
-                            print(f"⚠️ VALIDATION ERROR: AI response did not match NPCResponse model.\n{e}")
-                            await websocket.send_text(json.dumps({
-                                "type": "error",
-                                "message": "System: My thoughts are a bit scrambled. Please try rephrasing."
-                            }))
-                    else:
-                        print("DEBUG: Failed to extract JSON. Treating as fallback text.")
-                        fallback_message = { "type": "dialogue", "message": raw_output.replace("APPROVE", "").strip(), "animation": "talk_passionately"}
-                        await websocket.send_text(json.dumps(fallback_message))
+                                    tool_result = await update_tool.run_json(
+                                        {"target_object": obj_name, "new_status": new_status}, 
+                                        cancellation_token
+                                    )
+                                
+                                    print(f"✅ World State Update: {update_tool.return_value_as_string(tool_result)}")
+                                
+                                except Exception as tool_e:
+                                    print(f"⚠️ Error calling update_world_state tool: {tool_e}")
+                            else:
+                                print(f"⚠️ update_world_state tool not found in session tools")
+
+                elif extract_json_from_string(raw_output) is not None:
+                    print("⚠️ VALIDATION ERROR: AI response did not match NPCResponse model.")
+                    if streamed:
+                        await websocket.send_text(json.dumps({"type": "dialogue_end", "discard": True}))
+                    await websocket.send_text(json.dumps({
+                        "type": "error",
+                        "message": "System: My thoughts are a bit scrambled. Please try rephrasing."
+                    }))
                 else:
-                    print("DEBUG: Task result was empty or had no messages.")
-
-            except (InternalServerError, AuthenticationError, Exception) as e:
-                print(f"ERROR: Exception during agent run or processing: {e}")
-                
-                error_message = "Error: The AI service failed unexpectedly. Please try again."
-                # Check for a status_code if it's an API error
-                if hasattr(e, 'status_code'):
-                    error_message = f"Error: The AI service failed. ({e.status_code})"
+                    print("DEBUG: Failed to extract JSON. Treating as fallback text.")
+                    fallback_message = { "type": dialogue_type, "message": raw_output.replace("APPROVE", "").strip(), "animation": "talk_passionately"}
+                    await websocket.send_text(json.dumps(fallback_message))
+            else:
+                print("DEBUG: Task result was empty or had no messages.")
+
+        except asyncio.CancelledError:
+            turn_trace.interrupted = True
+            TURNS_INTERRUPTED.inc(reason=interrupt_reason or "cancelled")
+            interrupted_message = message
+            interrupted_effects.extend(turn_trace.effects)
+            print(f"DEBUG: Turn for '{character_name}' interrupted ({interrupt_reason}); rolling back.")
+            if pre_turn_state is not None:
+                await npc_team.reset()
+                await npc_team.load_state(pre_turn_state)
+            if interrupt_reason != "disconnect":
+                # Drops any streamed partial reply on the client.
+                await websocket.send_text(json.dumps({"type": "dialogue_end", "discard": True, "interrupted": True}))
+            raise
+        except (InternalServerError, AuthenticationError, Exception) as e:
+            print(f"ERROR: Exception during agent run or processing: {e}")
+            
+            error_message = "Error: The AI service failed unexpectedly. Please try again."
+            # Check for a status_code if it's an API error
+            if hasattr(e, 'status_code'):
+                error_message = f"Error: The AI service failed. ({e.status_code})"
+
+            await websocket.send_text(json.dumps({
+                "type": "error", 
+                "message": error_message
+            }))
+        finally:
+            session.last_active = time.time()
+            current_trace.reset(trace_token)
+            summary = turn_trace.summary()
+            if not turn_trace.interrupted:
+                TURN_DURATION.observe(summary["turn_ms"] / 1000)
+            print(f"DEBUG: Turn trace: {json.dumps(summary)}")
+            if config.NPC_TRACE_DEBUG and interrupt_reason != "disconnect":
+                await websocket.send_text(json.dumps(summary))
+        # --- END OF UPDATED BLOCK ---
+
+    async def interrupt_turn(reason: str) -> None:
+        """Cancels the running turn and waits until its state has been rolled back."""
+        nonlocal turn_task, interrupt_reason
+        if turn_task is None:
+            return
+        if not turn_task.done() and not turn_committed:
+            interrupt_reason = reason
+            turn_task.cancel()
+            # Aborts the model calls running inside the team and drops its queued ones.
+            turn_token.cancel()
+        await asyncio.wait({turn_task})
+        task, turn_task = turn_task, None
+        if reason != "disconnect" and not task.cancelled():
+            task.result()
+
+    receive_task: asyncio.Task | None = None
+    world_task: asyncio.Task | None = None
+    environment_task: asyncio.Task | None = None
+    try:
+        # Seq numbers let the client spot missed updates and ask for them with '_RESYNC_:<seq>'.
+        await websocket.send_text(json.dumps(world_sync_frame()))
+        world_task = asyncio.create_task(forward_world_changes())
+        environment_task = asyncio.create_task(forward_environment_changes())
+        if image_path and is_new_session:
+            # Described in the background (downscaled, cached by content hash); turns use a placeholder until then.
+            labeled = getattr(session.model_client, "labeled", None)
+            vision_client = labeled("VisionAgent", priority=PRIORITY_BACKGROUND) if labeled else session.model_client
+            scene_task = asyncio.create_task(get_scene_descriptions().describe(image_path, vision_client))
+            initial_description = SCENE_PLACEHOLDER
+        
+        print("INFO:     Connection open")
 
-                await websocket.send_text(json.dumps({
-                    "type": "error", 
-                    "message": error_message
-                }))
-            # --- END OF UPDATED BLOCK ---
+        # Receiving continues while a turn runs, so the player can interrupt it.
+        while True:
+            if receive_task is None:
+                receive_task = asyncio.ensure_future(websocket.receive_text())
+            waiting = {receive_task} if turn_task is None else {receive_task, turn_task}
+            # The idle clock only runs between turns.
+            done, _ = await asyncio.wait(
+                waiting,
+                timeout=SESSIONS.idle_timeout if turn_task is None else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if not done:
+                print(f"Session {session_id} idle for {SESSIONS.idle_timeout:.0f}s. Closing.")
+                idle_closed = True
+                break
+            if turn_task in done:
+                await interrupt_turn("finished")
+            if receive_task not in done:
+                continue
+            message, receive_task = receive_task.result(), None
+            if message == '_TERMINATE_':
+                break
+            if message.startswith('_RESYNC_'):
+                # Not a player message: the running turn carries on.
+                await send_world_changes(websocket, message.partition(":")[2])
+                continue
+            await interrupt_turn("interrupt" if message == '_INTERRUPT_' else "message")
+            if message == '_INTERRUPT_':
+                continue
+            turn_token = CancellationToken()
+            turn_committed = False
+            turn_task = asyncio.create_task(run_turn(message, turn_token))
 
     except WebSocketDisconnect:
         print(f"Client disconnected from session {session_id}")
     finally:
+        if receive_task is not None:
+            receive_task.cancel()
+        get_world_state().unsubscribe(world_feed)
+        if world_task is not None:
+            world_task.cancel()
+        get_file_watcher().unsubscribe(environment_feed)
+        if environment_task is not None:
+            environment_task.cancel()
+        # Nobody will see this turn's answer; its state is rolled back before the session is saved.
+        await interrupt_turn("disconnect")
+        if scene_task is not None:
+            scene_task.cancel()
         print(f"Closing session {session_id}...")
 
-        try:
-            state_path = get_state_path(session["name"])
-            team_state = await npc_team.save_state()
-            
-            full_session_state = {
-                "persona": {
-                    "name": session.get("name"),
-                    "background": session.get("background"),
-                    "behavior": session.get("behavior"),
-                },
-                "context_files": {
-                    "csharp": session["uploaded_files"].get("csharp"),
-                    "story": session["uploaded_files"].get("story"),
-                },
-                "team_state": team_state,
-                "npc_mood": session.get("npc_mood", "neutral"),
-                "npc_inventory": session.get("npc_inventory", [])
-            }
-            with open(state_path, 'w') as f:
-                json.dump(full_session_state, f, indent=2)
-            print(f"✅ Session state for '{session['name']}' saved to '{state_path}'")
-        except Exception as e:
-            print(f"⚠️ Failed to save session state: {e}")
-        
-        uploaded_files = session.get("uploaded_files", {})
-        for file_type, file_path in uploaded_files.items():
-            if file_path and os.path.exists(file_path):
-                try:
-                    if UPLOAD_DIR.resolve() in Path(file_path).resolve().parents:
-                        os.remove(file_path)
-                        print(f"✅ Cleaned up {file_type} file: {file_path}")
-                except OSError as e:
-                    print(f"⚠️ Error cleaning up file {file_path}: {e}")
-
-        await session["rag_memory"].close()
-        await session["model_client"].close()
-        del SESSIONS[session_id]
+        await SESSIONS.close(session_id, idle=idle_closed)
         print(f"Session {session_id} and its resources have been released.")
         
         if not websocket.client_state.name == 'DISCONNECTED':
             await websocket.close()
         print("INFO:     Connection closed")
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus text format: turn/step latency histograms, token counts, retries, loop lag."""
+    extra = {f"npc_sessions_{k}": v for k, v in SESSIONS.stats().items() if isinstance(v, (int, float))}
+    try:
+        extra.update({f"npc_model_pool_{k}": v for k, v in get_model_pool().stats().items()})
+    except Exception as e:
+        print(f"⚠️ Model pool unavailable for metrics: {e}")
+    return PlainTextResponse(render_metrics(extra))
+
+_loop_lag_task: asyncio.Task | None = None
+
 @app.on_event("startup")
 async def startup_event():
+    global _loop_lag_task
     debug_world_state()
+    get_world_state()  # Loaded once; turns and tools read it from memory
+    if config.FILE_WATCH:
+        # Designer edits are reloaded in the background instead of being re-read by turns.
+        get_file_watcher().start()
+    SESSIONS.start(config.SESSION_SWEEP_INTERVAL)
+    _loop_lag_task = asyncio.create_task(monitor_event_loop_lag())
+    # First run with an existing state/ directory: backfill the persona index once.
+    if get_persona_index().is_empty():
+        count = await asyncio.to_thread(get_persona_index().rebuild, STATE_DIR)
+        print(f"✅ Persona index built from {count} saved state file(s).")
+    # Load the embedding model and Chroma client once, before the first /initialize.
+    try:
+        await asyncio.to_thread(memory.get_rag_collection)
+        print("✅ Shared embedding model and Chroma collection loaded.")
+    except Exception as e:
+        print(f"⚠️ Could not preload shared RAG memory: {e}")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if _loop_lag_task:
+        _loop_lag_task.cancel()
+    await get_file_watcher().stop()
+    await SESSIONS.shutdown()
+    await get_world_state().flush()
+    await close_model_pool()
 
 app.mount("/public", StaticFiles(directory="public"), name="public_assets")
 
@@ -1,12 +1,14 @@
 # main.py
 import asyncio
-import json
 import os
 from pathlib import Path
 
 from agents.team import create_agent_team
 from autogen_agentchat.ui import Console
 from core import config, memory, tools
+from core.persistence import load_state_file, save_state_file
+from core.prompts import TurnPrompt, load_prompt
+from core.world_state import get_world_state
 from utils import helpers
 
 
@@ -42,8 +44,7 @@ async def main():
     state_filename = os.path.join("state", f"npc_{npc_config['name'].lower()}_state.json")
     if os.path.exists(state_filename):
         try:
-            with open(state_filename, "r") as f:
-                saved_state = json.load(f)
+            saved_state = load_state_file(state_filename)
             await team.load_state(saved_state)
             print(f"✅ Restored NPC team state from {state_filename}.")
         except Exception as e:
@@ -59,18 +60,11 @@ async def main():
             break
 
         task_prompt = (
-            f"The user's request is: '{user_input}'.\n\n"
-            f"--- MANDATORY CONTEXT ---\n"
-            f"C# File Path: {csharp_file_path}\n"
-            f"--- END CONTEXT ---\n\n"
-            f"Your first step is to use the CodeAnalyzerAgent to get a JSON object with data from the C# file. "
-            f"This data represents the current state and layout of the world.\n\n"
-            
-            f"**RULES FOR YOUR RESPONSE:**\n"
-            f"1. **Interpret Spatial Data:** The context data may contain object locations as Vector3 coordinates (e.g., '\"cashierTableLocation\": {{\"x\": 5.0, ...}}'). Use this information to understand where things are, but **DO NOT** mention the raw coordinates in your dialogue. Refer to locations by their human-readable names.\n"
-            f"2. **Movement Action Rule:** If your action involves moving, the destination in your 'action' description **MUST EXACTLY MATCH** one of the names from the 'navigableLocations' array provided in the C# data.\n"
-            f"3. **Use All Relevant Data:** Pay attention to all data points provided, such as 'DamageThreshold' or 'storeCleanliness', if they are relevant to the user's request.\n\n"
-            f"Now, formulate your thoughts, response, mood, and action based on these rules."
+            TurnPrompt()
+            .add("instructions", load_prompt("cli_turn_instructions.txt"))
+            .add("session", f"--- MANDATORY CONTEXT ---\nC# File Path: {csharp_file_path}\n--- END CONTEXT ---")
+            .add("message", f"The user's message is: '{user_input}'.")
+            .build(npc_config["name"])
         )
 
         try:
@@ -81,12 +75,13 @@ async def main():
 
         try:
             npc_state = await team.save_state()
-            with open(state_filename, "w") as f:
-                json.dump(npc_state, f, default=str)
+            # Appends only this turn's messages instead of rewriting the whole history.
+            save_state_file(state_filename, npc_state)
             print(f"\n--- NPC State Saved to {state_filename} ---\n")
         except Exception as e:
             print(f"Error saving state: {str(e)}")
 
+    await get_world_state().flush()
     await model_client.close()
     await rag_memory.close()
 
@@ -187,9 +187,13 @@ function connectWebSocket() {
     socket = new WebSocket(socketUrl);
     socket.onopen = () => { addMessageToChat('system', 'Connected to the AI.'); };
     socket.onmessage = (event) => {
-        typingIndicator.style.display = 'none';
-        try { const data = JSON.parse(event.data); handleIncomingMessage(data); }
-        catch (e) { console.error('Failed to parse incoming message as JSON:', event.data); addMessageToChat('bot', event.data); }
+        try {
+            const data = JSON.parse(event.data);
+            if (handleWorldFrame(data)) return;
+            typingIndicator.style.display = 'none';
+            handleIncomingMessage(data);
+        }
+        catch (e) { typingIndicator.style.display = 'none'; console.error('Failed to parse incoming message as JSON:', event.data); addMessageToChat('bot', event.data); }
     };
     socket.onclose = () => { addMessageToChat('system', 'Connection closed.'); terminateBtn.disabled = true; };
     socket.onerror = () => { typingIndicator.style.display = 'none'; addMessageToChat('system', 'Could not connect.'); };
@@ -234,6 +238,39 @@ function sendMessage() {
     }
 }
 
+// Bubble text element for an NPC reply that is still being streamed.
+let streamingText = null;
+
+// World objects as last pushed by the server. 'seq' increases by one per change,
+// so a jump means updates were missed and the server is asked to replay them.
+let worldSeq = null;
+let worldResyncing = false;
+const worldState = new Map();
+
+function handleWorldFrame(data) {
+    if (data.type === 'world_sync') {
+        worldSeq = data.seq;
+        worldResyncing = false;
+        worldState.clear();
+        (data.objects || []).forEach(obj => worldState.set(obj.Name, obj));
+    } else if (data.type === 'world_update') {
+        if (worldSeq === null || data.seq <= worldSeq) return true;
+        if (data.seq !== worldSeq + 1) {
+            if (!worldResyncing) { worldResyncing = true; socket.send(`_RESYNC_:${worldSeq}`); }
+            return true;
+        }
+        worldSeq = data.seq;
+        worldResyncing = false;
+        worldState.set(data.object.Name, data.object);
+        console.debug(`World update ${data.seq}: ${data.object.Name} -> ${data.object.Status}`);
+    } else if (data.type === 'environment_update') {
+        console.debug(`Environment script reloaded: ${data.version}`);
+    } else {
+        return false;
+    }
+    return true;
+}
+
 function handleIncomingMessage(data) {
     switch(data.type) {
         case 'dialogue':
@@ -243,7 +280,29 @@ function handleIncomingMessage(data) {
                 if (data.animation && data.animation !== 'talk_passionately') { playAnimation(data.animation); }
             }
             break;
+        case 'dialogue_delta':
+            if (!streamingText) { streamingText = addMessageToChat('bot', ''); }
+            if (data.reset) { streamingText.textContent = ''; }
+            streamingText.textContent += data.message || '';
+            chatBox.scrollTop = chatBox.scrollHeight;
+            break;
+        case 'dialogue_end':
+            if (data.discard) {
+                if (streamingText) { streamingText.closest('.flex').remove(); }
+            } else if (data.message) {
+                if (streamingText) { streamingText.textContent = data.message; }
+                else { addMessageToChat('bot', data.message); }
+                speak(data.message);
+                if (data.animation && data.animation !== 'talk_passionately') { playAnimation(data.animation); }
+            }
+            streamingText = null;
+            break;
+        case 'trace':
+            // Per-turn latency breakdown, only sent when NPC_TRACE_DEBUG=1 on the server.
+            console.debug(`Turn ${data.turn_ms} ms`, data.spans);
+            break;
         case 'error':
+            streamingText = null;
             addMessageToChat('system', data.message);
             break;
         default:
@@ -270,6 +329,7 @@ function addMessageToChat(sender, message) {
     messageBubble.appendChild(messageText);
     messageWrapper.appendChild(messageBubble);
     chatBox.appendChild(messageWrapper);
+    return messageText;
 }
 
 initThree();